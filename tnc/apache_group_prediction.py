@@ -1,7 +1,9 @@
 import torch
 import random
-from tnc.models import CausalCNNEncoder, RnnPredictor
+from tnc.models import CausalCNNEncoder
 from tnc.utils import dim_reduction, detect_incr_loss
+from tnc.trajectories import compute_risk_trajectories
+from tnc.tasks import EncodingSource, MulticlassHead, Task, TaskEngine, task_epoch_run
 import numpy as np
 import os
 import matplotlib.pyplot as plt
@@ -9,72 +11,28 @@ from sklearn.metrics import roc_auc_score, precision_recall_curve, auc, classifi
 from sklearn.metrics import roc_curve
 import argparse
 
-def linear_classifier_epoch_run(dataset, train, classifier, optimizer, data_type, window_size, encoder, encoding_size, class_weights, device):
-    if train:
-        classifier.train()
-    else:
-        classifier.eval()
-    
-    epoch_losses = []
-    epoch_predictions = []
-    epoch_labels = []
-    for data_batch, label_batch in dataset:
-        encoding_batch = encoder.forward_seq(data_batch.float().to(device))
-        predictions = torch.squeeze(classifier(encoding_batch)) # of shape (bs, n_classes)
-        label_batch = label_batch.to(device)
-        
-        
-        if train:
-            loss_fn = torch.nn.CrossEntropyLoss(weight=class_weights) # Applies softmax to outputs passed in so we shouldn't have softmax in the model. 
-            
-            loss = loss_fn(predictions, label_batch.long())
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-        else:
-            loss_fn = torch.nn.CrossEntropyLoss(weight=class_weights)
-            loss = loss_fn(predictions, label_batch.long())
-        
-        epoch_loss = loss.item()
-
-        # Apply sigmoid to predictions since we didn't apply it for the loss function since the loss function does sigmoid on its own.
-        predictions = torch.nn.Softmax(dim=1)(predictions)
-
-        # Move Tensors to CPU and remove gradients so they can be converted to NumPy arrays in the sklearn functions
-        #window_labels = window_labels.cpu().detach()
-        predictions = predictions.cpu().detach()
-        encoding_batch = encoding_batch.cpu() # Move off GPU memory
-        #neg_window_labels = neg_window_labels.cpu()
-        #pos_window_labels = pos_window_labels.cpu()
-        label_batch = label_batch.cpu()
-
-        epoch_losses.append(epoch_loss)
-        epoch_predictions.append(predictions)
-        epoch_labels.append(label_batch)
-    
-    return epoch_predictions, epoch_losses, epoch_labels
-
 def train_linear_classifier(X_train, y_train, X_validation, y_validation, X_TEST, y_TEST, encoding_size, encoder, window_size, target_names, class_weights, device, lr_list, weight_decay_list, n_epochs_list, encoder_type, batch_size=32, return_models=False, return_scores=False, data_type='ICU', classification_cv=0, encoder_cv=0, ckpt_path="./ckpt",  plt_path="./DONTCOMMITplots", classifier_name=""):
     '''
     Trains a classifier to predict positive events in samples. 
     X_train is of shape (num_train_samples, 2, num_features, seq_len)
     y_train is of shape (num_train_samples,)
-
+    The encoder is frozen, so the samples are encoded once (see tnc.tasks.EncodingSource) for all the runs, and each
+    classifier is trained by a TaskEngine on the cached encodings.
     '''
     print("Training Linear Classifier", flush=True)
 
     print('X_train shape: ', X_train.shape)
     print('batch_size: ', batch_size)
-    train_dataset = torch.utils.data.TensorDataset(X_train, y_train)
-    train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    validation_dataset = torch.utils.data.TensorDataset(X_validation, y_validation)
-    validation_data_loader = torch.utils.data.DataLoader(validation_dataset, batch_size=batch_size, shuffle=True)
-    TEST_dataset = torch.utils.data.TensorDataset(X_TEST, y_TEST)
-    TEST_data_loader = torch.utils.data.DataLoader(TEST_dataset, batch_size=batch_size, shuffle=True)
-    
+    encoder.eval()
+    source = EncodingSource(encoder, batch_size=batch_size, device=device)
+    source.add('train', X_train)
+    source.add('TEST', X_TEST)
+    if X_validation is not X_train:
+        source.add('validation', X_validation)
+    splits = {'train': ('train', y_train.cpu(), None),
+              'validation': ('train' if X_validation is X_train else 'validation', y_validation.cpu(), None),
+              'TEST': ('TEST', y_TEST.cpu(), None)}
 
-    
     for lr in lr_list:
         for weight_decay in weight_decay_list:
             for n_epochs in n_epochs_list:
@@ -83,37 +41,22 @@ def train_linear_classifier(X_train, y_train, X_validation, y_validation, X_TEST
                 for cv in range(3):
                     (unique, counts) = np.unique(y_train.cpu(), return_counts=True)
                     n_classes = len(unique)
-                    classifier = RnnPredictor(encoding_size=encoder.pruned_encoding_size, hidden_size=8, n_classes=n_classes).to(device)
-                    params = list(classifier.parameters())
                     #lr_list = [.007] #[0.01, 0.001, 0.0005, 0.007]
                     #weight_decay_list = [.001] #[0.001, 0.0001, 0]
                     #n_epochs_list = [120] #[100, 125, 150]
 
                     print('Learning Rate for classifier training: ', lr)
                     print('Weight Decay for classifier training: ', weight_decay)
-                    optimizer = torch.optim.Adam(params, lr=lr, weight_decay=weight_decay)
+                    engine = TaskEngine(source, [Task('apache', MulticlassHead(n_classes, class_weights), splits)], hidden_size=8,
+                                        lr=lr, weight_decay=weight_decay, batch_size=batch_size, device=device)
+                    classifier = engine.classifiers['apache']
                     train_losses = []
                     valid_losses = []
                     
                     for epoch in range(1, n_epochs + 1):
-                        encoder.eval()
-                        # linear_classifier_epoch_run(dataset, train, classifier, optimizer, data_type, window_size, encoder, encoding_size):
-                        epoch_train_predictions, epoch_train_losses, epoch_train_labels = linear_classifier_epoch_run(dataset=train_data_loader, train=True,
-                                                                    classifier=classifier,
-                                                                    optimizer=optimizer, data_type=data_type, window_size=window_size, encoder=encoder, encoding_size=encoding_size, class_weights=class_weights, device=device)
-
-                        
-                        classifier.eval()
-                        epoch_validation_predictions, epoch_validation_losses, epoch_validation_labels = linear_classifier_epoch_run(dataset=validation_data_loader, train=False,
-                                                                    classifier=classifier,
-                                                                    optimizer=optimizer, data_type=data_type, window_size=window_size, encoder=encoder, encoding_size=encoding_size, class_weights=class_weights, device=device)
-
-                        
-                        
-
-                        epoch_TEST_predictions, epoch_TEST_losses, epoch_TEST_labels = linear_classifier_epoch_run(dataset=TEST_data_loader, train=False,
-                                                                    classifier=classifier,
-                                                                    optimizer=optimizer, data_type=data_type, window_size=window_size, encoder=encoder, encoding_size=encoding_size, class_weights=class_weights, device=device)
+                        epoch_train_predictions, epoch_train_losses, epoch_train_labels = task_epoch_run(engine, 'apache', 'train', train=True)
+                        epoch_validation_predictions, epoch_validation_losses, epoch_validation_labels = task_epoch_run(engine, 'apache', 'validation')
+                        epoch_TEST_predictions, epoch_TEST_losses, epoch_TEST_labels = task_epoch_run(engine, 'apache', 'TEST')
 
                         
                         # TRAIN 
@@ -233,7 +176,10 @@ def train_linear_classifier(X_train, y_train, X_validation, y_validation, X_TEST
         return (epoch_validation_auroc, epoch_validation_auroc)
 
 
-def apache_prediction(encoder, encoder_cv, data_path, device, encoder_type):
+def load_apache_data(data_path, encoder_type=None):
+    '''Loads the first 24 hrs data maps of the train and TEST patients and their APACHE groups, mapped to consecutive class
+    numbers (classes missing from the TEST data or with fewer than 200 train samples are removed). Returns the train and TEST
+    data maps and labels, the names of the classes, and the class weights (max class count/class count) of the train data.'''
     train_first_24_hrs_data_maps = torch.from_numpy(np.load(os.path.join(data_path, 'train_first_24_hrs_data_maps.npy'))).float()
     TEST_first_24_hrs_data_maps = torch.from_numpy(np.load(os.path.join(data_path, 'TEST_first_24_hrs_data_maps.npy'))).float()
 
@@ -333,7 +279,7 @@ def apache_prediction(encoder, encoder_cv, data_path, device, encoder_type):
         print(unique[i], ': ', apache_names[i], ': ', counts[i])
         class_weights.append(counts[i])
     print()
-    class_weights = torch.Tensor(class_weights).to(device)
+    class_weights = torch.Tensor(class_weights)
     class_weights = torch.max(class_weights)/class_weights # So classes with high counts will have lower weights.
     (unique, counts) = np.unique(TEST_Apache_Groups, return_counts=True)
     print('Distribution of TEST Apache states:')
@@ -342,17 +288,18 @@ def apache_prediction(encoder, encoder_cv, data_path, device, encoder_type):
     
     
     print('class_weights: ', class_weights)
+    return train_first_24_hrs_data_maps, train_Apache_Groups, TEST_first_24_hrs_data_maps, TEST_Apache_Groups, apache_names, class_weights
 
-    encodings = []
-    apache_labels = []
-    for i in range(len(TEST_first_24_hrs_data_maps)//5):
-        sample = TEST_first_24_hrs_data_maps[i]
-        apache_label = TEST_Apache_Groups[i]
-        apache_labels.append(apache_label)
-        encodings.append(encoder(sample[:, :, 0:12].to(device)).squeeze().to('cpu').detach().numpy()) # Take first 5 min of data
-    
-    encodings = np.stack(encodings)
-    apache_labels = np.array(apache_labels)
+
+def apache_prediction(encoder, encoder_cv, data_path, device, encoder_type):
+    train_first_24_hrs_data_maps, train_Apache_Groups, TEST_first_24_hrs_data_maps, TEST_Apache_Groups, apache_names, class_weights = \
+        load_apache_data(data_path, encoder_type)
+    class_weights = class_weights.to(device)
+
+    num_plotted = len(TEST_first_24_hrs_data_maps)//5
+    _, encodings = compute_risk_trajectories(TEST_first_24_hrs_data_maps[:num_plotted, :, :, 0:encoder.window_size], encoder, device=device) # Take the first window of data
+    encodings = encodings[:, 0].numpy()
+    apache_labels = TEST_Apache_Groups[:num_plotted].numpy()
     dim_reduction(encodings=encodings, labels=apache_labels, save_path='./DONTCOMMITplots/HiRID_apache_classification', plot_name='first_encodings_clustered_TSNE', label_names=apache_names)
     dim_reduction(encodings=encodings, labels=apache_labels, save_path='./DONTCOMMITplots/HiRID_apache_classification', plot_name='first_encodings_clustered_PCA', label_names=apache_names, reduction_type='PCA')
     dim_reduction(encodings=encodings, labels=apache_labels, save_path='./DONTCOMMITplots/HiRID_apache_classification', plot_name='first_encodings_clustered_UMAP', label_names=apache_names, reduction_type='UMAP')
@@ -0,0 +1,392 @@
+"""
+Micro benchmarks comparing the fast implementations of models in tnc/models.py to their reference implementations.
+Each benchmark checks that both implementations give the same outputs before timing them.
+"""
+
+import torch
+import time
+import math
+import argparse
+from tnc.models import GRUD, RnnPredictor, EncoderMultiSignal, TST, WFEncoder, CausalCNNEncoder
+from tnc.ensemble import FoldEnsemble
+from tnc.trajectories import compute_risk_trajectories
+
+
+def time_function(function, num_repeats, device):
+    '''Returns the average number of seconds a call to function takes, after a warm up call.'''
+    with torch.no_grad():
+        function()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(num_repeats):
+            function()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start)/num_repeats
+
+
+def benchmark_grud(batch_size=64, num_features=18, hidden_size=32, seq_len=12, num_repeats=20, device='cpu'):
+    '''Compares GRUD.forward to GRUD.forward_stepwise (one call to GRUD.step with NaN checks per time step).'''
+    grud = GRUD(num_features=num_features, hidden_size=hidden_size, device=device)
+    X = torch.randn(batch_size, num_features, seq_len, device=device)
+    Mask = (torch.rand(batch_size, num_features, seq_len, device=device) > 0.5).float()
+    Delta = torch.randint(1, 10, (batch_size, num_features, seq_len), device=device).float()
+    X_mean = torch.randn(batch_size, num_features, device=device)
+
+    with torch.no_grad():
+        grud.check_nan = True
+        reference_outputs = grud.forward_stepwise(X, Mask, X, Delta, X_mean).to(device)
+        grud.check_nan = False
+        outputs = grud(X, Mask, X, Delta, X_mean)
+    max_diff = float(torch.max(torch.abs(outputs - reference_outputs)))
+
+    grud.check_nan = True
+    reference_time = time_function(lambda: grud.forward_stepwise(X, Mask, X, Delta, X_mean), num_repeats, device)
+    grud.check_nan = False
+    fused_time = time_function(lambda: grud(X, Mask, X, Delta, X_mean), num_repeats, device)
+    print('GRUD (batch_size=%d, num_features=%d, hidden_size=%d, seq_len=%d, %s): max abs diff %.2e'%(batch_size, num_features, hidden_size, seq_len, device, max_diff))
+    print('    stepwise: %.0f steps/sec, fused: %.0f steps/sec (%.1fx)'%(seq_len/reference_time, seq_len/fused_time, reference_time/fused_time))
+    return max_diff, seq_len/reference_time, seq_len/fused_time
+
+
+def rnn_predictor_loop_forward(classifier, x, return_full_seq=False):
+    '''RnnPredictor.forward as it was before the head was vectorized: the head is applied one sample at a time.'''
+    output, _ = classifier.rnn(x)
+    preds = torch.stack([classifier.linear(hidden_states).squeeze() for hidden_states in output])
+    if return_full_seq:
+        return preds
+    else:
+        return preds[:, -1]
+
+
+def benchmark_rnn_predictor(num_patients=1024, seq_len=96, encoding_size=10, hidden_size=8, num_repeats=20, device='cpu'):
+    '''Compares RnnPredictor.predict_trajectories to computing the risk trajectories with the per-sample head loop.'''
+    classifier = RnnPredictor(encoding_size=encoding_size, hidden_size=hidden_size).to(device).eval()
+    encodings = torch.randn(num_patients, seq_len, encoding_size, device=device)
+    with torch.no_grad():
+        reference_risks = torch.sigmoid(rnn_predictor_loop_forward(classifier, encodings, return_full_seq=True))
+        risks = classifier.predict_trajectories(encodings, batch_size=num_patients)
+        max_diff = max(float(torch.max(torch.abs(risks - reference_risks))), 
+                       float(torch.max(torch.abs(classifier(encodings) - rnn_predictor_loop_forward(classifier, encodings)))))
+
+    reference_time = time_function(lambda: torch.sigmoid(rnn_predictor_loop_forward(classifier, encodings, return_full_seq=True)), num_repeats, device)
+    vectorized_time = time_function(lambda: classifier.predict_trajectories(encodings, batch_size=num_patients), num_repeats, device)
+    print('RnnPredictor (num_patients=%d, seq_len=%d, %s): max abs diff %.2e'%(num_patients, seq_len, device, max_diff))
+    print('    per-sample head: %.0f patients/sec, predict_trajectories: %.0f patients/sec (%.1fx)'%(num_patients/reference_time, num_patients/vectorized_time, reference_time/vectorized_time))
+    return max_diff, num_patients/reference_time, num_patients/vectorized_time
+
+
+def gru_cell_loop_distribution_params(encoder, rnn_cell, x):
+    '''EncoderMultiSignal.get_distribution_params as it was with an nn.GRUCell: one call of rnn_cell per latent time step.'''
+    z = encoder.conv(x.to(encoder.device)).squeeze(2) # of shape (batch_size, latent_size, latent_seq_len)
+    encodings_arr = [rnn_cell(z[:, :, 0])]
+    for i in range(1, z.shape[-1]):
+        encodings_arr.append(rnn_cell(z[:, :, i], encodings_arr[-1]))
+    return torch.stack(encodings_arr)
+
+
+def benchmark_cnn_rnn(batch_size=64, num_features=8, seq_len=96, latent_size=32, encoding_size=16, num_repeats=20, device='cpu'):
+    '''Compares EncoderMultiSignal.get_distribution_params (one nn.GRU call) to the GRUCell time loop.'''
+    encoder = EncoderMultiSignal(latent_size=latent_size, encoding_size=encoding_size, in_channel=2).to(device).eval()
+    encoder.device = device
+    rnn_cell = torch.nn.GRUCell(latent_size, 2*encoding_size).to(device)
+    rnn_cell.load_state_dict({name[:-len('_l0')]: weights for name, weights in encoder.rnn.state_dict().items()})
+    x = torch.randn(batch_size, 2, num_features, seq_len, device=device)
+    with torch.no_grad():
+        max_diff = float(torch.max(torch.abs(encoder.get_distribution_params(x) - gru_cell_loop_distribution_params(encoder, rnn_cell, x))))
+
+    reference_time = time_function(lambda: gru_cell_loop_distribution_params(encoder, rnn_cell, x), num_repeats, device)
+    fused_time = time_function(lambda: encoder.get_distribution_params(x), num_repeats, device)
+    print('EncoderMultiSignal (batch_size=%d, seq_len=%d, %s): max abs diff %.2e'%(batch_size, seq_len, device, max_diff))
+    print('    GRUCell loop: %.0f windows/sec, nn.GRU: %.0f windows/sec (%.1fx)'%(batch_size/reference_time, batch_size/fused_time, reference_time/fused_time))
+    return max_diff, batch_size/reference_time, batch_size/fused_time
+
+
+def benchmark_tst(batch_size=64, num_features=18, seq_len=96, num_repeats=20, device='cpu'):
+    '''Compares TST.forward with the fused attention to TST.forward with the attention maps materialized (return_attn=True),
+    which takes the explicit softmax(q k^T) path.'''
+    tst = TST(num_features=num_features, encoding_size=10, seq_len=seq_len, device=device).eval()
+    x = torch.randn(batch_size, 2, num_features, seq_len, device=device)
+    x[:, 1] = (torch.rand(batch_size, num_features, seq_len, device=device) > 0.5).float()
+    with torch.no_grad():
+        max_diff = float(torch.max(torch.abs(tst(x) - tst(x, return_attn=True)[0])))
+
+    reference_time = time_function(lambda: tst(x, return_attn=True), num_repeats, device)
+    fused_time = time_function(lambda: tst(x), num_repeats, device)
+    print('TST (batch_size=%d, seq_len=%d, %s): max abs diff %.2e'%(batch_size, seq_len, device, max_diff))
+    print('    with attention maps: %.0f windows/sec, fused: %.0f windows/sec (%.1fx)'%(batch_size/reference_time, batch_size/fused_time, reference_time/fused_time))
+    return max_diff, batch_size/reference_time, batch_size/fused_time
+
+
+def benchmark_frozen_causal_cnn(num_samples=64, num_features=18, seq_len=1152, window_size=12, channels=32, depth=3, num_repeats=20, device='cpu'):
+    '''Compares CausalCNNEncoder.forward_seq (sliding_gap=1) before and after CausalCNNEncoder.freeze_for_inference.'''
+    encoder = CausalCNNEncoder(in_channels=2*num_features, channels=channels, depth=depth, reduced_size=channels, encoding_size=10,
+                               kernel_size=3, device=device, window_size=window_size).eval()
+    x = torch.randn(num_samples, 2, num_features, seq_len, device=device)
+    x[:, 1] = (torch.rand(num_samples, num_features, seq_len, device=device) > 0.5).float()
+    with torch.no_grad():
+        reference_encodings = encoder.forward_seq(x, sliding_gap=1)
+    reference_time = time_function(lambda: encoder.forward_seq(x, sliding_gap=1), num_repeats, device)
+
+    encoder.freeze_for_inference()
+    with torch.no_grad():
+        max_diff = float(torch.max(torch.abs(encoder.forward_seq(x, sliding_gap=1) - reference_encodings)))
+    frozen_time = time_function(lambda: encoder.forward_seq(x, sliding_gap=1), num_repeats, device)
+    num_windows = num_samples*(seq_len - window_size + 1)
+    print('CausalCNNEncoder (channels=%d, depth=%d, %d windows, %s): max abs diff %.2e'%(channels, depth, num_windows, device, max_diff))
+    print('    weight norm + chomp: %.0f windows/sec, frozen: %.0f windows/sec (%.1fx)'%(num_windows/reference_time, num_windows/frozen_time, reference_time/frozen_time))
+    return max_diff, num_windows/reference_time, num_windows/frozen_time
+
+
+def check_forward_seq_small_batches(num_features=4, window_size=12, device='cpu'):
+    '''Checks that CausalCNNEncoder.forward_seq gives the encodings of CausalCNNEncoder.network applied to each window when
+    1, 2 or 3 windows are encoded at once (through the single chunk path, the skip_imputed/packed path and chunks of a single
+    window). A batch of exactly 2 windows used to be mistaken for a single sample with maps. Returns the max abs diff.'''
+    encoder = CausalCNNEncoder(in_channels=2*num_features, channels=8, depth=1, reduced_size=8, encoding_size=6,
+                               kernel_size=3, device=device, window_size=window_size).eval()
+    max_diff = 0.
+    with torch.no_grad():
+        for num_observed in [1, 2, 3]:
+            # One left padded patient of 4 windows, only the last num_observed of which have observations
+            x = torch.randn(1, 2, num_features, 4*window_size, device=device)
+            x[:, 1] = 1
+            x[:, 1, :, :(4 - num_observed)*window_size] = 0
+            windows = torch.movedim(x.unfold(-1, window_size, window_size), -2, 1).reshape(4, 2*num_features, window_size)
+            reference_encodings = encoder.network(windows)
+            outputs = [(encoder.forward_seq(x), reference_encodings),
+                       (encoder.forward_seq(x[:, :, :, -num_observed*window_size:]), reference_encodings[4-num_observed:]),
+                       (encoder.forward_seq(x, skip_imputed=True, packed=True), reference_encodings[4-num_observed:]),
+                       (encoder.forward_seq(x, skip_imputed=True, memory_budget=1)[0, 4-num_observed:], reference_encodings[4-num_observed:])]
+            for encodings, reference in outputs:
+                max_diff = max(max_diff, float(torch.max(torch.abs(encodings.reshape(reference.shape) - reference))))
+    if max_diff > 1e-5:
+        raise ValueError('forward_seq differs from the encodings of each window by %.2e'%max_diff)
+    print('CausalCNNEncoder.forward_seq with 1, 2 and 3 windows per batch: max abs diff %.2e'%max_diff)
+    return max_diff
+
+
+def gather_forward_seq(encoder, x, sliding_gap=None, return_pruned=True, skip_imputed=False):
+    '''The previous CausalCNNEncoder.forward_seq: the windows of x (of shape (num_samples, 2, num_features, seq_len)) are
+    gathered with index_select (a copy of x per overlapping window with a sliding_gap), stacked with torch.split, and
+    encoded in a single call. With skip_imputed, the windows whose last time step is fully imputed are left as zeros.'''
+    if sliding_gap:
+        inds = torch.cat([torch.arange(ind, ind+encoder.window_size) for ind in range(0, x.shape[-1]-encoder.window_size+1, sliding_gap)]).to(x.device)
+        x = torch.index_select(input=x, dim=3, index=inds)
+    num_samples, num_channels, num_features, seq_len = x.shape
+    encoding_mask = torch.all(x[:, 1, :, encoder.window_size-1::encoder.window_size]==0, dim=1).reshape(-1,) # True for the fully imputed windows
+    x = x.reshape(num_samples, num_channels*num_features, seq_len).permute(1, 0, 2).reshape(num_channels*num_features, -1)
+    x = torch.stack(torch.split(x, encoder.window_size, dim=1)) # of shape (num_samples*num_windows, num_channels*num_features, window_size)
+    encoding_size = encoder.pruned_encoding_size if return_pruned else encoder.encoding_size
+    encodings = torch.zeros(len(x), encoding_size, device=x.device)
+    kept_windows = torch.where(~encoding_mask)[0] if skip_imputed else torch.arange(len(x), device=x.device)
+    if len(kept_windows) > 0:
+        encodings[kept_windows] = encoder._encode_windows(x[kept_windows], return_pruned=return_pruned)
+    return encodings.reshape(num_samples, seq_len//encoder.window_size, encoding_size)
+
+
+def benchmark_forward_seq_chunking(num_samples=64, num_features=18, seq_len=1152, window_size=12, channels=32, depth=3, memory_budget=2**24,
+                                   num_repeats=5, device='cpu'):
+    '''Compares CausalCNNEncoder.forward_seq (windows taken from an unfold view and encoded in chunks of at most
+    memory_budget bytes) to gather_forward_seq, with overlapping (sliding_gap=1) and non overlapping windows, with and without
+    skip_imputed. The first quarter of each sample is left padding (fully imputed), like the HiRID patients. Returns the max abs diff.'''
+    encoder = CausalCNNEncoder(in_channels=2*num_features, channels=channels, depth=depth, reduced_size=channels, encoding_size=10,
+                               kernel_size=3, device=device, window_size=window_size).eval()
+    x = torch.randn(num_samples, 2, num_features, seq_len, device=device)
+    x[:, 1] = (torch.rand(num_samples, num_features, seq_len, device=device) > 0.5).float()
+    x[:, 1, :, :seq_len//4] = 0
+    windows_per_chunk = encoder._windows_per_chunk(2*num_features, x.element_size(), memory_budget)
+    max_diff = 0.
+    for sliding_gap in [None, 1]:
+        for skip_imputed in [False, True]:
+            with torch.no_grad():
+                encodings = encoder.forward_seq(x, sliding_gap=sliding_gap, skip_imputed=skip_imputed, memory_budget=memory_budget)
+                diff = float(torch.max(torch.abs(encodings - gather_forward_seq(encoder, x, sliding_gap=sliding_gap, skip_imputed=skip_imputed))))
+            if diff > 1e-5:
+                raise ValueError('forward_seq (sliding_gap=%s, skip_imputed=%s) differs from the gather implementation by %.2e'%(sliding_gap, skip_imputed, diff))
+            max_diff = max(max_diff, diff)
+            if device == 'cuda':
+                torch.cuda.reset_peak_memory_stats()
+            gather_time = time_function(lambda: gather_forward_seq(encoder, x, sliding_gap=sliding_gap, skip_imputed=skip_imputed), num_repeats, device)
+            gather_memory = torch.cuda.max_memory_allocated()/2**20 if device == 'cuda' else float('nan')
+            if device == 'cuda':
+                torch.cuda.reset_peak_memory_stats()
+            chunked_time = time_function(lambda: encoder.forward_seq(x, sliding_gap=sliding_gap, skip_imputed=skip_imputed, memory_budget=memory_budget), num_repeats, device)
+            chunked_memory = torch.cuda.max_memory_allocated()/2**20 if device == 'cuda' else float('nan')
+            num_windows = num_samples*((seq_len - window_size)//(sliding_gap if sliding_gap else window_size) + 1)
+            print('forward_seq (sliding_gap=%s, skip_imputed=%s, %d windows, %d chunks, %s): max abs diff %.2e'%(sliding_gap, skip_imputed, num_windows,
+                  math.ceil(num_windows/windows_per_chunk), device, diff))
+            print('    gather: %.0f windows/sec (peak %.0f MB), chunked unfold: %.0f windows/sec (peak %.0f MB) (%.1fx)'%(num_windows/gather_time, gather_memory,
+                  num_windows/chunked_time, chunked_memory, gather_time/chunked_time))
+    return max_diff
+
+
+def benchmark_shared_trunk(num_samples=64, num_features=18, seq_len=1152, window_size=12, channels=32, depth=3, sliding_gap=1, num_repeats=5, device='cpu'):
+    '''Compares CausalCNNEncoder.forward_seq_shared (one pass of the causal CNN over each series, with and without exact_head)
+    to forward_seq with the same sliding_gap. The exact_head encodings must match forward_seq, the approximation error of the
+    shared trunk alone is reported with CausalCNNEncoder.shared_trunk_error. Returns (exact_head max abs diff, shared_trunk_error).'''
+    encoder = CausalCNNEncoder(in_channels=2*num_features, channels=channels, depth=depth, reduced_size=channels, encoding_size=10,
+                               kernel_size=3, device=device, window_size=window_size).eval()
+    x = torch.randn(num_samples, 2, num_features, seq_len, device=device)
+    x[:, 1] = (torch.rand(num_samples, num_features, seq_len, device=device) > 0.5).float()
+    with torch.no_grad():
+        max_diff = float(torch.max(torch.abs(encoder.forward_seq_shared(x, sliding_gap=sliding_gap, exact_head=True) - encoder.forward_seq(x, sliding_gap=sliding_gap))))
+    if max_diff > 1e-5:
+        raise ValueError('forward_seq_shared with exact_head differs from forward_seq by %.2e'%max_diff)
+    error = encoder.shared_trunk_error(x, sliding_gap=sliding_gap)
+
+    reference_time = time_function(lambda: encoder.forward_seq(x, sliding_gap=sliding_gap), num_repeats, device)
+    exact_head_time = time_function(lambda: encoder.forward_seq_shared(x, sliding_gap=sliding_gap, exact_head=True), num_repeats, device)
+    shared_time = time_function(lambda: encoder.forward_seq_shared(x, sliding_gap=sliding_gap), num_repeats, device)
+    num_windows = num_samples*((seq_len - window_size)//sliding_gap + 1)
+    print('CausalCNNEncoder shared trunk (channels=%d, depth=%d, receptive field %d, window_size %d, %d windows, %s): exact_head max abs diff %.2e'%(
+          channels, depth, encoder.receptive_field(), window_size, num_windows, device, max_diff))
+    print('    shared trunk without exact_head: max abs diff %.2e, mean abs diff %.2e, max rel diff %.2e, %.0f%% of the encodings affected'%(
+          error['max_abs_diff'], error['mean_abs_diff'], error['max_rel_diff'], 100*error['fraction_affected']))
+    print('    forward_seq: %.0f windows/sec, shared with exact_head: %.0f windows/sec (%.1fx), shared: %.0f windows/sec (%.1fx)'%(num_windows/reference_time,
+          num_windows/exact_head_time, reference_time/exact_head_time, num_windows/shared_time, reference_time/shared_time))
+    return max_diff, error
+
+
+def check_risk_trajectories_small_batches(num_samples=66, num_features=4, window_size=12, batch_size=64, device='cpu'):
+    '''Checks compute_risk_trajectories against encoding and classifying one patient at a time, for samples of a single
+    window (like the first 12 hours of apache_group_prediction.py) where the last batch has num_samples % batch_size windows.
+    The defaults leave exactly 2 windows in the last batch. Returns the max abs diff of the risks.'''
+    encoder = CausalCNNEncoder(in_channels=2*num_features, channels=8, depth=1, reduced_size=8, encoding_size=6,
+                               kernel_size=3, device=device, window_size=window_size).eval()
+    classifier = RnnPredictor(encoding_size=encoder.pruned_encoding_size, hidden_size=8).to(device).eval()
+    x = torch.randn(num_samples, 2, num_features, window_size, device=device)
+    x[:, 1] = (torch.rand(num_samples, num_features, window_size, device=device) > 0.5).float()
+    with torch.no_grad():
+        risks, _ = compute_risk_trajectories(x, encoder, classifier, batch_size=batch_size, device=device)
+        reference_risks = torch.stack([classifier.predict_trajectories(encoder.forward_seq(x[i:i+1])) for i in range(num_samples)]).reshape(risks.shape)
+    max_diff = float(torch.max(torch.abs(risks - reference_risks.cpu())))
+    if max_diff > 1e-5:
+        raise ValueError('compute_risk_trajectories differs from the per patient risks by %.2e'%max_diff)
+    print('compute_risk_trajectories with %d windows in the last batch: max abs diff %.2e'%(num_samples % batch_size, max_diff))
+    return max_diff
+
+
+def benchmark_fold_ensemble(num_samples=256, num_features=18, seq_len=1152, window_size=12, n_cross_val_encoder=3, n_cross_val_classification=2,
+                            channels=32, depth=3, reduced_size=None, kernel_size=3, sliding_gap=None, num_repeats=20, device='cpu'):
+    '''Compares running the fold models of a CV run one at a time to running them in a FoldEnsemble, which shares the windowing
+    of the input between the encoders. With a sliding_gap, the risk trajectories (return_full_seq) are compared.'''
+    encoders, classifiers = [], []
+    for encoder_cv in range(n_cross_val_encoder):
+        encoder = CausalCNNEncoder(in_channels=2*num_features, channels=channels, depth=depth, reduced_size=reduced_size if reduced_size else channels,
+                                   encoding_size=10, kernel_size=kernel_size, device=device, window_size=window_size)
+        encoder.freeze_for_inference()
+        for classification_cv in range(n_cross_val_classification):
+            encoders.append(encoder)
+            classifiers.append(RnnPredictor(encoding_size=encoder.pruned_encoding_size, hidden_size=8).to(device).eval())
+    x = torch.randn(num_samples, 2, num_features, seq_len, device=device)
+    x[:, 1] = (torch.rand(num_samples, num_features, seq_len, device=device) > 0.5).float()
+    return_full_seq = sliding_gap is not None
+
+    def fold_by_fold():
+        encodings = {}
+        predictions = []
+        for encoder, classifier in zip(encoders, classifiers):
+            if encoder not in encodings:
+                encodings[encoder] = encoder.forward_seq(x, sliding_gap=sliding_gap)
+            predictions.append(classifier(encodings[encoder], return_full_seq=return_full_seq))
+        return torch.stack(predictions)
+    ensemble = FoldEnsemble(encoders, classifiers)
+    with torch.no_grad():
+        max_diff = float(torch.max(torch.abs(ensemble(x, return_full_seq=return_full_seq, sliding_gap=sliding_gap)[..., 0] - fold_by_fold())))
+    fold_by_fold_time = time_function(fold_by_fold, num_repeats, device)
+    ensemble_time = time_function(lambda: ensemble(x, return_full_seq=return_full_seq, sliding_gap=sliding_gap), num_repeats, device)
+    print('%d folds (%d encoders, channels=%d, depth=%d), %d samples of length %d, sliding_gap %s (%s): max abs diff %.2e'%(
+        len(classifiers), n_cross_val_encoder, channels, depth, num_samples, seq_len, sliding_gap, device, max_diff))
+    print('    fold by fold: %.0f samples/sec, FoldEnsemble: %.0f samples/sec (%.2fx)'%(num_samples/fold_by_fold_time, num_samples/ensemble_time, fold_by_fold_time/ensemble_time))
+    return max_diff, num_samples/fold_by_fold_time, num_samples/ensemble_time
+
+
+def compare_wf_heads(x, y, n_classes, heads=('fc', 'lowrank', 'conv'), encoding_size=64, n_epochs=5, lr=1e-3, batch_size=32, num_repeats=5, device='cpu'):
+    '''For each WFEncoder head, reports the number of parameters, the encoding throughput, and the accuracy on a held out 40%
+    of (x, y) (x of shape (num_windows, 2, window_size)) of the model trained end to end for n_epochs.'''
+    n_train = int(0.6*len(x))
+    train_loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(x[:n_train], y[:n_train]), batch_size=batch_size, shuffle=True)
+    report = {}
+    for head in heads:
+        torch.manual_seed(0)
+        model = WFEncoder(encoding_size=encoding_size, classify=True, n_classes=n_classes, head=head).to(device)
+        num_params = sum(p.numel() for p in model.parameters() if p not in set(model.classifier.parameters()))
+        optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+        start = time.perf_counter()
+        model.train()
+        for epoch in range(n_epochs):
+            for x_batch, y_batch in train_loader:
+                optimizer.zero_grad()
+                loss = torch.nn.functional.cross_entropy(model(x_batch.to(device)), y_batch.long().to(device))
+                loss.backward()
+                optimizer.step()
+        train_time = time.perf_counter() - start
+
+        model.eval()
+        with torch.no_grad():
+            predictions = torch.cat([torch.argmax(model(x_batch.to(device)), -1).cpu() for x_batch in torch.split(x[n_train:], batch_size)])
+        accuracy = float(torch.mean((predictions == y[n_train:].long()).float()))
+        model.classify = False
+        encoding_time = time_function(lambda: model(x[:batch_size].to(device)), num_repeats, device)
+        report[head] = {'num_params': num_params, 'windows_per_sec': batch_size/encoding_time, 'train_sec_per_epoch': train_time/n_epochs, 'accuracy': accuracy}
+        del model, optimizer
+
+    print('WFEncoder heads (window_size=%d, %d train / %d held out windows, %d epochs, %s):'%(x.shape[-1], n_train, len(x)-n_train, n_epochs, device))
+    print('    %-8s %14s %16s %16s %10s'%('head', 'parameters', 'windows/sec', 'sec/epoch', 'accuracy'))
+    for head, row in report.items():
+        print('    %-8s %14d %16.0f %16.1f %10.3f'%(head, row['num_params'], row['windows_per_sec'], row['train_sec_per_epoch'], row['accuracy']))
+    return report
+
+
+def synthetic_waveform_windows(num_windows=256, window_size=2500, n_classes=4):
+    '''Two channel windows of noisy sines whose frequency depends on the class. Used by compare_wf_heads when the waveform
+    data isn't available.'''
+    y = torch.randint(0, n_classes, (num_windows,))
+    t = torch.arange(window_size).float()/window_size
+    x = torch.sin(2*math.pi*(5 + 5*y[:, None, None].float())*t + torch.rand(num_windows, 2, 1)*2*math.pi)
+    return x + 0.5*torch.randn(num_windows, 2, window_size), y
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro benchmarks of the fast model implementations')
+    parser.add_argument('--benchmark', type=str, default='all', choices=['all', 'grud', 'rnn_predictor', 'cnn_rnn', 'tst', 'frozen_causal_cnn', 'forward_seq_chunking', 'shared_trunk', 'wf_heads', 'fold_ensemble'])
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--seq_len', type=int, default=12)
+    parser.add_argument('--num_repeats', type=int, default=20)
+    parser.add_argument('--wf_data_path', type=str, default=None, help='Processed waveform data for the wf_heads comparison. Synthetic windows are used if not given.')
+    parser.add_argument('--wf_heads', type=str, nargs='+', default=['fc', 'lowrank', 'conv'])
+    parser.add_argument('--wf_epochs', type=int, default=5)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if args.benchmark in ['all', 'grud']:
+        benchmark_grud(batch_size=args.batch_size, seq_len=args.seq_len, num_repeats=args.num_repeats, device=device)
+    if args.benchmark in ['all', 'rnn_predictor']:
+        benchmark_rnn_predictor(num_patients=args.batch_size*16, seq_len=args.seq_len*8, num_repeats=args.num_repeats, device=device)
+    if args.benchmark in ['all', 'cnn_rnn']:
+        benchmark_cnn_rnn(batch_size=args.batch_size, seq_len=args.seq_len*8, num_repeats=args.num_repeats, device=device)
+    if args.benchmark in ['all', 'tst']:
+        benchmark_tst(batch_size=args.batch_size, seq_len=args.seq_len*8, num_repeats=args.num_repeats, device=device)
+    if args.benchmark in ['all', 'frozen_causal_cnn']:
+        check_forward_seq_small_batches(device=device)
+        check_risk_trajectories_small_batches(device=device)
+        benchmark_frozen_causal_cnn(num_samples=args.batch_size, seq_len=args.seq_len*96, num_repeats=args.num_repeats, device=device)
+    if args.benchmark in ['all', 'forward_seq_chunking']:
+        benchmark_forward_seq_chunking(num_samples=args.batch_size, seq_len=args.seq_len*96, num_repeats=args.num_repeats, device=device)
+    if args.benchmark in ['all', 'shared_trunk']:
+        benchmark_shared_trunk(num_samples=args.batch_size, seq_len=args.seq_len*96, num_repeats=args.num_repeats, device=device)
+    if args.benchmark in ['all', 'fold_ensemble']:
+        # Encoder of the HiRID experiments, and a wider one
+        for channels, depth, reduced_size, kernel_size in [(4, 1, 2, 2), (32, 3, 32, 3)]:
+            benchmark_fold_ensemble(num_samples=args.batch_size*4, seq_len=args.seq_len*96, channels=channels, depth=depth, reduced_size=reduced_size,
+                                    kernel_size=kernel_size, num_repeats=args.num_repeats, device=device)
+            benchmark_fold_ensemble(num_samples=args.batch_size, seq_len=args.seq_len*24, channels=channels, depth=depth, reduced_size=reduced_size,
+                                    kernel_size=kernel_size, sliding_gap=1, num_repeats=args.num_repeats, device=device)
+    if args.benchmark in ['all', 'wf_heads']:
+        if args.wf_data_path is not None:
+            from tnc.evaluations import load_waveform_windows
+            x, y = load_waveform_windows(args.wf_data_path, window_size=2500)
+        else:
+            x, y = synthetic_waveform_windows()
+        compare_wf_heads(x, y, n_classes=int(y.max())+1, heads=args.wf_heads, n_epochs=args.wf_epochs, num_repeats=args.num_repeats, device=device)
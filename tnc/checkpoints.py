@@ -0,0 +1,18 @@
+"""
+Loading of the checkpoints saved by the training, distillation and quantization scripts.
+
+Only depends on torch, so that the inference code (streaming, risk_server) can load checkpoints without importing the
+training or plotting dependencies.
+"""
+
+import inspect
+import torch
+
+
+def load_checkpoint(path, map_location='cpu'):
+    '''torch.load for the checkpoints of this repo. Besides state dicts, they hold hyper parameter dictionaries, numpy
+    values and, for quantized models, packed weights that aren't plain tensors, so they can't be loaded with weights_only,
+    which newer versions of torch use by default.'''
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    return torch.load(path, map_location=map_location)
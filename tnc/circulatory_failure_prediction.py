@@ -2,6 +2,8 @@ import torch
 import numpy as np
 from tnc.utils import plot_pca_trajectory_binned, plot_tsne_trajectory_binned, dim_reduction, plot_heatmap_subset_signals_with_risk, plot_pca_trajectory, detect_incr_loss
 from tnc.models import CausalCNNEncoder, RnnPredictor
+from tnc.trajectories import compute_risk_trajectories
+from tnc.tasks import EncodingSource, MulticlassHead, Task, TaskEngine, task_epoch_run
 import os
 from sklearn.metrics import roc_auc_score, precision_recall_curve, auc, classification_report
 import matplotlib.pyplot as plt
@@ -60,59 +62,57 @@ def train_linear_classifier(X_train, y_train, X_validation, y_validation, X_TEST
     Trains a classifier to predict positive events in samples. 
     X_train is of shape (num_train_samples, 2, num_features, seq_len)
     y_train is of shape (num_train_samples, seq_len)
-
+    With a frozen encoder (all the baseline_types but 'raw' and 'e2e'), the samples are encoded once (see
+    tnc.tasks.EncodingSource) for the 3 runs, and each classifier is trained by a TaskEngine on the cached encodings.
     '''
+    frozen_encoder = encoder is not None and baseline_type != 'e2e'
+    if frozen_encoder:
+        encoder.eval()
+        source = EncodingSource(encoder, batch_size=batch_size, device=device)
+        source.add('train', X_train)
+        source.add('TEST', X_TEST)
+        if X_validation is not X_train:
+            source.add('validation', X_validation)
+        splits = {'train': ('train', y_train.cpu(), None),
+                  'validation': ('train' if X_validation is X_train else 'validation', y_validation.cpu(), None),
+                  'TEST': ('TEST', y_TEST.cpu(), None)}
     cv_aurocs = []
     cv_auprcs = []
     for cv in range(3):
         print("Training Linear Classifier", flush=True)
-        if encoder is None:
-            (unique, counts) = np.unique(y_train.detach().cpu(), return_counts=True)
-            classifier = RnnPredictor(encoding_size=18, hidden_size=8, n_classes=len(unique)).to(device)
-        else:
-            (unique, counts) = np.unique(y_train.detach().cpu(), return_counts=True)
-            classifier = RnnPredictor(encoding_size=classifier_input_size, hidden_size=8, n_classes=len(unique)).to(device)
-            encoder.eval()
-        
+        (unique, counts) = np.unique(y_train.detach().cpu(), return_counts=True)
         print('X_train shape: ', X_train.shape)
         print('batch_size: ', batch_size)
-        train_dataset = torch.utils.data.TensorDataset(X_train, y_train)
-        train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-        validation_dataset = torch.utils.data.TensorDataset(X_validation, y_validation)
-        validation_data_loader = torch.utils.data.DataLoader(validation_dataset, batch_size=batch_size, shuffle=True)
-        TEST_dataset = torch.utils.data.TensorDataset(X_TEST, y_TEST)
-        TEST_data_loader = torch.utils.data.DataLoader(TEST_dataset, batch_size=batch_size, shuffle=True)
-        
-        if baseline_type == 'e2e':
-            params = list(classifier.parameters()) + list(encoder.parameters())
-        else:
-            params = list(classifier.parameters())
         lr = .001
         weight_decay = 0.0001
         print('Learning Rate for classifier training: ', lr)
         print('Weight Decay for classifier training: ', weight_decay)
-        optimizer = torch.optim.Adam(params, lr=lr, weight_decay=weight_decay)
+        if frozen_encoder:
+            engine = TaskEngine(source, [Task('circulatory', MulticlassHead(len(unique), class_weights), splits)], hidden_size=8,
+                                lr=lr, weight_decay=weight_decay, batch_size=batch_size, device=device)
+            classifier = engine.classifiers['circulatory']
+            epoch_run = lambda split, train=False: task_epoch_run(engine, 'circulatory', split, train=train)
+        else:
+            classifier = RnnPredictor(encoding_size=classifier_input_size, hidden_size=8, n_classes=len(unique)).to(device)
+            data_loaders = {'train': torch.utils.data.DataLoader(torch.utils.data.TensorDataset(X_train, y_train), batch_size=batch_size, shuffle=True),
+                            'validation': torch.utils.data.DataLoader(torch.utils.data.TensorDataset(X_validation, y_validation), batch_size=batch_size, shuffle=True),
+                            'TEST': torch.utils.data.DataLoader(torch.utils.data.TensorDataset(X_TEST, y_TEST), batch_size=batch_size, shuffle=True)}
+            if baseline_type == 'e2e':
+                params = list(classifier.parameters()) + list(encoder.parameters())
+            else:
+                params = list(classifier.parameters())
+            optimizer = torch.optim.Adam(params, lr=lr, weight_decay=weight_decay)
+            epoch_run = lambda split, train=False: linear_classifier_epoch_run(dataset=data_loaders[split], train=train,
+                                                        classifier=classifier, class_weights=class_weights,
+                                                        optimizer=optimizer, data_type=data_type, window_size=window_size, encoder=encoder, encoding_size=classifier_input_size)
         train_losses = []
         valid_losses = []
         
         for epoch in range(1, 501):
-            # linear_classifier_epoch_run(dataset, train, classifier, optimizer, data_type, window_size, encoder, encoding_size):
-            epoch_train_predictions, epoch_train_losses, epoch_train_labels = linear_classifier_epoch_run(dataset=train_data_loader, train=True,
-                                                        classifier=classifier, class_weights=class_weights,
-                                                        optimizer=optimizer, data_type=data_type, window_size=window_size, encoder=encoder, encoding_size=classifier_input_size)
-
-            
+            epoch_train_predictions, epoch_train_losses, epoch_train_labels = epoch_run('train', train=True)
             classifier.eval()
-            epoch_validation_predictions, epoch_validation_losses, epoch_validation_labels = linear_classifier_epoch_run(dataset=validation_data_loader, train=False,
-                                                        classifier=classifier, class_weights=class_weights,
-                                                        optimizer=optimizer, data_type=data_type, window_size=window_size, encoder=encoder, encoding_size=classifier_input_size)
-
-            
-            
-
-            epoch_TEST_predictions, epoch_TEST_losses, epoch_TEST_labels = linear_classifier_epoch_run(dataset=TEST_data_loader, train=False,
-                                                        classifier=classifier, class_weights=class_weights,
-                                                        optimizer=optimizer, data_type=data_type, window_size=window_size, encoder=encoder, encoding_size=classifier_input_size)
+            epoch_validation_predictions, epoch_validation_losses, epoch_validation_labels = epoch_run('validation')
+            epoch_TEST_predictions, epoch_TEST_losses, epoch_TEST_labels = epoch_run('TEST')
 
             
             # TRAIN 
@@ -412,21 +412,21 @@ if __name__ == '__main__':
                 inds.append(ind)
         
         print('inds: ', inds)
+        # Risk of circulatory failure (softmax score of the positive class) at each window of all the plotted samples
+        risk_trajectories, encoding_trajectories = compute_risk_trajectories(TEST_circulatory_data_maps[inds], encoder, classifier, device=device)
 
-        for ind in inds:
+        for plot_index, ind in enumerate(inds):
             sample = TEST_circulatory_data_maps[ind]
             sample_mask=[1, 0, 0, 0, 0, 1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-            encodings = encoder.forward_seq(sample.unsqueeze(0).to(device)).squeeze()
-            
-            
-            risk_scores = torch.nn.Softmax(dim=1)(classifier.forward(encodings.unsqueeze(0), return_full_seq=True).squeeze()).detach().cpu()[:, 1] # Score for positive class, i.e. risk of circ failure
+            encodings = encoding_trajectories[plot_index]
+            risk_scores = risk_trajectories[plot_index]
             
-            plot_heatmap_subset_signals_with_risk(sample=sample.cpu(), sample_mask=sample_mask, encodings=encodings.detach().cpu(),
+            plot_heatmap_subset_signals_with_risk(sample=sample.cpu(), sample_mask=sample_mask, encodings=encodings,
             risk_scores=risk_scores, path='./DONTCOMMITplots/HiRID_circulatory_classification', hm_file_name='risk_heatmap%d.pdf'%ind,
             risk_plot_title='Risk of Circulatory Failure', signal_list=signal_list, length_of_hour=12, 
             risk_x_axis_label='Hours until circulatory failure', truncate_amt=truncate_amt)
             
-            plot_pca_trajectory(encodings=encodings.detach().cpu(), path='./DONTCOMMITplots/HiRID_circulatory_classification', pca_file_name='trajectory%d.pdf'%ind, pos_sample_name='circulatory failure')
+            plot_pca_trajectory(encodings=encodings, path='./DONTCOMMITplots/HiRID_circulatory_classification', pca_file_name='trajectory%d.pdf'%ind, pos_sample_name='circulatory failure')
 
 
 
@@ -0,0 +1,238 @@
+"""
+Distillation of a trained encoder (the teacher, e.g. a deep CausalCNNEncoder or a CNN_Transformer_Encoder from a hyper
+parameter sweep) into a small CausalCNNEncoder (the student) that is fast enough for bedside serving.
+
+The student is trained to regress the teacher's (pruned) encodings of windows sampled from train_encoder_data_maps, so it
+lives in the teacher's encoding space, and the classifiers trained on the teacher's encodings can be used on it as they are.
+
+Running this file distills the encoder of a checkpoint saved by tnc.py, reports the encoding agreement on held out windows,
+the TEST AUROC/AUPRC of a classifier checkpoint on the teacher and student encodings, and the encoding speedup, and saves
+the student in the same checkpoint format as tnc.py, with the teacher's hyper parameters (so that it can be loaded as any
+other CausalCNNEncoder checkpoint, including by tnc.py --checkpoint_file).
+"""
+
+import os
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score, precision_recall_curve, auc
+from tnc.models import CausalCNNEncoder, CNN_Transformer_Encoder, RnnPredictor
+from tnc.checkpoints import load_checkpoint
+
+
+def load_teacher(encoder_checkpoint, example_windows, device='cpu'):
+    '''Loads the encoder of a checkpoint saved by tnc.py (a CausalCNNEncoder or a CNN_Transformer_Encoder). example_windows
+    (of shape (num_windows, 2, num_features, window_size)) are needed to build the transformer of a CNN_Transformer_Encoder,
+    which is only instantiated on its first forward pass. Returns the encoder in eval mode, and the checkpoint.'''
+    checkpoint = load_checkpoint(encoder_checkpoint, map_location=device)
+    encoder_type = checkpoint.get('encoder_type', 'CausalCNNEncoder')
+    if encoder_type == 'CausalCNNEncoder':
+        teacher = CausalCNNEncoder(**dict(checkpoint['encoder_hyper_params'], device=device))
+    elif encoder_type == 'CNN_Transformer':
+        teacher = CNN_Transformer_Encoder(**checkpoint['encoder_hyper_params']).to(device)
+        teacher.device = device
+        with torch.no_grad():
+            teacher.get_distribution_params(example_windows[0:1].to(device))
+        teacher.transformer.to(device)
+    else:
+        raise ValueError('Distillation of %s encoders is not supported'%encoder_type)
+    teacher.load_state_dict(checkpoint['encoder_state_dict'])
+    teacher.pruning_mask = checkpoint['pruning_mask'].cpu()
+    teacher.pruned_encoding_size = int(torch.sum(teacher.pruning_mask))
+    return teacher.eval(), checkpoint
+
+
+def encode_windows(encoder, windows):
+    '''Deterministic (pruned) encodings of windows of shape (num_windows, 2, num_features, window_size). The
+    CNN_Transformer_Encoder returns the mean of its posterior rather than a sample.'''
+    if isinstance(encoder, CNN_Transformer_Encoder):
+        encodings = encoder.mus(encoder.get_distribution_params(windows.to(encoder.device)))
+    else:
+        encodings = encoder(windows, return_pruned=False)
+    return encodings[:, encoder.pruning_mask.to(encodings.device)]
+
+
+def encode_sequences(encoder, data_maps, window_size, batch_size=64):
+    '''Encodings of the non overlapping windows of data_maps (of shape (num_samples, 2, num_features, seq_len)), of shape
+    (num_samples, seq_len/window_size, pruned_encoding_size), as CausalCNNEncoder.forward_seq computes them.'''
+    encodings = []
+    with torch.no_grad():
+        for batch in torch.split(data_maps, batch_size):
+            if isinstance(encoder, CausalCNNEncoder):
+                encodings.append(encoder.forward_seq(batch).cpu())
+            else:
+                num_samples, num_windows = len(batch), batch.shape[-1]//window_size
+                windows = batch.reshape(num_samples, 2, batch.shape[2], num_windows, window_size).permute(0, 3, 1, 2, 4)
+                encodings.append(encode_windows(encoder, windows.reshape(-1, 2, batch.shape[2], window_size)).reshape(num_samples, num_windows, -1).cpu())
+    return torch.cat(encodings)
+
+
+def sample_windows(data_maps, window_size, num_windows, seed=0):
+    '''Samples num_windows windows of shape (2, num_features, window_size) from data_maps (a numpy array, possibly memory
+    mapped, of shape (num_samples, 2, num_features, seq_len)). Windows whose last time step was fully imputed (e.g. the left
+    padding of HiRID patients) are never sampled, the same way CausalCNNEncoder.forward_seq(skip_imputed=True) skips them.'''
+    random_state = np.random.RandomState(seed)
+    num_samples, seq_len = data_maps.shape[0], data_maps.shape[-1]
+    windows = []
+    num_sampled = 0
+    while num_sampled < num_windows:
+        sample_inds = np.sort(random_state.choice(num_samples, min(num_samples, num_windows - num_sampled), replace=False))
+        samples = np.asarray(data_maps[sample_inds])
+        starts = random_state.randint(0, seq_len - window_size + 1, size=len(sample_inds))
+        batch = np.stack([sample[:, :, start:start+window_size] for sample, start in zip(samples, starts)])
+        batch = batch[np.any(batch[:, 1, :, -1] != 0, axis=1)] # Keeps windows with at least one observation on their last time step
+        windows.append(torch.from_numpy(batch).float())
+        num_sampled += len(batch)
+    return torch.cat(windows)[:num_windows]
+
+
+def encoding_agreement(teacher_encodings, student_encodings):
+    '''MSE, R^2 (the fraction of the total variance of the teacher's encodings explained by the student) and mean cosine
+    similarity between the student's and the teacher's encodings, both of shape (num_windows, encoding_size).'''
+    mse = torch.mean((student_encodings - teacher_encodings)**2, dim=0)
+    variance = torch.var(teacher_encodings, dim=0, unbiased=False)
+    return {'mse': float(torch.mean(mse)), 'r2': float(1 - torch.sum(mse)/torch.clamp(torch.sum(variance), min=1e-12)),
+            'cosine_similarity': float(torch.mean(torch.nn.functional.cosine_similarity(student_encodings, teacher_encodings, dim=1)))}
+
+
+def distill_encoder(teacher, student, windows, n_epochs=20, batch_size=256, lr=1e-3, validation_fraction=0.1, device='cpu'):
+    '''Trains student (a CausalCNNEncoder whose encoding_size is teacher.pruned_encoding_size) to regress the teacher's
+    encodings of windows (of shape (num_windows, 2, num_features, window_size)), with an MSE loss. The student with the lowest
+    validation loss (on the last validation_fraction of the windows) is kept. Returns it, and the agreement on the validation
+    windows (see encoding_agreement).'''
+    teacher_encodings = []
+    with torch.no_grad():
+        for batch in torch.split(windows, batch_size):
+            teacher_encodings.append(encode_windows(teacher, batch.to(device)).cpu())
+    teacher_encodings = torch.cat(teacher_encodings)
+
+    n_train = int((1 - validation_fraction)*len(windows))
+    train_loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(windows[:n_train], teacher_encodings[:n_train]), batch_size=batch_size, shuffle=True)
+    validation_windows, validation_encodings = windows[n_train:], teacher_encodings[n_train:]
+
+    student = student.to(device)
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr)
+    best_loss, best_state = float('inf'), None
+    for epoch in range(n_epochs):
+        student.train()
+        epoch_loss = 0
+        for window_batch, encoding_batch in train_loader:
+            optimizer.zero_grad()
+            loss = torch.nn.functional.mse_loss(student(window_batch.to(device), return_pruned=False), encoding_batch.to(device))
+            loss.backward()
+            optimizer.step()
+            epoch_loss += loss.item()*len(window_batch)
+
+        student.eval()
+        with torch.no_grad():
+            student_encodings = torch.cat([student(batch.to(device), return_pruned=False).cpu() for batch in torch.split(validation_windows, batch_size)])
+        validation_loss = float(torch.mean((student_encodings - validation_encodings)**2))
+        print('Epoch %d Distillation loss =====> Training: %.5f \t Validation: %.5f'%(epoch, epoch_loss/n_train, validation_loss))
+        if validation_loss < best_loss:
+            best_loss, best_state = validation_loss, copy.deepcopy(student.state_dict())
+
+    student.load_state_dict(best_state)
+    student.eval()
+    with torch.no_grad():
+        student_encodings = torch.cat([student(batch.to(device), return_pruned=False).cpu() for batch in torch.split(validation_windows, batch_size)])
+    return student, encoding_agreement(validation_encodings, student_encodings)
+
+
+def classifier_metrics(classifier, encodings, labels, batch_size=512):
+    '''TEST AUROC and AUPRC of a single output RnnPredictor on encodings of shape (num_samples, num_windows, encoding_size).'''
+    with torch.no_grad():
+        risks = torch.cat([torch.sigmoid(classifier(batch)).reshape(-1) for batch in torch.split(encodings, batch_size)]).numpy()
+    precision, recall, _ = precision_recall_curve(labels, risks)
+    return roc_auc_score(labels, risks), auc(recall, precision)
+
+
+def encoding_throughput(encoder, data_maps, window_size, batch_size=64, num_repeats=3):
+    '''Number of windows encoded per second by encode_sequences.'''
+    encode_sequences(encoder, data_maps[:batch_size], window_size, batch_size) # Warm up
+    start = time.perf_counter()
+    for _ in range(num_repeats):
+        encode_sequences(encoder, data_maps, window_size, batch_size)
+    return num_repeats*len(data_maps)*(data_maps.shape[-1]//window_size)/(time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distills an encoder into a smaller CausalCNNEncoder')
+    parser.add_argument('--teacher_checkpoint', type=str, required=True, help='Encoder checkpoint saved by tnc.py')
+    parser.add_argument('--classifier_checkpoint', type=str, default=None, help='Mortality classifier checkpoint of the teacher, for the downstream AUROC')
+    parser.add_argument('--path', type=str, default='./hirid_numpy')
+    parser.add_argument('--output_checkpoint', type=str, default='./ckpt/HiRID/distilled_CausalCNNEncoder_checkpoint_0.tar')
+    parser.add_argument('--student_channels', type=int, default=8)
+    parser.add_argument('--student_depth', type=int, default=1)
+    parser.add_argument('--student_reduced_size', type=int, default=8)
+    parser.add_argument('--student_kernel_size', type=int, default=3)
+    parser.add_argument('--num_windows', type=int, default=50000)
+    parser.add_argument('--n_epochs', type=int, default=20)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--hidden_size', type=int, default=8)
+    parser.add_argument('--num_speed_samples', type=int, default=256)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    checkpoint = load_checkpoint(args.teacher_checkpoint, map_location='cpu')
+    window_size = checkpoint.get('learn_encoder_hyper_params', {}).get('window_size', checkpoint['encoder_hyper_params'].get('window_size'))
+    train_encoder_data_maps = np.load(os.path.join(args.path, 'train_encoder_data_maps.npy'), mmap_mode='r')
+    windows = sample_windows(train_encoder_data_maps, window_size, args.num_windows)
+    teacher, checkpoint = load_teacher(args.teacher_checkpoint, windows, device=device)
+
+    student_hyper_params = {'in_channels': 2*windows.shape[2], 'channels': args.student_channels, 'depth': args.student_depth,
+                            'reduced_size': args.student_reduced_size, 'encoding_size': teacher.pruned_encoding_size,
+                            'kernel_size': args.student_kernel_size, 'window_size': window_size}
+    student = CausalCNNEncoder(**dict(student_hyper_params, device=device))
+    student, agreement = distill_encoder(teacher, student, windows, n_epochs=args.n_epochs, batch_size=args.batch_size, lr=args.lr, device=device)
+    print('Encoding agreement on held out windows: MSE %.5f, R^2 %.3f, cosine similarity %.3f'%(agreement['mse'], agreement['r2'], agreement['cosine_similarity']))
+
+    # tnc.py --checkpoint_file runs main with the hyper parameters and ids of the checkpoint, so the ones of the teacher are
+    # kept, with the student's encoder_hyper_params and its own ids. UNIQUE_NAME is UNIQUE_ID + '_' + encoder_type + '_' + data_type in tnc.py
+    data_type = checkpoint.get('data_type', 'HiRID')
+    unique_name = os.path.basename(args.output_checkpoint).split('_checkpoint_')[0]
+    name_suffix = '_CausalCNNEncoder_%s'%data_type
+    unique_id = unique_name[:-len(name_suffix)] if unique_name.endswith(name_suffix) else unique_name
+    learn_encoder_hyper_params = dict(checkpoint.get('learn_encoder_hyper_params', {}), window_size=window_size)
+    learn_encoder_hyper_params.setdefault('device', device)
+    state = {
+        'encoder_state_dict': student.state_dict(),
+        'encoder_hyper_params': dict(student_hyper_params, device=checkpoint['encoder_hyper_params'].get('device', device)),
+        'learn_encoder_hyper_params': learn_encoder_hyper_params,
+        'classification_hyper_params': checkpoint.get('classification_hyper_params', {}),
+        'pretrain_hyper_params': checkpoint.get('pretrain_hyper_params', {}),
+        'unique_id': unique_id,
+        'unique_name': unique_name,
+        'data_type': data_type,
+        'encoder_type': 'CausalCNNEncoder',
+        'pruning_mask': student.pruning_mask,
+        'teacher_checkpoint': args.teacher_checkpoint,
+        'encoding_agreement': agreement
+    }
+    if os.path.dirname(args.output_checkpoint) and not os.path.exists(os.path.dirname(args.output_checkpoint)):
+        os.makedirs(os.path.dirname(args.output_checkpoint))
+    torch.save(state, args.output_checkpoint)
+    print('Student saved to %s'%args.output_checkpoint)
+
+    TEST_data_maps = torch.from_numpy(np.load(os.path.join(args.path, 'TEST_mortality_data_maps.npy'))).float()
+    # Both encoders are compared as they would be served, i.e. frozen if they are CausalCNNEncoders
+    serving_student = copy.deepcopy(student)
+    serving_student.freeze_for_inference()
+    if isinstance(teacher, CausalCNNEncoder):
+        teacher.freeze_for_inference()
+    if args.classifier_checkpoint is not None:
+        TEST_labels = np.array([1 in label for label in torch.from_numpy(np.load(os.path.join(args.path, 'TEST_mortality_labels.npy')))])
+        classifier = RnnPredictor(encoding_size=teacher.pruned_encoding_size, hidden_size=args.hidden_size).to(device)
+        classifier.load_state_dict(load_checkpoint(args.classifier_checkpoint, map_location=device)['classifier_state_dict'])
+        classifier.eval()
+        for name, encoder in [('teacher', teacher), ('student', serving_student)]:
+            auroc, auprc = classifier_metrics(classifier, encode_sequences(encoder, TEST_data_maps, window_size).to(device), TEST_labels)
+            print('TEST mortality with the %s encodings: AUROC %.3f, AUPRC %.3f'%(name, auroc, auprc))
+
+    speed_data_maps = TEST_data_maps[:args.num_speed_samples]
+    teacher_throughput = encoding_throughput(teacher, speed_data_maps, window_size)
+    student_throughput = encoding_throughput(serving_student, speed_data_maps, window_size)
+    print('Teacher: %.0f windows/sec, student: %.0f windows/sec (%.1fx)'%(teacher_throughput, student_throughput, student_throughput/teacher_throughput))
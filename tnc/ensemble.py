@@ -0,0 +1,193 @@
+"""
+Ensemble inference over the CV fold encoders and RnnPredictors trained by tnc.py.
+
+main() trains n_cross_val_encoder encoders and, for each of them, n_cross_val_classification classifiers. FoldEnsemble runs
+all of them in one pass over the data:
+    - the encoders share a single CausalCNNEncoder.forward_seq: each chunk of windows is taken from the input (and copied)
+      once, and every fold's causal CNN is applied to it in turn, with its own (ungrouped) convolutions,
+    - every classifier then runs its own LSTM (a separate cuDNN/MKL call) on the encodings of its encoder.
+The per-fold outputs are exactly those of the individual models. Compared to running the folds one at a time, only the
+windowing of the input is shared, so the gain is small (see benchmark_fold_ensemble in tnc/benchmarks.py), the point of
+FoldEnsemble is the single pass over the data for the per-fold and fold-averaged risks. Stacking the folds into a single
+wider encoder (with grouped convolutions) and a block diagonal LSTM was slower than running them one at a time.
+
+Running this file loads the fold checkpoints of a run, and reports the per-fold and fold-averaged TEST AUROC/AUPRC from a
+single pass over the TEST data.
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score, precision_recall_curve, auc
+from tnc.models import CausalCNNEncoder, RnnPredictor
+from tnc.checkpoints import load_checkpoint
+
+
+class _FoldNetworks(torch.nn.Module):
+    '''Applies the network of every fold encoder to the same windows, and concatenates their encodings.'''
+    def __init__(self, networks):
+        super(_FoldNetworks, self).__init__()
+        self.networks = torch.nn.ModuleList(networks)
+
+    def forward(self, windows):
+        return torch.cat([network(windows) for network in self.networks], dim=1)
+
+
+def stack_encoders(encoders):
+    '''Returns a CausalCNNEncoder whose (pruned) encodings are the concatenation of the (pruned) encodings of encoders,
+    which must have the same hyper parameters. Its network runs the networks of the encoders (not copies of them) one after
+    the other on each chunk of windows of forward_seq. The encoders are frozen for inference (in place), see
+    CausalCNNEncoder.freeze_for_inference.'''
+    def hyper_params(encoder):
+        first_conv = encoder.network[0].network[0].causal[0]
+        return (first_conv.in_channels, encoder.channels, encoder.depth, encoder.network[3].in_features, encoder.encoding_size,
+                first_conv.kernel_size[0], encoder.window_size)
+    if len(set(hyper_params(encoder) for encoder in encoders)) != 1:
+        raise ValueError('All the encoders of an ensemble must have the same hyper parameters')
+    for encoder in encoders:
+        encoder.freeze_for_inference()
+
+    in_channels, channels, depth, reduced_size, encoding_size, kernel_size, window_size = hyper_params(encoders[0])
+    # The folds' activations aren't alive at the same time, so the chunks of windows are those of a single encoder
+    stacked = CausalCNNEncoder(in_channels=in_channels, channels=channels, depth=depth, reduced_size=reduced_size,
+                               encoding_size=len(encoders)*encoding_size, kernel_size=kernel_size, device=encoders[0].device, window_size=window_size)
+    stacked.network = _FoldNetworks([encoder.network for encoder in encoders])
+    stacked.memory_budget = encoders[0].memory_budget
+    stacked.pruning_mask = torch.cat([encoder.pruning_mask.cpu() for encoder in encoders])
+    stacked.pruned_encoding_size = int(torch.sum(stacked.pruning_mask))
+    return stacked.eval()
+
+
+class FoldEnsemble(torch.nn.Module):
+    '''Runs classifiers[k] on the encodings of encoders[k], for all k in one pass. The same encoder can appear several times
+    (e.g. the encoder of one encoder_cv, shared by its n_cross_val_classification classifiers), it is then only run once.'''
+    def __init__(self, encoders, classifiers):
+        super(FoldEnsemble, self).__init__()
+        if len(encoders) != len(classifiers):
+            raise ValueError('One encoder is needed per classifier')
+        if len(set(classifier.n_classes for classifier in classifiers)) != 1:
+            raise ValueError('All the classifiers of an ensemble must have the same n_classes')
+        unique_encoders = []
+        encoder_inds = []
+        for encoder in encoders:
+            if not any(encoder is unique_encoder for unique_encoder in unique_encoders):
+                unique_encoders.append(encoder)
+            encoder_inds.append([unique_encoder is encoder for unique_encoder in unique_encoders].index(True))
+        self.encoder = stack_encoders(unique_encoders)
+        self.classifiers = torch.nn.ModuleList([classifier.eval() for classifier in classifiers])
+
+        # Slices of the stacked (pruned) encodings read by each classifier
+        encoding_ends = np.cumsum([encoder.pruned_encoding_size for encoder in unique_encoders])
+        encoding_slices = [(int(end) - encoder.pruned_encoding_size, int(end)) for end, encoder in zip(encoding_ends, unique_encoders)]
+        self.input_slices = [encoding_slices[ind] for ind in encoder_inds]
+
+        self.num_folds = len(classifiers)
+        self.n_classes = classifiers[0].n_classes
+        self.window_size = self.encoder.window_size
+
+    def forward(self, x, return_full_seq=False, sliding_gap=None, lengths=None):
+        '''Takes data_maps of shape (num_samples, 2, num_features, seq_len), and returns the predictions (logits) of every fold, of
+        shape (num_folds, num_samples, n_classes) (or (num_folds, num_samples, num_windows, n_classes) if return_full_seq).'''
+        encodings = self.encoder.forward_seq(x, sliding_gap=sliding_gap)
+        preds = [classifier(encodings[..., start:end], return_full_seq=return_full_seq, lengths=lengths)
+                 for classifier, (start, end) in zip(self.classifiers, self.input_slices)]
+        preds = torch.stack(preds)
+        return preds.unsqueeze(-1) if self.n_classes == 1 else preds
+
+    def predict_risks(self, data_maps, batch_size=64):
+        '''Risk of the positive class at the end of each sample of data_maps (see tnc.quantization.predict_risks), for every fold
+        and averaged over the folds. Returns tensors of shape (num_folds, num_samples) and (num_samples,).'''
+        fold_risks = []
+        with torch.no_grad():
+            for batch in torch.split(data_maps, batch_size):
+                preds = self.forward(batch).cpu()
+                fold_risks.append(torch.sigmoid(preds[..., 0]) if self.n_classes == 1 else torch.softmax(preds, dim=-1)[..., 1])
+        fold_risks = torch.cat(fold_risks, dim=1)
+        return fold_risks, torch.mean(fold_risks, dim=0)
+
+    def predict_trajectories(self, data_maps, sliding_gap=None, batch_size=64):
+        '''Risk at every window of each sample (see RnnPredictor.predict_trajectories), for every fold and averaged over the
+        folds. Returns tensors of shape (num_folds, num_samples, num_windows) and (num_samples, num_windows) (with a trailing
+        n_classes dimension for multi-class classifiers).'''
+        fold_risks = []
+        with torch.no_grad():
+            for batch in torch.split(data_maps, batch_size):
+                preds = self.forward(batch, return_full_seq=True, sliding_gap=sliding_gap).cpu()
+                fold_risks.append(torch.sigmoid(preds[..., 0]) if self.n_classes == 1 else torch.softmax(preds, dim=-1))
+        fold_risks = torch.cat(fold_risks, dim=1)
+        return fold_risks, torch.mean(fold_risks, dim=0)
+
+
+def ensemble_metrics(fold_risks, mean_risks, labels):
+    '''AUROC and AUPRC of every fold (and their mean and std over the folds, as reported by tnc.py), and of the fold-averaged
+    risk. labels is of shape (num_samples,).'''
+    def auprc(risks):
+        precision, recall, _ = precision_recall_curve(labels, risks)
+        return auc(recall, precision)
+    fold_aurocs = [roc_auc_score(labels, risks) for risks in fold_risks.numpy()]
+    fold_auprcs = [auprc(risks) for risks in fold_risks.numpy()]
+    return {'fold_aurocs': fold_aurocs, 'fold_auprcs': fold_auprcs,
+            'auroc_mean': np.mean(fold_aurocs), 'auroc_std': np.std(fold_aurocs),
+            'auprc_mean': np.mean(fold_auprcs), 'auprc_std': np.std(fold_auprcs),
+            'ensemble_auroc': roc_auc_score(labels, mean_risks.numpy()), 'ensemble_auprc': auprc(mean_risks.numpy())}
+
+
+def load_fold_ensemble(data_type, unique_name, unique_id, n_cross_val_encoder, n_cross_val_classification, classifier_name='',
+                       hidden_size=8, ckpt_path='./ckpt', device='cpu'):
+    '''Loads the encoder checkpoints ('%s_checkpoint_%d.tar'%(unique_name, encoder_cv)) and classifier checkpoints saved by
+    tnc.py for a run, and stacks them in a FoldEnsemble.'''
+    encoders, classifiers = [], []
+    for encoder_cv in range(n_cross_val_encoder):
+        checkpoint = load_checkpoint(os.path.join(ckpt_path, data_type, '%s_checkpoint_%d.tar'%(unique_name, encoder_cv)), map_location=device)
+        encoder = CausalCNNEncoder(**dict(checkpoint['encoder_hyper_params'], device=device))
+        encoder.load_state_dict(checkpoint['encoder_state_dict'])
+        encoder.pruning_mask = checkpoint['pruning_mask']
+        encoder.pruned_encoding_size = int(torch.sum(encoder.pruning_mask))
+        for classification_cv in range(n_cross_val_classification):
+            classifier_state_dict = load_checkpoint(os.path.join(ckpt_path, data_type, '%s_encoder_checkpoint_%d_%sClassifier_checkpoint_%d.tar'% \
+                (unique_id, encoder_cv, classifier_name, classification_cv)), map_location=device)['classifier_state_dict']
+            n_classes = classifier_state_dict[[key for key in classifier_state_dict if key.startswith('linear')][-1]].shape[0]
+            classifier = RnnPredictor(encoding_size=encoder.pruned_encoding_size, hidden_size=hidden_size, n_classes=n_classes).to(device)
+            classifier.load_state_dict(classifier_state_dict)
+            encoders.append(encoder)
+            classifiers.append(classifier.eval())
+    return FoldEnsemble(encoders, classifiers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-fold and fold-averaged TEST metrics of the CV fold models, in a single pass')
+    parser.add_argument('--data_type', type=str, default='HiRID')
+    parser.add_argument('--unique_name', type=str, required=True, help='Name of the encoder checkpoints, e.g. CausalCNNEncoder_HiRID')
+    parser.add_argument('--unique_id', type=str, required=True, help='Prefix of the classifier checkpoints')
+    parser.add_argument('--n_cross_val_encoder', type=int, default=1)
+    parser.add_argument('--n_cross_val_classification', type=int, default=1)
+    parser.add_argument('--circulatory_failure', action='store_true')
+    parser.add_argument('--path', type=str, default='./hirid_numpy')
+    parser.add_argument('--hidden_size', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=64)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    ensemble = load_fold_ensemble(args.data_type, args.unique_name, args.unique_id, args.n_cross_val_encoder, args.n_cross_val_classification,
+                                  classifier_name='circulatory' if args.circulatory_failure else '', hidden_size=args.hidden_size, device=device)
+    if args.circulatory_failure:
+        # Same truncation as in circulatory_failure_prediction.py: the last 3 hrs of data are cut off
+        truncate_amt = 36
+        TEST_data_maps = torch.from_numpy(np.load(os.path.join(args.path, 'TEST_circulatory_data_maps.npy')))[:, :, :, :-truncate_amt].float()
+        TEST_labels = np.array([1 in label for label in torch.from_numpy(np.load(os.path.join(args.path, 'TEST_circulatory_labels.npy')))[:, truncate_amt:]])
+    else:
+        TEST_data_maps = torch.from_numpy(np.load(os.path.join(args.path, 'TEST_mortality_data_maps.npy'))).float()
+        TEST_labels = np.array([1 in label for label in torch.from_numpy(np.load(os.path.join(args.path, 'TEST_mortality_labels.npy')))])
+
+    start = time.perf_counter()
+    fold_risks, mean_risks = ensemble.predict_risks(TEST_data_maps, batch_size=args.batch_size)
+    elapsed = time.perf_counter() - start
+    metrics = ensemble_metrics(fold_risks, mean_risks, TEST_labels)
+    print('%d folds, %d TEST samples in %.1f sec'%(ensemble.num_folds, len(TEST_data_maps), elapsed))
+    for fold, (auroc, auprc) in enumerate(zip(metrics['fold_aurocs'], metrics['fold_auprcs'])):
+        print('    Fold %d: AUROC %.3f, AUPRC %.3f'%(fold, auroc, auprc))
+    print("CLASSIFICATION TEST RESULT OVER CV")
+    print("AUC: %.2f +- %.2f, AUPRC: %.2f +- %.2f"%(metrics['auroc_mean'], metrics['auroc_std'], metrics['auprc_mean'], metrics['auprc_std']))
+    print("Fold-averaged risk: AUC: %.2f, AUPRC: %.2f"%(metrics['ensemble_auroc'], metrics['ensemble_auprc']))
@@ -16,6 +16,26 @@ from sklearn.metrics import confusion_matrix
 def get_instance_of_encoder(encoder_type: str):
     '''Takes in a string '''
 
+def load_waveform_windows(wf_datapath='./data/waveform_data/processed', window_size=2500):
+    '''Splits the waveform training recordings into non overlapping windows of window_size time steps, labelled with their
+    most frequent state. Returns the shuffled windows (torch.Tensor of shape (num_windows, 2, window_size)) and their labels.'''
+    with open(os.path.join(wf_datapath, 'x_train.pkl'), 'rb') as f:
+        x = pickle.load(f)
+    with open(os.path.join(wf_datapath, 'state_train.pkl'), 'rb') as f:
+        y = pickle.load(f)
+
+    T = x.shape[-1]
+    x_window = np.split(x[:, :, :window_size * (T // window_size)],(T//window_size), -1)
+    y_window = np.concatenate(np.split(y[:, :window_size * (T // window_size)], (T // window_size), -1), 0).astype(int)
+    y_window = torch.Tensor(np.array([np.bincount(yy).argmax() for yy in y_window]))
+    shuffled_inds = list(range(len(y_window)))
+    random.shuffle(shuffled_inds)
+    x_window = torch.Tensor(np.concatenate(x_window, 0))
+    x_window = x_window[shuffled_inds]
+    y_window = y_window[shuffled_inds]
+    return x_window, y_window
+
+
 class ClassificationPerformanceExperiment():
     def __init__(self, n_states=4, encoding_size=10, path='simulation', cv=0, hidden_size=100, in_channel=3, window_size=50):
         # Load or train a TNC encoder
@@ -200,33 +220,20 @@ class ClassificationPerformanceExperiment():
 
 
 class WFClassificationExperiment(ClassificationPerformanceExperiment):
-    def __init__(self, n_classes=4, encoding_size=64, window_size=2500, data='waveform', cv=0):
+    def __init__(self, n_classes=4, encoding_size=64, window_size=2500, data='waveform', cv=0, head='fc'):
         # Load or train a TNC encoder and an end to end model
         if not os.path.exists("./ckpt/%s/checkpoint_%d.pth.tar"%(data, cv)):
             raise ValueError("No checkpoint for an encoder")
         checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar'%(data, cv))
         # print('Loading encoder with discrimination performance accuracy of %.3f '%checkpoint['best_accuracy'])
-        self.encoder = WFEncoder(encoding_size=encoding_size)
+        # head must be the one the checkpoint's encoder was trained with (see WFEncoder)
+        self.encoder = WFEncoder(encoding_size=encoding_size, head=head)
         self.encoder.load_state_dict(checkpoint['encoder_state_dict'])
-        self.classifier = WFEncoder(encoding_size=encoding_size, classify=True, n_classes=n_classes).classifier
-        self.e2e_model = WFEncoder(encoding_size=encoding_size, classify=True, n_classes=n_classes)
+        self.classifier = WFEncoder(encoding_size=encoding_size, classify=True, n_classes=n_classes, head=head).classifier
+        self.e2e_model = WFEncoder(encoding_size=encoding_size, classify=True, n_classes=n_classes, head=head)
 
         # Load data
-        wf_datapath = './data/waveform_data/processed'
-        with open(os.path.join(wf_datapath, 'x_train.pkl'), 'rb') as f:
-            x = pickle.load(f)
-        with open(os.path.join(wf_datapath, 'state_train.pkl'), 'rb') as f:
-            y = pickle.load(f)
-
-        T = x.shape[-1]
-        x_window = np.split(x[:, :, :window_size * (T // window_size)],(T//window_size), -1)
-        y_window = np.concatenate(np.split(y[:, :window_size * (T // window_size)], (T // window_size), -1), 0).astype(int)
-        y_window = torch.Tensor(np.array([np.bincount(yy).argmax() for yy in y_window]))
-        shuffled_inds = list(range(len(y_window)))
-        random.shuffle(shuffled_inds)
-        x_window = torch.Tensor(np.concatenate(x_window, 0))
-        x_window = x_window[shuffled_inds]
-        y_window = y_window[shuffled_inds]
+        x_window, y_window = load_waveform_windows(window_size=window_size)
         n_train = int(0.6*len(x_window))
         trainset = torch.utils.data.TensorDataset(x_window[:n_train], y_window[:n_train])
         validset = torch.utils.data.TensorDataset(x_window[n_train:], y_window[n_train:])
@@ -0,0 +1,65 @@
+"""
+Cross validation folds as index arrays into tensors that are loaded once.
+
+The encoder and classifier cross validation loops used to shuffle the whole dataset with fancy indexing
+(data_maps[inds]) and slice the train and validation sets out of the shuffled copy, i.e. a full copy of the data (and
+labels) per fold. A FoldManager keeps the base tensors as they are (in shared memory if the folds are run in other
+processes) and hands out the indices of each fold's train and validation samples, which the datasets (TNCDataset's
+indices, indexed_dataset) and samplers use to read the rows they need, a batch at a time.
+"""
+
+import random
+import numpy as np
+import torch
+from torch.utils import data
+
+
+def indexed_dataset(tensors, indices=None):
+    '''Dataset of the rows indices (all of them if None) of tensors (of the same length), without copying them.'''
+    dataset = data.TensorDataset(*tensors)
+    if indices is None:
+        return dataset
+    return data.Subset(dataset, torch.as_tensor(indices, dtype=torch.long).tolist())
+
+
+class FoldManager():
+    '''
+    Holds the base tensors of a dataset (e.g. data_maps and labels, of the same length) and splits a permutation of their
+    samples into (train_indices, validation_indices), with the first (validation_first=True) or last valid_fraction of it
+    as the validation set. With share_memory=True the base tensors are moved to shared memory, so that worker processes
+    running the folds read the same tensors.
+    '''
+    def __init__(self, *tensors, valid_fraction=0.2, validation_first=True, share_memory=False):
+        if len(set(len(tensor) for tensor in tensors)) != 1:
+            raise ValueError('The base tensors have different numbers of samples: %s'%[len(tensor) for tensor in tensors])
+        self.tensors = [tensor.share_memory_() if share_memory else tensor for tensor in tensors]
+        self.num_samples = len(tensors[0])
+        self.valid_fraction = valid_fraction
+        self.validation_first = validation_first
+
+    def shuffle(self):
+        '''A permutation of the samples drawn with the random module, like the np.arange + random.shuffle of the training
+        scripts, so the folds of a given random.seed are the same as before.'''
+        inds = np.arange(self.num_samples)
+        random.shuffle(inds)
+        return inds
+
+    def split(self, order):
+        '''(train_indices, validation_indices) of the permutation order.'''
+        if self.validation_first:
+            n_valid = int(self.valid_fraction*len(order))
+            return order[n_valid:], order[:n_valid]
+        n_train = int((1 - self.valid_fraction)*len(order))
+        return order[:n_train], order[n_train:]
+
+    def fold(self):
+        '''(train_indices, validation_indices) of a new shuffle of the samples.'''
+        return self.split(self.shuffle())
+
+    def dataset(self, indices=None):
+        '''Dataset of the rows indices of the base tensors, see indexed_dataset.'''
+        return indexed_dataset(self.tensors, indices)
+
+    def sampler(self, indices):
+        '''Sampler over the rows indices of the base tensors, in a random order, for a DataLoader over self.dataset().'''
+        return data.SubsetRandomSampler(torch.as_tensor(indices, dtype=torch.long).tolist())
@@ -0,0 +1,166 @@
+"""
+Parallel hyperparameter grid search of the APACHE group and circulatory failure classifiers, over cached encodings.
+
+The data maps of each task are encoded once (see tnc.tasks.EncodingSource) and the encodings of every split are moved to
+shared memory, so the worker processes of the pool read the same tensors rather than each encoding (or copying) the data.
+The grid (lr x weight_decay x cross validation runs) is expanded into independent jobs, each pinned to its own threads
+(and CPUs, where the platform allows it). A job trains a single RnnPredictor for the largest of n_epochs_list epochs and
+evaluates a snapshot of it after each of the requested epoch counts, instead of retraining from scratch for each of them.
+All the snapshots are gathered in one summary table.
+"""
+
+import os
+import time
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from tnc.models import RnnPredictor
+from tnc.tasks import EncodingSource, hirid_tasks
+from tnc.quantization import load_float_encoder
+
+
+def shared_task_data(source, task):
+    '''Encodings (with the task's encoding_slice applied) and labels of every split of task, in shared memory.'''
+    splits = {}
+    for split, (source_name, labels, rows) in task.splits.items():
+        encodings = source.encodings(source_name)[rows][:, task.encoding_slice].contiguous()
+        splits[split] = (encodings.share_memory_(), labels.clone().share_memory_())
+    return {'name': task.name, 'head': task.head, 'splits': splits, 'encoding_size': source.encoding_size}
+
+
+def grid_jobs(task_names, lr_list, weight_decay_list, n_cv=3):
+    return [{'task': task, 'lr': lr, 'weight_decay': weight_decay, 'cv': cv}
+            for task, lr, weight_decay, cv in itertools.product(task_names, lr_list, weight_decay_list, range(n_cv))]
+
+
+_WORKER_STATE = {}
+
+
+def _init_worker(task_data, settings, cpu_sets):
+    # Each worker takes its own set of CPUs (if any) and limits torch to as many threads
+    cpus = cpu_sets.get() if cpu_sets is not None else None
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(settings['threads_per_job'])
+    _WORKER_STATE['task_data'] = {data['name']: data for data in task_data}
+    _WORKER_STATE['settings'] = settings
+
+
+def _evaluate(classifier, head, encodings, labels, batch_size):
+    classifier.eval()
+    losses, probabilities = [], []
+    with torch.no_grad():
+        for start in range(0, len(encodings), batch_size):
+            predictions = classifier(encodings[start:start+batch_size])
+            losses.append(head.loss(predictions, labels[start:start+batch_size]).item()*len(predictions))
+            probabilities.append(head.probabilities(predictions))
+    metrics = head.metrics(labels.numpy(), torch.cat(probabilities).numpy())
+    metrics['loss'] = sum(losses)/len(encodings)
+    return metrics
+
+
+def run_job(job):
+    '''Trains the classifier of a grid job on the shared encodings and returns a row of results per snapshot (requested
+    epoch count), with the metrics of every split other than train.'''
+    data = _WORKER_STATE['task_data'][job['task']]
+    settings = _WORKER_STATE['settings']
+    head = data['head']
+    train_encodings, train_labels = data['splits']['train']
+    torch.manual_seed(job['cv'])
+    classifier = RnnPredictor(encoding_size=data['encoding_size'], hidden_size=settings['hidden_size'], n_classes=head.n_classes)
+    optimizer = torch.optim.Adam(classifier.parameters(), lr=job['lr'], weight_decay=job['weight_decay'])
+    snapshots = sorted(set(settings['n_epochs_list']))
+    rows = []
+    start_time = time.time()
+    for epoch in range(1, snapshots[-1] + 1):
+        classifier.train()
+        for batch_rows in torch.split(torch.randperm(len(train_encodings)), settings['batch_size']):
+            loss = head.loss(classifier(train_encodings[batch_rows]), train_labels[batch_rows])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        if epoch in snapshots:
+            row = dict(job, n_epochs=epoch, train_time=time.time() - start_time)
+            for split, (encodings, labels) in data['splits'].items():
+                if split != 'train':
+                    row.update({'%s_%s'%(split, key): value for key, value in _evaluate(classifier, head, encodings, labels, settings['batch_size']).items()})
+            rows.append(row)
+    return rows
+
+
+def _cpu_sets(num_workers, threads_per_job):
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    if num_workers*threads_per_job > len(cpus):
+        return None # Not enough CPUs to give each worker its own
+    return [set(cpus[i*threads_per_job:(i+1)*threads_per_job]) for i in range(num_workers)]
+
+
+def run_grid(task_data, lr_list, weight_decay_list, n_epochs_list, n_cv=3, num_workers=None, threads_per_job=1, hidden_size=8, batch_size=32):
+    '''
+    Runs every job of the grid over the tasks of task_data (see shared_task_data) with num_workers processes (all the
+    CPUs divided by threads_per_job if None, in this process if 0). Returns a DataFrame with a row per job and epoch count.
+    '''
+    settings = {'n_epochs_list': list(n_epochs_list), 'threads_per_job': threads_per_job, 'hidden_size': hidden_size, 'batch_size': batch_size}
+    jobs = grid_jobs([data['name'] for data in task_data], lr_list, weight_decay_list, n_cv)
+    if num_workers is None:
+        num_workers = max(len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count(), 1)//threads_per_job
+    num_workers = min(num_workers, len(jobs))
+    if num_workers <= 0:
+        _init_worker(task_data, settings, None)
+        results = [run_job(job) for job in jobs]
+    else:
+        context = mp.get_context('spawn')
+        cpu_sets = _cpu_sets(num_workers, threads_per_job)
+        cpu_queue = None
+        if cpu_sets is not None:
+            cpu_queue = context.Queue()
+            for cpus in cpu_sets:
+                cpu_queue.put(cpus)
+        with context.Pool(num_workers, initializer=_init_worker, initargs=(task_data, settings, cpu_queue)) as pool:
+            results = list(pool.imap_unordered(run_job, jobs))
+    table = pd.DataFrame([row for rows in results for row in rows])
+    return table.sort_values(['task', 'lr', 'weight_decay', 'n_epochs', 'cv']).reset_index(drop=True)
+
+
+def summarize(table):
+    '''Mean and standard deviation over the cross validation runs of each grid point.'''
+    metric_columns = [column for column in table.columns if column not in ['task', 'lr', 'weight_decay', 'n_epochs', 'cv']]
+    return table.groupby(['task', 'lr', 'weight_decay', 'n_epochs'])[metric_columns].agg(['mean', 'std'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel hyperparameter grid search of the APACHE group and circulatory failure classifiers')
+    parser.add_argument('--encoder_checkpoint', type=str, required=True)
+    parser.add_argument('--path', type=str, default='./hirid_numpy')
+    parser.add_argument('--tasks', type=str, nargs='+', default=['apache', 'circulatory'], choices=['mortality', 'circulatory', 'apache'])
+    parser.add_argument('--lr_list', type=float, nargs='+', default=[0.01, 0.002, 0.001, 0.0005])
+    parser.add_argument('--weight_decay_list', type=float, nargs='+', default=[0.001, 0.0005, 0.0001, 0])
+    parser.add_argument('--n_epochs_list', type=int, nargs='+', default=[100, 125, 150, 200])
+    parser.add_argument('--n_cv', type=int, default=3)
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--threads_per_job', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--hidden_size', type=int, default=8)
+    parser.add_argument('--output', type=str, default=None, help='CSV file for the results of every job and epoch count.')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    encoder, _ = load_float_encoder(args.encoder_checkpoint)
+    encoder.freeze_for_inference()
+    encoder.device = device
+    source = EncodingSource(encoder.to(device), device=device)
+    tasks = hirid_tasks(source, args.path, args.tasks, window_size=encoder.window_size)
+    task_data = [shared_task_data(source, task) for task in tasks]
+    del source
+
+    table = run_grid(task_data, args.lr_list, args.weight_decay_list, args.n_epochs_list, n_cv=args.n_cv, num_workers=args.num_workers,
+                     threads_per_job=args.threads_per_job, hidden_size=args.hidden_size, batch_size=args.batch_size)
+    if args.output is not None:
+        table.to_csv(args.output, index=False)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+        print(summarize(table))
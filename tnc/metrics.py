@@ -0,0 +1,83 @@
+"""
+Streaming metrics for binary classifiers, accumulated per batch on the device of the predictions.
+
+BinaryMetricAccumulator keeps a histogram of the predicted probabilities of the positive and negative samples (num_bins
+equal width bins over [0, 1]), so its memory is O(num_bins) whatever the number of samples, and nothing is concatenated or
+moved to the host until the metrics are read. The AUROC and AUPRC are those sklearn computes (roc_auc_score, and auc of
+precision_recall_curve) if the probabilities are rounded down to their bin, i.e. they are exact up to ties within a bin.
+"""
+
+import torch
+
+
+class BinaryMetricAccumulator():
+    def __init__(self, num_bins=10000, device='cpu'):
+        self.num_bins = num_bins
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.positive_counts = torch.zeros(self.num_bins, dtype=torch.float64, device=self.device)
+        self.counts = torch.zeros(self.num_bins, dtype=torch.float64, device=self.device)
+
+    def update(self, probabilities, labels):
+        '''Adds a batch of predicted probabilities of the positive class and labels (0 or 1), of any (matching) shapes.'''
+        bins = torch.clamp((probabilities.detach().reshape(-1)*self.num_bins).long(), 0, self.num_bins - 1).to(self.device)
+        labels = labels.detach().reshape(-1).to(self.device, torch.float64)
+        self.positive_counts += torch.bincount(bins, weights=labels, minlength=self.num_bins)
+        self.counts += torch.bincount(bins, minlength=self.num_bins).double()
+
+    def _cumulative_counts(self):
+        # Number of true and false positives when the threshold is the lower edge of each bin, from the highest bin down
+        true_positives = torch.cumsum(torch.flip(self.positive_counts, [0]), 0)
+        false_positives = torch.cumsum(torch.flip(self.counts - self.positive_counts, [0]), 0)
+        return true_positives, false_positives
+
+    def auroc(self):
+        true_positives, false_positives = self._cumulative_counts()
+        tpr = torch.cat([torch.zeros(1, dtype=torch.float64, device=self.device), true_positives/true_positives[-1]])
+        fpr = torch.cat([torch.zeros(1, dtype=torch.float64, device=self.device), false_positives/false_positives[-1]])
+        return float(torch.sum((fpr[1:] - fpr[:-1])*(tpr[1:] + tpr[:-1])/2))
+
+    def auprc(self):
+        true_positives, false_positives = self._cumulative_counts()
+        non_empty = torch.flip(self.counts, [0]) > 0 # Empty bins would repeat the previous point of the curve
+        true_positives, false_positives = true_positives[non_empty], false_positives[non_empty]
+        # The curve starts at recall 0 and precision 1, as in precision_recall_curve
+        precision = torch.cat([torch.ones(1, dtype=torch.float64, device=self.device), true_positives/(true_positives + false_positives)])
+        recall = torch.cat([torch.zeros(1, dtype=torch.float64, device=self.device), true_positives/true_positives[-1]])
+        return float(torch.sum((recall[1:] - recall[:-1])*(precision[1:] + precision[:-1])/2))
+
+    def confusion_counts(self, threshold=0.5):
+        '''Returns (true negatives, false positives, false negatives, true positives) of the predictions thresholded at
+        threshold (rounded down to a bin edge), as Python ints.'''
+        first_positive_bin = int(threshold*self.num_bins)
+        true_positives = int(torch.sum(self.positive_counts[first_positive_bin:]))
+        false_positives = int(torch.sum(self.counts[first_positive_bin:])) - true_positives
+        positives = int(torch.sum(self.positive_counts))
+        negatives = int(torch.sum(self.counts)) - positives
+        return negatives - false_positives, false_positives, positives - true_positives, true_positives
+
+    def classification_report(self, target_names, threshold=0.5, digits=2):
+        '''Same text report as sklearn.metrics.classification_report of the predictions thresholded at threshold.'''
+        true_negatives, false_positives, false_negatives, true_positives = self.confusion_counts(threshold)
+        def scores(true, false_predicted, false_missed):
+            precision = true/(true + false_predicted) if true + false_predicted > 0 else 0.
+            recall = true/(true + false_missed) if true + false_missed > 0 else 0.
+            f1 = 2*precision*recall/(precision + recall) if precision + recall > 0 else 0.
+            return precision, recall, f1, true + false_missed
+        rows = [scores(true_negatives, false_negatives, false_positives), scores(true_positives, false_positives, false_negatives)]
+        support = rows[0][3] + rows[1][3]
+        width = max(len('weighted avg'), max(len(name) for name in target_names), digits)
+        header = ' '*width + ' ' + ''.join('%10s'%name for name in ['precision', 'recall', 'f1-score', 'support'])
+        lines = [header, '']
+        for name, (precision, recall, f1, class_support) in zip(target_names, rows):
+            lines.append('%*s  %9.*f %9.*f %9.*f %9d'%(width, name, digits, precision, digits, recall, digits, f1, class_support))
+        lines.append('')
+        accuracy = (true_negatives + true_positives)/support if support > 0 else 0.
+        lines.append('%*s  %9s %9s %9.*f %9d'%(width, 'accuracy', '', '', digits, accuracy, support))
+        averages = [('macro avg', [0.5, 0.5]), ('weighted avg', [row[3]/support if support > 0 else 0. for row in rows])]
+        for name, weights in averages:
+            averaged = [sum(weight*row[i] for weight, row in zip(weights, rows)) for i in range(3)]
+            lines.append('%*s  %9.*f %9.*f %9.*f %9d'%(width, name, digits, averaged[0], digits, averaged[1], digits, averaged[2], support))
+        return '\n'.join(lines) + '\n'
@@ -1,12 +1,29 @@
 import torch
 import torch.nn as nn
 import math
+import os
+import json
 import numpy as np
 from torch.utils import data
 from torch.autograd import Variable
 from torch.nn.parameter import Parameter
 import torch.nn.functional as F
 
+def gru_cell_state_dict_to_gru(state_dict, prefix='rnn.'):
+    '''Renames the parameters of an nn.GRUCell (weight_ih, weight_hh, bias_ih, bias_hh) saved under prefix to the names of
+    the equivalent single layer nn.GRU (weight_ih_l0, ...), in place. The gates are stacked the same way in both modules,
+    so the weights are used as they are. Returns state_dict.'''
+    for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+        if prefix + name in state_dict:
+            state_dict[prefix + name + '_l0'] = state_dict.pop(prefix + name)
+    return state_dict
+
+
+def _load_gru_cell_checkpoint_hook(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    # Checkpoints of the CNN-RNN encoders saved when their RNN was an nn.GRUCell
+    gru_cell_state_dict_to_gru(state_dict, prefix + 'rnn.')
+
+
 class EncoderMultiSignalMIMIC(nn.Module):
     # Encoder from Cardiac Arrest paper
     def __init__(self, latent_size, encoding_size, in_channel, device='cpu'):
@@ -80,7 +97,9 @@ class EncoderMultiSignalMIMIC(nn.Module):
                                          nn.ReLU())
 
         # input is of size latent_size, output is of size 2*self.encoding_size
-        self.rnn = nn.GRUCell(self.latent_size, 2 * self.encoding_size) # Want to generate a distribution, so we create mean and variance vectors.
+        # A single layer GRU over the whole latent sequence, with the same parameters as the nn.GRUCell it replaces
+        self.rnn = nn.GRU(self.latent_size, 2 * self.encoding_size) # Want to generate a distribution, so we create mean and variance vectors.
+        self._register_load_state_dict_pre_hook(_load_gru_cell_checkpoint_hook)
         
         # Parameters of the posterior distribution of the latent representation
         self.mus = torch.nn.Sequential(nn.Linear(2 * self.encoding_size, self.encoding_size))
@@ -90,8 +109,10 @@ class EncoderMultiSignalMIMIC(nn.Module):
         torch.nn.init.xavier_uniform_(self.mus[0].weight)
         torch.nn.init.xavier_uniform_(self.cov[0].weight)
 
-    def forward(self, x, kl_loss=False, past_state=None):
+    def forward(self, x, kl_loss=False, past_state=None, deterministic=None):
         # x is of shape (num_samples, 2, num_features, signal_length)
+        # If deterministic, the mean of the posterior (mus) is returned instead of a sample. Defaults to True in eval mode.
+        deterministic = not self.training if deterministic is None else deterministic
         if len(tuple(x.shape)) == 3: # if a single window is being passed in
             x = x.unsqueeze(0) # Make it a batch size of 1 so its 4 dimensional.
         hiddens = self.get_distribution_params(x, past_state) # Shape: latent_seq_len, batch_size, 2*encoding_size
@@ -113,12 +134,14 @@ class EncoderMultiSignalMIMIC(nn.Module):
         kl_z = 0.5 * (torch.bmm(mus.unsqueeze(1), mus.unsqueeze(-1)) + torch.bmm(std.unsqueeze(1), std.unsqueeze(-1)) - \
                       mus.shape[-1] - torch.sum(torch.log((std+1e-5) ** 2), -1)) # What's going on here?
 
+        z = mus if deterministic else mus + std * torch.randn(std.shape).to(self.device) # Doesn't return a distribution, returns a sample of the distribution (or its mean).
         if kl_loss:
-            return mus + std * torch.randn(std.shape).to(self.device), kl_z
+            return z, kl_z
 
-        return mus + std * torch.randn(std.shape).to(self.device) # Doesn't return a distribution, returns a sample of the distribution.
+        return z
 
-    def forward_weights(self, x, past_state=None):
+    def forward_weights(self, x, past_state=None, deterministic=None):
+        deterministic = not self.training if deterministic is None else deterministic
         hiddens = self.get_distribution_params(x, past_state)  # Shape:[time_steps, batch_size, latent_size]
         weights = self.att_weights(x)
         weights = weights.view(weights.shape[0],weights.shape[-1])  # Shape:[batch_size, time_steps]
@@ -127,21 +150,21 @@ class EncoderMultiSignalMIMIC(nn.Module):
 
         mus = encoding[:, :encoding.shape[-1] // 2]
         std = encoding[:, encoding.shape[-1] // 2:]
+        if deterministic:
+            return mus, weights
         return mus + std*0.01*torch.randn(std.shape).to(self.device), weights
 
-    def forward_all(self, x):
-        latent_rep_arr = []
-        encodings = self.get_distribution_params(x)
-        for encoding in encodings:
-            mus = encoding[:, :encoding.shape[-1] // 2]
-            std = encoding[:, encoding.shape[-1] // 2:]
-            z = mus + std*0.01*torch.randn(std.shape).to(self.device)
-            latent_rep_arr.append(z)
-        latent_rep = torch.stack(latent_rep_arr)
+    def forward_all(self, x, deterministic=None):
+        deterministic = not self.training if deterministic is None else deterministic
+        encodings = self.get_distribution_params(x) # Shape: latent_seq_len, batch_size, 2*encoding_size
+        mus = encodings[:, :, :encodings.shape[-1] // 2]
+        std = encodings[:, :, encodings.shape[-1] // 2:]
+        if deterministic:
+            return mus
+        latent_rep = mus + std*0.01*torch.randn(std.shape).to(self.device)
         return latent_rep
 
     def get_distribution_params(self, x, past_state=None):
-        encodings_arr = []
         x = x.to(self.device)
         '''
         print('INPUT SHAPE TO ENCODER: ', x.shape)
@@ -180,13 +203,10 @@ class EncoderMultiSignalMIMIC(nn.Module):
         
         z = self.conv(x) # Latent state of shape (batch_size, latent_size, 1, latent_seq_len), where latent_seq_len is the compressed time dimension
         z = z.squeeze(3) # remove the dimension of size 1
-        batch_size, latent_size, latent_seq_len = z.shape
-        encodings_arr.append(self.rnn(z[:, :, 0].view(batch_size, self.latent_size), )) # No previous RNN hidden state to pass in so we leave empty
-        for i in range(1, latent_seq_len):
-            encodings_arr.append(self.rnn(z[:,:,i].view(batch_size,self.latent_size), encodings_arr[-1])) # Grabbing the most recent hidden state each time
-        
+        # past_state (of shape (batch_size, 2*encoding_size)) is the initial hidden state. Zeros if not given
+        h_0 = None if past_state is None else past_state.to(self.device).unsqueeze(0)
         # encodings.shape is latent_seq_len, batch_size, 2*encoding_size
-        encodings = torch.stack(encodings_arr)
+        encodings, _ = self.rnn(z.permute(2, 0, 1), h_0)
         return encodings
 
 class EncoderMultiSignal(nn.Module):
@@ -282,7 +302,9 @@ class EncoderMultiSignal(nn.Module):
                                          nn.ReLU())
 
         # input is of size latent_size, output is of size 2*self.encoding_size
-        self.rnn = nn.GRUCell(self.latent_size, 2 * self.encoding_size) # Want to generate a distribution, so we create mean and variance vectors.
+        # A single layer GRU over the whole latent sequence, with the same parameters as the nn.GRUCell it replaces
+        self.rnn = nn.GRU(self.latent_size, 2 * self.encoding_size) # Want to generate a distribution, so we create mean and variance vectors.
+        self._register_load_state_dict_pre_hook(_load_gru_cell_checkpoint_hook)
         
         # Parameters of the posterior distribution of the latent representation
         self.mus = torch.nn.Sequential(nn.Linear(2 * self.encoding_size, self.encoding_size))
@@ -292,8 +314,10 @@ class EncoderMultiSignal(nn.Module):
         torch.nn.init.xavier_uniform_(self.mus[0].weight)
         torch.nn.init.xavier_uniform_(self.cov[0].weight)
 
-    def forward(self, x, kl_loss=False, past_state=None):
+    def forward(self, x, kl_loss=False, past_state=None, deterministic=None):
         # x is of shape (num_samples, 2, num_features, signal_length)
+        # If deterministic, the mean of the posterior (mus) is returned instead of a sample. Defaults to True in eval mode.
+        deterministic = not self.training if deterministic is None else deterministic
         if len(tuple(x.shape)) == 3: # if a single window is being passed in
             x = x.unsqueeze(0) # Make it a batch size of 1 so its 4 dimensional.
         hiddens = self.get_distribution_params(x, past_state) # Shape: latent_seq_len, batch_size, 2*encoding_size
@@ -315,12 +339,14 @@ class EncoderMultiSignal(nn.Module):
         kl_z = 0.5 * (torch.bmm(mus.unsqueeze(1), mus.unsqueeze(-1)) + torch.bmm(std.unsqueeze(1), std.unsqueeze(-1)) - \
                       mus.shape[-1] - torch.sum(torch.log((std+1e-5) ** 2), -1)) # What's going on here?
 
+        z = mus if deterministic else mus + std * torch.randn(std.shape).to(self.device) # Doesn't return a distribution, returns a sample of the distribution (or its mean).
         if kl_loss:
-            return mus + std * torch.randn(std.shape).to(self.device), kl_z
+            return z, kl_z
 
-        return mus + std * torch.randn(std.shape).to(self.device) # Doesn't return a distribution, returns a sample of the distribution.
+        return z
 
-    def forward_weights(self, x, past_state=None):
+    def forward_weights(self, x, past_state=None, deterministic=None):
+        deterministic = not self.training if deterministic is None else deterministic
         hiddens = self.get_distribution_params(x, past_state)  # Shape:[time_steps, batch_size, latent_size]
         weights = self.att_weights(x)
         weights = weights.view(weights.shape[0],weights.shape[-1])  # Shape:[batch_size, time_steps]
@@ -329,21 +355,21 @@ class EncoderMultiSignal(nn.Module):
 
         mus = encoding[:, :encoding.shape[-1] // 2]
         std = encoding[:, encoding.shape[-1] // 2:]
+        if deterministic:
+            return mus, weights
         return mus + std*0.01*torch.randn(std.shape).to(self.device), weights
 
-    def forward_all(self, x):
-        latent_rep_arr = []
-        encodings = self.get_distribution_params(x)
-        for encoding in encodings:
-            mus = encoding[:, :encoding.shape[-1] // 2]
-            std = encoding[:, encoding.shape[-1] // 2:]
-            z = mus + std*0.01*torch.randn(std.shape).to(self.device)
-            latent_rep_arr.append(z)
-        latent_rep = torch.stack(latent_rep_arr)
+    def forward_all(self, x, deterministic=None):
+        deterministic = not self.training if deterministic is None else deterministic
+        encodings = self.get_distribution_params(x) # Shape: latent_seq_len, batch_size, 2*encoding_size
+        mus = encodings[:, :, :encodings.shape[-1] // 2]
+        std = encodings[:, :, encodings.shape[-1] // 2:]
+        if deterministic:
+            return mus
+        latent_rep = mus + std*0.01*torch.randn(std.shape).to(self.device)
         return latent_rep
 
     def get_distribution_params(self, x, past_state=None):
-        encodings_arr = []
         x = x.to(self.device)
         '''
         print('INPUT SHAPE TO ENCODER: ', x.shape)
@@ -384,16 +410,42 @@ class EncoderMultiSignal(nn.Module):
         
         z = self.conv(x) # Latent state of shape (batch_size, latent_size, 1, latent_seq_len), where latent_seq_len is the compressed time dimension
         z = z.squeeze(2) # remove the dimension of size 1
-        batch_size, latent_size, latent_seq_len = z.shape
-        encodings_arr.append(self.rnn(z[:, :, 0].view(batch_size, self.latent_size), )) # No previous RNN hidden state to pass in so we leave empty
-        for i in range(1, latent_seq_len):
-            encodings_arr.append(self.rnn(z[:,:,i].view(batch_size,self.latent_size), encodings_arr[-1])) # Grabbing the most recent hidden state each time
-        
+        # past_state (of shape (batch_size, 2*encoding_size)) is the initial hidden state. Zeros if not given
+        h_0 = None if past_state is None else past_state.to(self.device).unsqueeze(0)
         # encodings.shape is latent_seq_len, batch_size, 2*encoding_size
-        encodings = torch.stack(encodings_arr)
+        encodings, _ = self.rnn(z.permute(2, 0, 1), h_0)
         return encodings
 
 
+def lengths_from_encoding_mask(encoding_mask):
+    '''Takes an encoding mask of shape (num_samples, num_encodings) as returned by CausalCNNEncoder.forward_seq (-1 for encodings
+    derived from fully imputed data), and returns the number of encodings of each sample that come after the left padding, i.e.
+    from its first encoding that isn't -1 to the end. Samples that are fully imputed get a length of 0.'''
+    observed = encoding_mask != -1
+    first_observed = torch.where(torch.any(observed, dim=1), torch.argmax(observed.int(), dim=1), torch.full_like(observed[:, 0], observed.shape[1], dtype=torch.long))
+    return observed.shape[1] - first_observed
+
+
+def pack_left_padded(x, lengths):
+    '''Packs x of shape (batch_size, seq_len, num_features), where only the last lengths[i] time steps of sample i are real data
+    (e.g. HiRID patients are left padded), into a PackedSequence that only contains the real time steps. Lengths of 0 are treated as 1.'''
+    seq_len = x.shape[1]
+    lengths = torch.clamp(lengths.long().cpu(), 1, seq_len)
+    # Rolls each sample so its real time steps come first
+    inds = (torch.arange(seq_len).unsqueeze(0) + (seq_len - lengths).unsqueeze(1)) % seq_len # of shape (batch_size, seq_len)
+    x = torch.gather(x, 1, inds.to(x.device).unsqueeze(2).expand(x.shape))
+    return torch.nn.utils.rnn.pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+
+
+def unpack_left_padded(packed_output, lengths, seq_len):
+    '''Inverse of pack_left_padded for the output of a recurrent layer. Returns a tensor of shape (batch_size, seq_len, hidden_size)
+    with the outputs for the real time steps at the end of each sample, and zeros for the padding.'''
+    lengths = torch.clamp(lengths.long().cpu(), 1, seq_len)
+    output, _ = torch.nn.utils.rnn.pad_packed_sequence(packed_output, batch_first=True, total_length=seq_len)
+    inds = (torch.arange(seq_len).unsqueeze(0) - (seq_len - lengths).unsqueeze(1)) % seq_len
+    return torch.gather(output, 1, inds.to(output.device).unsqueeze(2).expand(output.shape))
+
+
 class RnnEncoder(torch.nn.Module):
     # Original encoder for simulation data from TNC paper
     def __init__(self, hidden_size, in_channel, encoding_size, cell_type='GRU', num_layers=1, device='cpu', dropout=0, bidirectional=True):
@@ -423,22 +475,30 @@ class RnnEncoder(torch.nn.Module):
         else:
             raise ValueError('Cell type not defined, must be one of the following {GRU, LSTM, RNN}')
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
+        # If lengths is given, only the last lengths[i] time steps of sample i are passed through the RNN (the rest is left padding)
         if len(x.shape) == 4: # This means maps are passed in too, which are not needed for RNN
             x = x[:, 0, :, :]
         # x is either of shape (mc_sample_size, num_features, window_size) or (num_features, window_size)
-        x = x.permute(2,0,1) # Moves around rows/columns. if old dim was (x, y, z), now its (z, x, y)
+        seq_len = x.shape[-1]
+        if lengths is not None:
+            x = pack_left_padded(x.permute(0, 2, 1).to(self.device), lengths)
+        else:
+            x = x.permute(2,0,1) # Moves around rows/columns. if old dim was (x, y, z), now its (z, x, y)
+        batch_size = len(lengths) if lengths is not None else x.shape[1]
         if self.cell_type=='GRU':
             # Starting hidden vector of size (num_hidden_vectors_needed, batch_size, hidden_size). The number of hidden vectors needed will either be num_layers, or double that
             # if its bidirectional. Batch size is included because we want different hidden states for different sequences in a single batch. 
-            past = torch.zeros(self.num_layers * (int(self.bidirectional) + 1), x.shape[1], self.hidden_size).to(self.device)
+            past = torch.zeros(self.num_layers * (int(self.bidirectional) + 1), batch_size, self.hidden_size).to(self.device)
         elif self.cell_type=='LSTM':
             # Starting short term memory vector
-            h_0 = torch.zeros(self.num_layers * (int(self.bidirectional) + 1), (x.shape[1]), self.hidden_size).to(self.device)
+            h_0 = torch.zeros(self.num_layers * (int(self.bidirectional) + 1), batch_size, self.hidden_size).to(self.device)
             # Starting long term memory vector
-            c_0 = torch.zeros(self.num_layers * (int(self.bidirectional) + 1), (x.shape[1]), self.hidden_size).to(self.device)
+            c_0 = torch.zeros(self.num_layers * (int(self.bidirectional) + 1), batch_size, self.hidden_size).to(self.device)
             past = (h_0, c_0)
         out, _ = self.rnn(x.to(self.device), past)  # out shape = [seq_len, batch_size, num_directions*hidden_size]
+        if lengths is not None:
+            out = unpack_left_padded(out, lengths, seq_len).permute(1, 0, 2) # The last time step is real data for every sample
         encodings = self.nn(out[-1].squeeze(0)) # squeeze gets rid of dimensions of size 1 on the 0 axis
         return encodings
 
@@ -530,11 +590,17 @@ class MimicEncoder(torch.nn.Module):
 
 
 class WFEncoder(nn.Module):
-    def __init__(self, encoding_size, classify=False, n_classes=None):
-        # Input x is (batch, 2, 256)
+    def __init__(self, encoding_size, classify=False, n_classes=None, head='fc', head_rank=64, head_pool_size=16):
+        # Input x is (batch, 2, 2500)
+        # head selects the layers between the convolutional features (of shape (batch, 256, 312)) and the encoding:
+        #   'fc': flattens the features into a Linear(79872, 2048) layer (~163M parameters). Requires windows of 2500 time steps.
+        #   'lowrank': average pools the features into head_pool_size bins and projects them to 2048 through a rank head_rank factorization.
+        #   'conv': downsamples the features with a strided convolution before pooling them into head_pool_size bins.
+        # The 'lowrank' and 'conv' heads have less than 1% of the parameters of 'fc' and work with any window size.
         super(WFEncoder, self).__init__()
 
         self.encoding_size = encoding_size
+        self.head = head
         self.n_classes = n_classes
         self.classify = classify
         self.classifier =None
@@ -575,17 +641,45 @@ class WFEncoder(nn.Module):
             nn.MaxPool1d(kernel_size=2, stride=2)
             )
 
-        self.fc = nn.Sequential(
-            nn.Dropout(0.5),
-            nn.Linear(79872, 2048),
-            nn.ELU(inplace=True),
-            nn.BatchNorm1d(2048, eps=0.001),
-            nn.Linear(2048, self.encoding_size)
-        )
+        if head == 'fc':
+            self.fc = nn.Sequential(
+                nn.Dropout(0.5),
+                nn.Linear(79872, 2048),
+                nn.ELU(inplace=True),
+                nn.BatchNorm1d(2048, eps=0.001),
+                nn.Linear(2048, self.encoding_size)
+            )
+        elif head == 'lowrank':
+            self.fc = nn.Sequential(
+                nn.AdaptiveAvgPool1d(head_pool_size),
+                nn.Flatten(),
+                nn.Dropout(0.5),
+                nn.Linear(256*head_pool_size, head_rank, bias=False), # Linear(256*head_pool_size, 2048) factorized as the product of two low rank matrices
+                nn.Linear(head_rank, 2048),
+                nn.ELU(inplace=True),
+                nn.BatchNorm1d(2048, eps=0.001),
+                nn.Linear(2048, self.encoding_size)
+            )
+        elif head == 'conv':
+            self.fc = nn.Sequential(
+                nn.Conv1d(256, 64, kernel_size=8, stride=8),
+                nn.ELU(inplace=True),
+                nn.BatchNorm1d(64, eps=0.001),
+                nn.AdaptiveMaxPool1d(head_pool_size),
+                nn.Flatten(),
+                nn.Dropout(0.5),
+                nn.Linear(64*head_pool_size, 256),
+                nn.ELU(inplace=True),
+                nn.BatchNorm1d(256, eps=0.001),
+                nn.Linear(256, self.encoding_size)
+            )
+        else:
+            raise ValueError('Unknown WFEncoder head %s, expected one of fc, lowrank or conv'%head)
 
     def forward(self, x):
         x = self.features(x)
-        x = x.view(x.size(0), -1)
+        if self.head == 'fc':
+            x = x.view(x.size(0), -1)
         encoding = self.fc(x)
         if self.classify:
             c = self.classifier(encoding)
@@ -612,18 +706,38 @@ class TST_pretrain_loader(data.Dataset):
     def __getitem__(self, ind):
         return (self.x[ind], self.mask[ind])
 
+def geometric_span_masks(num_samples, num_features, seq_len, r=0.15, l_m=3):
+    '''Masks used to pretrain the TST, of shape (num_samples, num_features, seq_len), with 0's marking the masked values.
+    Each (sample, feature) sequence alternates between segments of 1's and 0's, starting with 1's, whose lengths are drawn
+    from geometric distributions with means l_u = ((1-r)/r)*l_m and l_m, so that a proportion r of the values is masked.
+
+    All the segment lengths are drawn at once. The segment boundaries (cumulative sums of the lengths) are marked in a
+    tensor of toggles, and the cumulative sum of the toggles gives the index of the segment of each time step.'''
+    # Recall for a geometric dist., mean=(1-p)/p, where p defines the geom dist.
+    p_0 = 1/(1+l_m) # p_0 is the value that defines the geom dist of lengths of seq's of 0's
+    l_u = ((1-r)/r)*l_m  # mean len of a segment of 1's
+    p_1 = 1/(1+l_u) # p_1 is the value that defines the geom dist of lengths of seq's of 1's
+
+    # Segments are at least 1 time step long, so seq_len segments always cover the sequence
+    num_pairs = seq_len//2 + 1
+    lengths = np.empty((num_samples*num_features, 2*num_pairs), dtype=np.int64)
+    lengths[:, 0::2] = np.random.geometric(p_1, size=(num_samples*num_features, num_pairs))
+    lengths[:, 1::2] = np.random.geometric(p_0, size=(num_samples*num_features, num_pairs))
+    boundaries = torch.from_numpy(np.minimum(np.cumsum(lengths, axis=1), seq_len)) # Start of each segment after the first, clipped to seq_len
+
+    toggles = torch.zeros(num_samples*num_features, seq_len+1)
+    toggles.scatter_add_(1, boundaries, torch.ones(boundaries.shape))
+    segment_index = torch.cumsum(toggles[:, :seq_len], dim=1)
+    mask = (segment_index % 2 == 0).float() # Segments with an even index are 1's
+    return mask.reshape(num_samples, num_features, seq_len)
+
 # Internal Cell
 class _ScaledDotProductAttention(torch.nn.Module):
     def __init__(self, d_qk:int): 
         super(_ScaledDotProductAttention, self).__init__()
         self.d_qk = d_qk
-    def forward(self, q:torch.Tensor, k:torch.Tensor, v:torch.Tensor, mask:torch.Tensor=None, masked_val:int=1e-9):
-
-        # MatMul (q, k) - similarity scores for all pairs of positions in an input sequence
-        scores = torch.matmul(q, k)                                         # scores : [bs x n_heads x q_len x q_len]
-
-        # Scale
-        scores = scores / (self.d_qk ** 0.5)
+    def forward(self, q:torch.Tensor, k:torch.Tensor, v:torch.Tensor, mask:torch.Tensor=None, masked_val:int=1e-9, return_attn:bool=False):
+        # q, k : [bs x n_heads x q_len x d_qk], v : [bs x n_heads x q_len x d_v]
 
         if mask is not None:
             # mask is size (bs, num_features, seq_len)
@@ -632,21 +746,28 @@ class _ScaledDotProductAttention(torch.nn.Module):
             mask = torch.max(mask-num_features/2, torch.zeros_like(mask)) # Subtract num_features/2: We'll allow half of features to be missing before decreasing context value
             mask = mask/(num_features)
             mask = 1-mask
-            bs = mask.shape[0]
-            seq_len = mask.shape[1]
-            for i in range(bs):
-                scores[i, :] = scores[i, :] * mask[i].view([seq_len, 1])
+            # The scores of each query are multiplied by the weight of its time step. Scaling the rows of q is the same, and
+            # doesn't require the scores to be materialized.
+            q = q * mask[:, None, :, None].to(q.dtype)
 
         # Mask (optional)
         # if mask is not None: scores.masked_fill_(mask==1, masked_val)
 
+        if not return_attn and hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+            # Fused kernel when available (math implementation on CPU). Scales the scores by 1/sqrt(d_qk)
+            return torch.nn.functional.scaled_dot_product_attention(q, k, v), None
+
+        # MatMul (q, k) - similarity scores for all pairs of positions in an input sequence
+        scores = torch.matmul(q, k.transpose(2, 3))                         # scores : [bs x n_heads x q_len x q_len]
+
+        # Scale
+        scores = scores / (self.d_qk ** 0.5)
+
         # SoftMax
         attn = torch.nn.functional.softmax(scores, dim=3)                   # attn   : [bs x n_heads x q_len x q_len]
 
         # MatMul (attn, v)
         context = torch.matmul(attn, v)                                     # context: [bs x n_heads x q_len x d_v]
-        
-
 
         return context, attn
 
@@ -665,28 +786,25 @@ class _MultiHeadAttention(torch.nn.Module):
         # Note: I believe this is W^O from the illustrated transformer article, *not* the W_O from the paper this code is based on
         self.W_O = nn.Linear(n_heads * d_v, hidden_size, bias=False)
 
-    def forward(self, Q:torch.Tensor, K:torch.Tensor, V:torch.Tensor, mask:torch.Tensor=None, mask_val:float=1e-9):
+        self.sdp_attn = _ScaledDotProductAttention(d_qk)
+
+    def forward(self, Q:torch.Tensor, K:torch.Tensor, V:torch.Tensor, mask:torch.Tensor=None, mask_val:float=1e-9, return_attn:bool=False):
         r"""
         Q, K, and V are all passed in as just the input sequence of data
         Input shape:  Q, K, V:[batch_size (bs) x q_len x hidden_size], 
-                         mask:[q_len x q_len]
+                         mask:[bs x num_features x q_len]
+        The attention maps ([bs x n_heads x q_len x q_len]) are only computed if return_attn, otherwise None is returned in their place.
         """
 
         bs = Q.size(0)
-        q_len = Q.shape[1]
 
         # Linear (+ split in multiple heads)
         q_s = self.W_Q(Q).view(bs, -1, self.n_heads, self.d_qk).transpose(1,2)       # q_s    : [bs x n_heads x q_len x d_qk]
-        assert tuple(q_s.shape) == (bs, self.n_heads, q_len, self.d_qk)
-
-        k_s = self.W_K(K).view(bs, -1, self.n_heads, self.d_qk).permute(0,2,3,1)     # k_s    : [bs x n_heads x d_qk x q_len] - transpose(1,2) + transpose(2,3)
-        assert tuple(k_s.shape) == (bs, self.n_heads, self.d_qk, q_len)
-
+        k_s = self.W_K(K).view(bs, -1, self.n_heads, self.d_qk).transpose(1,2)       # k_s    : [bs x n_heads x q_len x d_qk]
         v_s = self.W_V(V).view(bs, -1, self.n_heads, self.d_v).transpose(1,2)       # v_s    : [bs x n_heads x q_len x d_v]
-        assert tuple(v_s.shape) == (bs, self.n_heads, q_len, self.d_v)
 
         # Scaled Dot-Product Attention (multiple heads)
-        context, attn = _ScaledDotProductAttention(self.d_qk)(q_s, k_s, v_s, mask, mask_val)          # context: [bs x n_heads x q_len x d_v], attn: [bs x n_heads x q_len x q_len]
+        context, attn = self.sdp_attn(q_s, k_s, v_s, mask, mask_val, return_attn=return_attn)          # context: [bs x n_heads x q_len x d_v], attn: [bs x n_heads x q_len x q_len]
 
         # Concat
         # Note: contiguous just makes context behave in memory as if it had always been of this shape. Transpose doesn't actually modify the tensor, just adjusts meta data
@@ -727,11 +845,11 @@ class _TSTEncoderLayer(torch.nn.Module):
         self.dropout_ffn = nn.Dropout(res_dropout)
         self.batchnorm_ffn = nn.BatchNorm1d(q_len)
 
-    def forward(self, src:torch.Tensor, mask:torch.Tensor=None, mask_val:float=1e-9) -> torch.Tensor:
+    def forward(self, src:torch.Tensor, mask:torch.Tensor=None, mask_val:float=1e-9, return_attn:bool=False) -> torch.Tensor:
 
         # Multi-Head attention sublayer
         ## Multi-Head attention
-        src2, attn = self.self_attn(src, src, src, mask=mask, mask_val=mask_val)
+        src2, attn = self.self_attn(src, src, src, mask=mask, mask_val=mask_val, return_attn=return_attn)
         ## Add & Norm
         src = src + self.dropout_attn(src2) # Add: residual connection with residual dropout
         src = self.batchnorm_attn(src)      # Norm: batchnorm
@@ -743,6 +861,8 @@ class _TSTEncoderLayer(torch.nn.Module):
         src = src + self.dropout_ffn(src2) # Add: residual connection with residual dropout
         src = self.batchnorm_ffn(src) # Norm: batchnorm
 
+        if return_attn:
+            return src, attn
         return src
 
     def _get_activation_fn(self, activation):
@@ -758,10 +878,17 @@ class _TSTEncoder(torch.nn.Module):
         self.layers = nn.ModuleList([_TSTEncoderLayer(q_len, hidden_size, n_heads=n_heads, d_qk=d_qk, d_v=d_v, d_ff=d_ff, res_dropout=res_dropout,
                                                             activation=activation) for i in range(n_layers)])
 
-    def forward(self, src, mask, mask_val):
+    def forward(self, src, mask, mask_val, return_attn=False):
         output = src
-        for module in self.layers: output = module(output, mask, mask_val)
-        return output
+        if not return_attn:
+            for module in self.layers: output = module(output, mask, mask_val)
+            return output
+
+        attns = [] # The attention maps of each layer, each of shape [bs x n_heads x q_len x q_len]
+        for module in self.layers:
+            output, attn = module(output, mask, mask_val, return_attn=True)
+            attns.append(attn)
+        return output, attns
 
 
 # Cell
@@ -850,7 +977,9 @@ class TST(nn.Module):
 
     
 
-    def forward(self, data: torch.Tensor, mask_val:float=1e-9, mask_included=True) -> torch.Tensor:  # x: (bs, nvars, q_len])
+    def forward(self, data: torch.Tensor, mask_val:float=1e-9, mask_included=True, return_attn=False) -> torch.Tensor:  # x: (bs, nvars, q_len])
+        # If return_attn, the attention maps of each layer are also returned (a list of tensors of shape (bs, n_heads, q_len, q_len)).
+        # Otherwise they are never materialized, which the fused attention kernel doesn't need.
         data = data.to(self.device)
         if len(tuple(data.shape)) == 3 and mask_included: # Only a single sample is being passed in
             data = data.unsqueeze(0) # Add dim 1 at the start so its a 'batch' of size 1.
@@ -878,28 +1007,26 @@ class TST(nn.Module):
         u = self.res_dropout(u + self.W_pos) # element wise addition with positional encoding vector
 
         # Encoder
-        z = self.encoder(u, mask, mask_val)                             # z: (bs, q_len, hidden_size)
+        if return_attn:
+            z, attns = self.encoder(u, mask, mask_val, return_attn=True)
+        else:
+            z = self.encoder(u, mask, mask_val)                         # z: (bs, q_len, hidden_size)
         z = z.view(z.size(0), -1)     # flattening                      # z: (bs, q_len * hidden_size)
         #else: z = z.transpose(2,1).contiguous()                         # z: (bs, hidden_size, q_len)
 
-        
+        if return_attn:
+            return self.linear_hidden_to_encoding(z), attns
         return self.linear_hidden_to_encoding(z)    # return is of size (bs, encoding_size)
     
-    def pretrain(self, x:torch.Tensor, lr: float, decay: float, batch_size: int, num_epochs:int=50):
+    def pretrain(self, x:torch.Tensor, lr: float, decay: float, batch_size: int, num_epochs:int=50, regenerate_masks:bool=False, num_workers:int=3):
         # x is of shape (num_train_samples, 2, num_features, signal_length), assume its been shuffled and
         # that we are passing in only *training* data
+        # If regenerate_masks, new masks are drawn at every epoch instead of using the same ones for the whole pretraining.
         x = x[:, 0, :, :]
 
-        # Masking + pretrain implemented according to the paper
-        
+        # Masking + pretrain implemented according to the paper, see geometric_span_masks
         r = 0.15 # prob of setting a value to 0
-
         l_m = 3 # mean len of a segment of 0's
-        # Recall for a geometric dist., mean=(1-p)/p, where p defines the geom dist.
-        p_0 = 1/(1+l_m) # p_0 is the value that defines the geom dist of lengths of seq's of 0's
-
-        l_u = ((1-r)/r)*l_m  # mean len of a segment of 1's
-        p_1 = 1/(1+l_u) # p_1 is the value that defines the geom dist of lengths of seq's of 1's
 
         # Recall x is of shape (num_samples, num_features, seq_len])
         # We must reshape it though because seq_len could be large (e.g. 2000) when we pass in the whole dataset to pretrain,
@@ -908,66 +1035,43 @@ class TST(nn.Module):
         x = torch.reshape(x, (-1, x.shape[1], self.seq_len))
         num_train_samples, num_features, seq_len = x.shape
 
-        mask = torch.ones(x.shape)
-        
-        start_indices = torch.zeros((num_train_samples, num_features))
-
-
-        # done_values are booleans indicating if we've finished masking for the ij'th sequence, where i and j
-        # are in the range of num_train_samples and num_features respectively. 0=Done Masking, 1=Not Done
-        done_values = torch.ones((num_train_samples, num_features))
-        while True:
-            items, counts = torch.unique(done_values, return_counts=True)
-            if counts[0] == num_train_samples*num_features and 0  in items: # done_values is filled with 0's
-                break
-            
-            for i in range(num_train_samples):
-                for j in range(num_features):
-                    if done_values[i][j] == 1:
-                        one_seg_length = np.random.geometric(p_1)
-                        mask[i, j, int(start_indices[i][j]): min(seq_len, int(start_indices[i][j]+one_seg_length * done_values[i][j]))] = 1
-                        start_indices[i][j] += one_seg_length * done_values[i][j]
-                        if start_indices[i][j] > seq_len:
-                            done_values[i][j] = 0
-                    
-                    if done_values[i][j] == 1:
-                        zero_seg_length = np.random.geometric(p_0)
-                        mask[i, j, int(start_indices[i][j]): min(seq_len, int(start_indices[i][j]+zero_seg_length * done_values[i][j]))] = 0
-                        start_indices[i][j] += zero_seg_length * done_values[i][j]
-                        if start_indices[i][j] > seq_len:
-                            done_values[i][j] = 0
+        mask = geometric_span_masks(num_train_samples, num_features, seq_len, r=r, l_m=l_m).to(self.device)
 
         loss_fn = torch.nn.MSELoss()
         params = list(self.parameters())
         optimizer = torch.optim.Adam(params, lr=lr, weight_decay=decay)
         loss_progression = []
+
+        # The loader is created once, so its workers are kept across epochs. It yields the index of each sample, which is
+        # used to look up its mask on self.device (so masks can be regenerated without going through the workers).
+        batches = data.DataLoader(data.TensorDataset(x, torch.arange(num_train_samples)), batch_size=batch_size, shuffle=True,
+                                  num_workers=num_workers, persistent_workers=num_workers > 0, pin_memory=str(self.device).startswith('cuda'))
         
         for epoch in range(num_epochs):
-            epoch_loss = 0
-            
-            batches = TST_pretrain_loader(x, mask)
-            batches = data.DataLoader(batches, batch_size=batch_size, shuffle=True, num_workers=3) # Wrap in DataLoader so we can have batches
+            epoch_loss = torch.zeros(1, device=self.device)
+            if regenerate_masks and epoch > 0:
+                mask = geometric_span_masks(num_train_samples, num_features, seq_len, r=r, l_m=l_m).to(self.device)
             
-            for truth_batch, mask_batch in batches:
+            for truth_batch, ind_batch in batches:
                 optimizer.zero_grad()
-                truth_batch = truth_batch.to(self.device)
-                mask_batch = mask_batch.to(self.device)
+                truth_batch = truth_batch.to(self.device, non_blocking=True)
+                mask_batch = mask[ind_batch.to(self.device)]
                 masked = truth_batch * mask_batch # apply the mask
                 masked = masked.float()
-                z = self.forward(masked) # z is of shape (bs, encoding_size)
+                z = self.forward(masked, mask_included=False) # z is of shape (bs, encoding_size)
                 
                 reconstruction = self.linear_for_pretraining(z)
-                reconstruction = torch.reshape(reconstruction, (batch_size, num_features, seq_len))
+                reconstruction = torch.reshape(reconstruction, (-1, num_features, seq_len)) # The last batch may be smaller than batch_size
     
                 # Measure reconstruction loss only for the masked values
-                mask_batch = mask_batch.cpu() # Need to move back to CPU for np.where to work
-                loss = loss_fn(reconstruction[np.where(mask_batch==0)], truth_batch[np.where(mask_batch==0)])
-                epoch_loss += loss.item()
+                masked_values = mask_batch == 0
+                loss = loss_fn(reconstruction[masked_values], truth_batch[masked_values])
+                epoch_loss += loss.detach() # Kept on device so that there is no synchronization at every batch
                 
                 loss.backward()
                 optimizer.step()
 
-            loss_progression.append(epoch_loss/batch_size)
+            loss_progression.append(epoch_loss.item()/batch_size)
 
         print('loss progression during Transformer pretraining:')
         print(loss_progression)
@@ -1026,7 +1130,7 @@ class FilterLinear(nn.Module):
 
 
 class GRUD(nn.Module):
-    def __init__(self, num_features, hidden_size, device='cpu', output_last=False):
+    def __init__(self, num_features, hidden_size, device='cpu', output_last=False, check_nan=False):
         """
         Recurrent Neural Networks for Multivariate Times Series with Missing Values
         GRU-D: GRU exploit two representations of informative missingness patterns, i.e., masking and time interval.
@@ -1047,6 +1151,7 @@ class GRUD(nn.Module):
             hidden_size: dimension of hidden_state at each time step
             mask_size: dimension of masking vector at each time step
             X_mean: the mean of the historical input data
+            check_nan: if True, inputs, decays and hidden states are checked for NaNs (debug mode, every check is a host sync)
         """
 
         super(GRUD, self).__init__()
@@ -1074,6 +1179,7 @@ class GRUD(nn.Module):
         # Before going through the gates of the GRU. As per the paper, the matrix is not forced to be diagonal, whereas it is for gamma_x_l
 
         self.output_last = output_last
+        self.check_nan = check_nan
 
     def step(self, x, x_last_obsv, x_mean, h, mask, delta):
         # Note: mask is assumed to be of format where 1 indicates observed and 0's indicate missingness
@@ -1086,24 +1192,27 @@ class GRUD(nn.Module):
         # Compute decays
         
         
-        assert not torch.isnan(x).any()
-        assert not torch.isnan(x_last_obsv).any()
-        assert not torch.isnan(x_mean).any()
-        assert not torch.isnan(h).any()
-        assert not torch.isnan(mask).any()
-        assert not torch.isnan(delta).any()
+        if self.check_nan:
+            assert not torch.isnan(x).any()
+            assert not torch.isnan(x_last_obsv).any()
+            assert not torch.isnan(x_mean).any()
+            assert not torch.isnan(h).any()
+            assert not torch.isnan(mask).any()
+            assert not torch.isnan(delta).any()
         
         delta_x = torch.exp(-torch.max(self.zeros, self.gamma_x_l(delta))) # self.zeros is of shape (num_features), self.gamma_x_l(delta) is of shape (batch_size, num_features)
         
         delta_h = torch.exp(-torch.max(self.zeros_h, self.gamma_h_l(delta))) # self.zeros_h is of shape (self.hidden_size), self.gamma_h_l(delta) is of shape (batch_size, self.hidden_size)
-        assert not torch.isnan(delta_x).any()
-        assert not torch.isnan(delta_h).any()
+        if self.check_nan:
+            assert not torch.isnan(delta_x).any()
+            assert not torch.isnan(delta_h).any()
 
         # Apply decays to input data and hidden state
         x = mask * x + (1 - mask) * (delta_x * x_last_obsv + (1 - delta_x) * x_mean)
-        assert not torch.isnan(x).any()
         h = delta_h * h
-        assert not torch.isnan(h).any()
+        if self.check_nan:
+            assert not torch.isnan(x).any()
+            assert not torch.isnan(h).any()
 
         
         # Concatenate x, h, and mask so they can go into zl, rl, and hl which each are matrices of concatenated
@@ -1122,7 +1231,76 @@ class GRUD(nn.Module):
         # print('end: ', h.shape)
         return h
 
-    def forward(self, X, Mask, X_last_obsv, Delta, X_mean):
+    def forward(self, X, Mask, X_last_obsv, Delta, X_mean, lengths=None):
+        # X is of shape (batch_size, num_features, seq_len). Its our data
+        # Mask is of shape (batch_size, num_features, seq_len). Its a mask of our data. 1's indicate observed, 0's indicate missing
+        # X_last_obsv is of shape (batch_size, num_features, seq_len). Its a tensor of the last observed value for each feature at each time step, for each batch.
+        # Delta is of shape (batch_size, num_features, seq_len). Its the time since the last observed value for each feature at each time step, for each batch.
+        # X_mean is of shape (batch_size, num_features). The ij'th element is the average observed value of the j'th feature for the i'th batch
+        # lengths is optional, of shape (batch_size,). If given, only the last lengths[i] time steps of sample i are real data (the rest is left padding),
+        # the hidden state stays at 0 until the real data starts, and leading time steps that are padding for every sample are skipped.
+
+        # Same computation as calling self.step for each time step, but everything that doesn't depend on the hidden state
+        # (decays, imputed inputs and the input/mask projections of the three gates) is computed for all time steps at once.
+        # Only two matmuls with the hidden state are left in the loop, and there are no host syncs unless self.check_nan is set.
+        num_features = X.shape[1]
+        seq_len = X.shape[2]
+        if self.check_nan:
+            for tensor in [X, Mask, X_last_obsv, Delta, X_mean]:
+                assert not torch.isnan(tensor).any()
+
+        keep, num_skipped = None, 0
+        if lengths is not None:
+            start = seq_len - torch.clamp(lengths.long(), 1, seq_len).to(X.device) # First real time step of each sample
+            num_skipped = int(torch.min(start))
+            X, Mask, X_last_obsv, Delta = X[:, :, num_skipped:], Mask[:, :, num_skipped:], X_last_obsv[:, :, num_skipped:], Delta[:, :, num_skipped:]
+            keep = (torch.arange(seq_len - num_skipped, device=X.device).unsqueeze(1) >= (start - num_skipped).unsqueeze(0)).unsqueeze(2).to(X.dtype) # of shape (seq_len - num_skipped, batch_size, 1)
+
+        X, Mask, X_last_obsv, Delta = X.permute(2, 0, 1), Mask.permute(2, 0, 1), X_last_obsv.permute(2, 0, 1), Delta.permute(2, 0, 1) # Now of shape (seq_len, batch_size, num_features)
+
+        # Decays for all time steps, of shape (seq_len, batch_size, num_features) and (seq_len, batch_size, hidden_size)
+        delta_x = torch.exp(-torch.relu(self.gamma_x_l(Delta)))
+        delta_h = torch.exp(-torch.relu(self.gamma_h_l(Delta)))
+        x = Mask * X + (1 - Mask) * (delta_x * X_last_obsv + (1 - delta_x) * X_mean.unsqueeze(0))
+
+        # The columns of zl, rl and hl are the (x, h, mask) blocks of the concatenated input. The x and mask blocks of the
+        # three gates are stacked into one (3*hidden_size, 2*num_features) weight, and the h blocks of z and r into one (2*hidden_size, hidden_size) weight
+        h_cols = slice(num_features, num_features + self.hidden_size)
+        W_input = torch.cat([torch.cat([layer.weight[:, :num_features], layer.weight[:, num_features + self.hidden_size:]], dim=1) for layer in [self.zl, self.rl, self.hl]])
+        b_input = torch.cat([self.zl.bias, self.rl.bias, self.hl.bias])
+        U_zr = torch.cat([self.zl.weight[:, h_cols], self.rl.weight[:, h_cols]])
+        U_h = self.hl.weight[:, h_cols]
+        input_gates = torch.nn.functional.linear(torch.cat([x, Mask], dim=2), W_input, b_input) # of shape (seq_len, batch_size, 3*hidden_size)
+
+        if self.check_nan:
+            for tensor in [delta_x, delta_h, x]:
+                assert not torch.isnan(tensor).any()
+
+        outputs = self._recurrence(input_gates, delta_h, U_zr, U_h, torch.zeros(X.shape[1], self.hidden_size, dtype=X.dtype, device=X.device), keep)
+        if num_skipped > 0:
+            outputs = torch.cat([torch.zeros(num_skipped, X.shape[1], self.hidden_size, dtype=outputs.dtype, device=outputs.device), outputs])
+        if self.check_nan:
+            assert not torch.isnan(outputs).any()
+        # outputs is of shape (seq_len, batch_size, hidden_size). i.e. for each time step, we have a matrix of hidden states, one for each sample from our batch.
+        if self.output_last:
+            return outputs[-1, :, :]
+        else:
+            return outputs
+
+    def _recurrence(self, input_gates, delta_h, U_zr, U_h, h, keep=None):
+        outputs = []
+        for i in range(input_gates.shape[0]):
+            h = delta_h[i] * h
+            z, r = torch.sigmoid(input_gates[i, :, :2*self.hidden_size] + torch.nn.functional.linear(h, U_zr)).chunk(2, dim=1)
+            h_tilde = torch.tanh(input_gates[i, :, 2*self.hidden_size:] + torch.nn.functional.linear(r * h, U_h))
+            h = (1 - z) * h + z * h_tilde
+            if keep is not None:
+                h = keep[i] * h # Padding time steps keep the hidden state at 0
+            outputs.append(h)
+        return torch.stack(outputs)
+
+    def forward_stepwise(self, X, Mask, X_last_obsv, Delta, X_mean):
+        # Reference implementation of forward, calling self.step for each time step
         #batch_size = input.size(0) # Size of each batch
         #type_size = input.size(1) # 0'th value in this dim is data, 1st is last observed data, second is mask, third is delta (time since last observation)
         # step_size = input.size(2) # Not sure what this is for.. just set this dim to 1
@@ -1193,8 +1371,51 @@ class GRUD(nn.Module):
 
 
 
+def grud_delta(map):
+    '''Vectorized computation of the Delta input of GRUD from map, of shape (..., seq_len). Delta is 1 at the first time step,
+    and at every other time step it is 1 more than at the previous time step where map is nonzero, and 1 where it is 0.
+    Delta[..., t] = t - (last time step <= t where map is 0, or 0) + 1, which is computed with a cumulative max.'''
+    time_steps = torch.arange(map.shape[-1], device=map.device).expand(map.shape)
+    resets = torch.where(map.bool(), torch.zeros_like(time_steps), time_steps) # Time step of each reset, 0 elsewhere
+    last_reset = torch.cummax(resets, dim=-1)[0]
+    return (time_steps - last_reset + 1).to(map.dtype)
+
+
+def add_grud_delta_channel(data_maps, cache_file=None, source_file=None):
+    '''Takes data_maps of shape (num_samples, 2, num_features, seq_len) and returns a tensor of shape (num_samples, 3, num_features, seq_len)
+    where the third channel is the Delta of the whole series, computed by grud_delta. GRUDEncoder uses it for any window sliced out
+    of the series instead of recomputing Delta. If cache_file is given, the channel is loaded from it if it exists, and saved to it otherwise.
+    A cached Delta whose shape doesn't match data_maps is recomputed, and so is one saved for a different version of source_file
+    (the file data_maps were loaded from, if given), whose size and modification time are saved next to the cache.'''
+    source_signature = None
+    if source_file is not None:
+        source_stat = os.stat(source_file)
+        source_signature = {'source_file': os.path.abspath(source_file), 'size': source_stat.st_size, 'mtime': source_stat.st_mtime}
+    delta = None
+    if cache_file is not None and os.path.exists(cache_file):
+        cached_signature = None
+        if os.path.exists(cache_file + '.json'):
+            with open(cache_file + '.json') as f:
+                cached_signature = json.load(f)
+        delta = torch.from_numpy(np.load(cache_file)).to(data_maps.dtype)
+        if tuple(delta.shape) != tuple(data_maps[:, 1, :, :].shape) or (source_signature is not None and cached_signature != source_signature):
+            print("%s doesn't match the data_maps (stale, or of another shape), recomputing it"%cache_file)
+            delta = None
+    if delta is None:
+        delta = grud_delta(data_maps[:, 1, :, :])
+        if cache_file is not None:
+            np.save(cache_file, delta.numpy())
+            if source_signature is not None:
+                with open(cache_file + '.json', 'w') as f:
+                    json.dump(source_signature, f)
+            elif os.path.exists(cache_file + '.json'):
+                os.remove(cache_file + '.json')
+    return torch.cat([data_maps, delta.unsqueeze(1)], dim=1)
+
+
 class GRUDEncoder(nn.Module):
-    '''Encodes time series data using GRUD cells'''
+    '''Encodes time series data using GRUD cells. Takes windows of shape (num_samples, 2, num_features, seq_len), or
+    (num_samples, 3, num_features, seq_len) if the Delta channel was precomputed with add_grud_delta_channel'''
     def __init__(self, num_features, hidden_size, num_layers, encoding_size, extra_layer_types, dropout=0, device='cpu') -> None:
         super(GRUDEncoder, self).__init__()
         self.num_features = num_features
@@ -1204,7 +1425,7 @@ class GRUDEncoder(nn.Module):
         self.encoding_size = encoding_size
         self.extra_layer_types = extra_layer_types
         
-        self.layers=[]
+        self.layers = nn.ModuleList() # So the GRUD and extra layers are registered as submodules, and trained with encoder.parameters()
         self.layers.append(GRUD(num_features=num_features, hidden_size=hidden_size, device=device, output_last=False))
 
         if num_layers > 1:
@@ -1222,53 +1443,71 @@ class GRUDEncoder(nn.Module):
                                           torch.nn.Dropout(dropout),
                                           torch.nn.ReLU(),
                                           torch.nn.Linear(50, encoding_size)).to(self.device)
+        
+        self.pruning_mask = torch.ones(self.encoding_size).bool()
+        self.pruned_encoding_size = int(torch.sum(self.pruning_mask))
 
-    def forward(self, X):
+    def forward(self, X, return_pruned=True, lengths=None):
+        # If lengths is given, only the last lengths[i] time steps of sample i are encoded (the rest is left padding)
         if len(tuple(X.shape)) == 3: # If we have a single sample being passed in
             X = X.unsqueeze(0) # Make it of shape (1, 2, num_features, seq_len)
+        X = X.to(self.device)
         
         map = X[:, 1, :, :] # map is set up so 1's indicate missingness 0's indicate observed
-        Delta = torch.ones_like(map).to(self.device)
-        for i in range(1, map.shape[2]): # map is of shape (num_samples, num_feautres, seq_len). i iterates through time steps
-            places_to_modify = map[:, :, i].bool()
-            Delta[:, :, i][places_to_modify] = Delta[:, :, i-1][places_to_modify] + 1
-
+        if X.shape[1] == 3:
+            # Delta of the whole series was precomputed. Within a window it can't be larger than the number of time steps since the window started
+            Delta = torch.minimum(X[:, 2, :, :], torch.arange(1, X.shape[-1] + 1, dtype=X.dtype, device=self.device))
+        else:
+            Delta = grud_delta(map) # map is of shape (num_samples, num_feautres, seq_len)
 
-        X = X[:, 0, :, :].to(self.device)
+        X = X[:, 0, :, :]
 
         Mask = (1-map).to(self.device) # Mask is now of the format where 0's indicate missingness and 1's indicate observed values
+        real_steps = 1
+        if lengths is not None:
+            # Delta restarts at the first real time step, and the padding isn't part of the means
+            steps_since_start = torch.arange(X.shape[-1], device=self.device).unsqueeze(0) - (X.shape[-1] - lengths.long().to(self.device)).unsqueeze(1) + 1 # of shape (num_samples, seq_len)
+            Delta = torch.minimum(Delta, torch.clamp(steps_since_start, min=1).unsqueeze(1).to(Delta.dtype))
+            real_steps = (steps_since_start > 0).unsqueeze(1).to(X.dtype)
 
         # Compute means:
-        sums = torch.sum(X*Mask, 2)
-        counts = torch.sum(Mask, 2)
-        counts[counts==0] = 1 # Ensure we don't divide by 0!
-        X_mean = (sums/counts).to(self.device) # Comptues mean for each sample and feature over time.
+        sums = torch.sum(X*Mask*real_steps, 2)
+        counts = torch.clamp(torch.sum(Mask*real_steps, 2), min=1) # Ensure we don't divide by 0!
+        X_mean = sums/counts # Comptues mean for each sample and feature over time.
 
-        X_last_obsv = X.to(self.device) # Since we forward imputeted our data
+        X_last_obsv = X # Since we forward imputeted our data
 
         # X is of shape (batch_size, num_features, seq_len). Its our data
         # Mask is of shape (batch_size, num_features, seq_len). Its a mask of our data. 1's indicate observed, 0's indicate missing
         # X_last_obsv is of shape (batch_size, num_features, seq_len). Its a tensor of the last observed value for each feature at each time step, for each sample in the batch.
         # Delta is of shape (batch_size, num_features, seq_len). Its the time since the last observed value for each feature at each time step, for each sample in the batch.
         # X_mean is of shape (batch_size, num_features). The ij'th element is the average observed value of the j'th feature for the i'th sample in the batch
-        X = self.layers[0](X, Mask, X_last_obsv, Delta, X_mean)
+        X = self.layers[0](X, Mask, X_last_obsv, Delta, X_mean, lengths=lengths)
         
         if self.extra_layer_types=='GRU':
             # Starting hidden vector of size (num_layers, batch_size, hidden_size). The number of hidden vectors needed will either be num_layers, or double that
             # if its bidirectional. Batch size is included because we want different hidden states for different sequences in a single batch. 
-            past = torch.zeros(self.num_layers, X.shape[1], self.hidden_size).to(self.device)
+            past = torch.zeros(self.num_layers-1, X.shape[1], self.hidden_size).to(self.device)
         elif self.extra_layer_types=='LSTM':
             # Starting short term memory vector
-            h_0 = torch.zeros(self.num_layers, X.shape[1], self.hidden_size).to(self.device)
+            h_0 = torch.zeros(self.num_layers-1, X.shape[1], self.hidden_size).to(self.device)
             # Starting long term memory vector
-            c_0 = torch.zeros(self.num_layers, X.shape[1], self.hidden_size).to(self.device)
+            c_0 = torch.zeros(self.num_layers-1, X.shape[1], self.hidden_size).to(self.device)
             past = (h_0, c_0)
-        if self.num_layers > 1:
+        if self.num_layers > 1 and lengths is not None:
+            out, _ = self.layers[1](pack_left_padded(X.permute(1, 0, 2), lengths), past)
+            out = unpack_left_padded(out, lengths, X.shape[0]) # of shape (batch_size, seq_len, hidden_size)
+            encodings = self.linear(out[:, -1])
+        elif self.num_layers > 1:
             out, _ = self.layers[1](X.to(self.device), past)  # out shape = [seq_len, batch_size, hidden_size]. 
             encodings = self.linear(out[-1]) # Gets the (batch_size, hidden_size) matrix from the last time step
         else:
             encodings = self.linear(X[-1])
-        return encodings
+        
+        if return_pruned:
+            return encodings[:, self.pruning_mask]
+        else:
+            return encodings
 
 
 class LinearClassifier(nn.Module):
@@ -1305,6 +1544,7 @@ class RnnPredictor(torch.nn.Module):
         self.encoding_size = encoding_size
         self.hidden_size = hidden_size
         self.num_layers = 1
+        self.n_classes = n_classes
         self.rnn = torch.nn.LSTM(input_size=encoding_size,  hidden_size=hidden_size, num_layers=self.num_layers, batch_first=True)
         if n_classes == 1:
             self.linear = torch.nn.Linear(hidden_size, n_classes)
@@ -1312,19 +1552,38 @@ class RnnPredictor(torch.nn.Module):
             self.linear = torch.nn.Sequential(torch.nn.Linear(hidden_size, 32), 
                                               torch.nn.Linear(32, n_classes))
 
-    def forward(self, x, return_full_seq=False):
+    def forward(self, x, return_full_seq=False, lengths=None):
         # x is of shape (num_samples, seq_len, num_features)
-        output, (h_n, _) = self.rnn(x)
-        preds = []
-        for hidden_states in output:
-            preds.append(self.linear(hidden_states).squeeze()) # of shape (seq_len, num_classes)
+        # If lengths is given (e.g. from lengths_from_encoding_mask), only the last lengths[i] encodings of sample i are passed
+        # through the LSTM. The hidden states of the left padding are zeros.
+        if lengths is not None:
+            output, (h_n, _) = self.rnn(pack_left_padded(x, lengths))
+            output = unpack_left_padded(output, lengths, x.shape[1])
+        else:
+            output, (h_n, _) = self.rnn(x)
+        # output is of shape (num_samples, seq_len, hidden_size). The head is applied to all samples (and time steps) in one call,
+        # or only to the last time step if the full sequence isn't needed
+        if not return_full_seq:
+            output = output[:, -1]
+        preds = self.linear(output) # Note this must be passed through sigmoid after output
+        if self.n_classes == 1:
+            preds = preds.squeeze(-1)
         
         # of shape (num_samples, seq_len, n_classes) or (num_samples, seq_len) if n_classes ==1. The ijk'th element is the prediction of class k for sample i at time j
-        preds = torch.stack(preds) # Note this must be passed through sigmoid after output
-        if return_full_seq:
-            return preds
-        else:
-            return preds[:, -1] # of shape (num_samples, n_classes)
+        # or of shape (num_samples, n_classes) (or (num_samples,)) for the last time step
+        return preds
+
+    def predict_trajectories(self, encodings, lengths=None, batch_size=512):
+        '''Takes encodings of shape (num_samples, seq_len, encoding_size) (e.g. from CausalCNNEncoder.forward_seq with a sliding_gap), and
+        returns the risk at every time step for all samples, of shape (num_samples, seq_len) (or (num_samples, seq_len, n_classes), with a softmax).
+        Samples are processed batch_size at a time. If lengths is given, the left padding of each sample is skipped (see forward).'''
+        risks = []
+        with torch.no_grad():
+            for start in range(0, len(encodings), batch_size):
+                batch_lengths = lengths[start:start+batch_size] if lengths is not None else None
+                preds = self.forward(encodings[start:start+batch_size], return_full_seq=True, lengths=batch_lengths)
+                risks.append(torch.sigmoid(preds) if self.n_classes == 1 else torch.softmax(preds, dim=-1))
+        return torch.cat(risks)
 
         
 
@@ -1450,6 +1709,44 @@ class Chomp1d(torch.nn.Module):
         return x[:, :, :-self.chomp_size]
 
 
+class LeftPaddedConv1d(torch.nn.Conv1d):
+    """
+    Causal one-dimensional convolution that only pads its input on the left, by
+    `left_padding` zeros, so that no output past the end of the input is
+    computed (contrary to a convolution padded on both sides followed by a
+    Chomp1d). Used by CausalConvolutionBlock.freeze_for_inference.
+    @param left_padding Number of zeros added before the input.
+    @param groups Number of blocked connections from input to output channels,
+           as in torch.nn.Conv1d.
+    """
+    def __init__(self, in_channels, out_channels, kernel_size, dilation, left_padding, bias=True, groups=1):
+        super(LeftPaddedConv1d, self).__init__(
+            in_channels, out_channels, kernel_size, dilation=dilation, bias=bias,
+            groups=groups
+        )
+        self.left_padding = left_padding
+
+    @classmethod
+    def from_conv(cls, conv, left_padding):
+        """
+        Returns a LeftPaddedConv1d with the (plain, not weight normalized)
+        weights of `conv`.
+        """
+        left_padded_conv = cls(
+            conv.in_channels, conv.out_channels, conv.kernel_size[0],
+            conv.dilation[0], left_padding, bias=conv.bias is not None,
+            groups=conv.groups
+        ).to(conv.weight.device)
+        with torch.no_grad():
+            left_padded_conv.weight.copy_(conv.weight)
+            if conv.bias is not None:
+                left_padded_conv.bias.copy_(conv.bias)
+        return left_padded_conv
+
+    def forward(self, x):
+        return super(LeftPaddedConv1d, self).forward(F.pad(x, (self.left_padding, 0)))
+
+
 class SqueezeChannels(torch.nn.Module):
     """
     Squeezes, in a three-dimensional tensor, the third dimension.
@@ -1512,6 +1809,31 @@ class CausalConvolutionBlock(torch.nn.Module):
         # Final activation function
         self.relu = torch.nn.LeakyReLU() if final else None
 
+    def freeze_for_inference(self):
+        """
+        Replaces, in place, the weight normalized convolutions by plain
+        convolutions with the folded weights, padded on the left only (so the
+        Chomp1d layers are removed), and makes the activations in place. The
+        outputs are unchanged, but the block can't be trained anymore.
+        """
+        layers = []
+        for layer in self.causal:
+            if isinstance(layer, Chomp1d):
+                continue
+            elif isinstance(layer, LeftPaddedConv1d): # Already frozen
+                layers.append(layer)
+            elif isinstance(layer, torch.nn.Conv1d):
+                if hasattr(layer, 'weight_g'):
+                    torch.nn.utils.remove_weight_norm(layer) # Folds weight_g * weight_v / ||weight_v|| into weight
+                padding = (layer.kernel_size[0] - 1) * layer.dilation[0]
+                layers.append(LeftPaddedConv1d.from_conv(layer, padding))
+            elif isinstance(layer, torch.nn.LeakyReLU):
+                # Applied right after the convolution, on a tensor nothing else holds
+                layers.append(torch.nn.LeakyReLU(layer.negative_slope, inplace=True))
+            else:
+                layers.append(layer)
+        self.causal = torch.nn.Sequential(*layers)
+
     def forward(self, x):
         out_causal = self.causal(x)
         res = x if self.upordownsample is None else self.upordownsample(x)
@@ -1595,6 +1917,9 @@ class CausalCNNEncoder(torch.nn.Module):
         ).to(device)
 
         self.window_size = window_size
+        self.channels = channels
+        self.depth = depth
+        self.memory_budget = 2**28 # Approximate number of bytes forward_seq lets a chunk of windows take
         self.pruning_mask = torch.ones(self.encoding_size).bool() # This will be used to prune encoding dimensions that 
         self.pruned_encoding_size = int(torch.sum(self.pruning_mask))
         
@@ -1618,66 +1943,179 @@ class CausalCNNEncoder(torch.nn.Module):
         else:
             return self.network(x)
 
-    def forward_seq(self, x, return_encoding_mask=False, sliding_gap=None, return_pruned=True):
+    def _encode_windows(self, windows, return_pruned=True):
+        '''Encodes windows of shape (num_windows, num_channels*num_features, window_size). Unlike forward, a batch of exactly 2
+        windows isn't mistaken for a single sample with maps.'''
+        encodings = self.network(windows.to(self.device))
+        return encodings[:, self.pruning_mask] if return_pruned else encodings
+
+    def forward_seq(self, x, return_encoding_mask=False, sliding_gap=None, return_pruned=True, skip_imputed=False, packed=False, memory_budget=None):
         '''Takes a tensor of shape (num_samples, 2, num_features, seq_len) of timeseries data.
         
-        Returns a tensor of shape (num_samples, seq_len/winow_size, encoding_size)'''
+        Returns a tensor of shape (num_samples, seq_len/winow_size, encoding_size)
+        
+        If skip_imputed is True, windows whose last time step was fully imputed (the ones marked -1 in the encoding mask)
+        are not passed through the encoder at all. Their rows in the output are filled with zeros, or if packed is True, only
+        the encodings of the kept windows are returned as a tensor of shape (num_kept_windows, encoding_size), in the same
+        order as encoding_mask.reshape(-1,) != -1. This has no effect when maps aren't included in x.
+        
+        Windows are taken from an unfold view of x and encoded in chunks, so that the windows (and the causal CNN activations)
+        passed to the encoder at once take roughly at most memory_budget bytes (defaults to self.memory_budget).'''
         assert x.shape[-1] % self.window_size == 0
         if len(tuple(x.shape)) == 3 and x.shape[1] == 2: # If a 3D tensor with maps is passed in, add a new dimension of size 1 to make it a batch of size 1
             x = torch.unsqueeze(x, 0)
 
-        if sliding_gap:
-            # This is a tensor of indices. If the data is of shape (num_samples, 2, num_features, 10), and window_size = 4 and sliding_gap=2, then inds is an array
-            # of [0, 1, 2, 3, 2, 3, 4, 5, 4, 5, 6, 7, 6, 7, 8, 9]
-            inds = torch.cat([torch.arange(ind, ind+self.window_size) for ind in range(0, x.shape[-1]-self.window_size+1, sliding_gap)])
-            
-            # Now for each sample we have the window_size windows concatenated for each sliding gap on the last axis.
-            # So if window_size is 120 and sliding_gap is 20, then for each sample, the time dimension will go 
-            # [0, 1, 2, ..., 119, 20, 21, ..., 139, 140, ...]
-            x = torch.index_select(input=x, dim=3, index=inds)
-
-        if return_encoding_mask:
-            if x.shape[1] == 2:
-                encoding_mask  = torch.sum(x[:, 1, :, :]==0, dim=1) # Of shape (num_samples, seq_len). the ij'th element is = num_features if that time step was fully imputed, <num_features otherwise
-                encoding_mask[torch.where(encoding_mask < x.shape[2])] = 0 # Of shape (num_samples, seq_len). the ij'th element is = num_features if that time step was fully imputed, 0 otherwise
-                encoding_mask = encoding_mask[:, self.window_size-1::self.window_size] # Of shape (num_samples, seq_len/self.window_size). On the second dim, only keeps every self.window_size'th element
-                encoding_mask[encoding_mask == x.shape[2]] = -1 # Now the ij'th element is -1 if the j'th encoding from sample i was derived from fully imputed data. 0 otherwise
+        # With sliding_gap, window j of a sample covers time steps [j*sliding_gap, j*sliding_gap + window_size). Without it, the
+        # windows don't overlap. E.g. if seq_len = 10, window_size = 4 and sliding_gap=2, the windows start at 0, 2, 4 and 6.
+        window_gap = sliding_gap if sliding_gap else self.window_size
+        num_samples, seq_len = x.shape[0], x.shape[-1]
+        num_windows = (seq_len - self.window_size)//window_gap + 1
+
+        has_maps = len(tuple(x.shape)) == 4 and x.shape[1] == 2
+        if return_encoding_mask or (skip_imputed and has_maps):
+            if has_maps:
+                fully_imputed = torch.all(x[:, 1, :, :]==0, dim=1) # Of shape (num_samples, seq_len). the ij'th element is True if that time step was fully imputed
+                encoding_mask = torch.zeros(num_samples, num_windows, dtype=torch.long, device=x.device)
+                # Only the last time step of each window is checked. Now the ij'th element is -1 if the j'th encoding from sample i was derived from fully imputed data. 0 otherwise
+                encoding_mask[fully_imputed[:, self.window_size-1::window_gap]] = -1
             else:
-                encoding_mask = torch.ones(x.shape[0], x.shape[-1]//self.window_size)
-        
-        if len(tuple(x.shape)) == 4:
-            num_samples, num_channels, num_features, seq_len = x.shape
-            #print('entering forward_seq!')
-            #print('num_samples, two, num_features, seq_len', num_samples, two, num_features, seq_len)
-            x = torch.reshape(x, (num_samples, num_features*num_channels, seq_len)) # now x is of shape (num_samples, num_channels*num_features, seq_len)
-            #print(x.shape, '==', num_samples, 2*num_features, seq_len)
-            x = x.permute(1, 0, 2)
-            x = x.reshape(num_channels*num_features, -1) # Now of shape (2*num_features, num_samples*seq_len)
-            #print(x.shape, '==', 2*num_features, num_samples*seq_len)
-            x = torch.stack(torch.split(x, self.window_size, dim=1)) # Now of shape (num_samples*(seq_len/window_size), num_channels*num_features, window_size)
-            #print(x.shape, '==', num_samples*(seq_len/self.window_size), num_channels*num_features, self.window_size)
-
-            encodings = self.forward(x, return_pruned=return_pruned) # encodings is of shape (num_samples*(seq_len/window_size), encoding_size)
-            #print(encodings.shape, '==', num_samples*(seq_len/self.window_size), self.pruned_encoding_size)
-            encodings = encodings.reshape(num_samples, int(seq_len/self.window_size), self.pruned_encoding_size)
-        
-        elif len(tuple(x.shape)) == 3:
-            num_samples, num_features, seq_len = x.shape
-            x = x.permute(1, 0, 2)
-            x = x.reshape(num_features, -1) # Now of shape (num_features, num_samples*seq_len)
-            #print(x.shape, '==', 2*num_features, num_samples*seq_len)
-            x = torch.stack(torch.split(x, self.window_size, dim=1)) # Now of shape (num_samples*(seq_len/window_size), num_features, window_size)
-            
+                encoding_mask = torch.ones(num_samples, num_windows)
+        
+        encoding_size = self.pruned_encoding_size if return_pruned else self.encoding_size
+        if skip_imputed and has_maps:
+            # Only the windows that have at least one observation on their last time step get encoded. Fully imputed windows
+            # (e.g. the left padding of HiRID patients) never go through the causal CNN.
+            window_inds = torch.where(encoding_mask.reshape(-1,) != -1)[0]
+        else:
+            window_inds = torch.arange(num_samples*num_windows, device=x.device)
+        
+        window_rows = x[0, ..., 0].numel() # num_channels*num_features (or num_features if maps aren't included)
+        windows_per_chunk = self._windows_per_chunk(window_rows, x.element_size(), memory_budget)
 
-            encodings = self.forward(x, return_pruned=return_pruned) # encodings is of shape (num_samples*(seq_len/window_size), encoding_size)
-            #print(encodings.shape, '==', num_samples*(seq_len/self.window_size), self.pruned_encoding_size)
-            encodings = encodings.reshape(num_samples, int(seq_len/self.window_size), self.pruned_encoding_size)
+        if not sliding_gap and len(window_inds) == num_samples*num_windows and len(window_inds) <= windows_per_chunk:
+            # Non overlapping windows that all fit in one chunk. x is of shape (num_samples, num_channels, num_features, seq_len) or (num_samples, num_features, seq_len)
+            x = x.reshape(num_samples, window_rows, num_windows, self.window_size)
+            x = x.permute(0, 2, 1, 3).reshape(num_samples*num_windows, window_rows, self.window_size) # Now of shape (num_samples*(seq_len/window_size), num_channels*num_features, window_size)
+            kept_encodings = self._encode_windows(x, return_pruned=return_pruned) # of shape (num_samples*(seq_len/window_size), encoding_size)
+        else:
+            # View of shape (num_samples, num_windows, num_channels, num_features, window_size), nothing is copied until a chunk of windows is indexed
+            window_view = torch.movedim(x.unfold(-1, self.window_size, window_gap), -2, 1)
+            kept_encodings = []
+            for chunk in torch.split(window_inds, windows_per_chunk):
+                windows = window_view[chunk//num_windows, chunk%num_windows].reshape(len(chunk), window_rows, self.window_size)
+                kept_encodings.append(self._encode_windows(windows, return_pruned=return_pruned))
+            kept_encodings = torch.cat(kept_encodings) if kept_encodings else torch.zeros(0, encoding_size, device=self.device) # of shape (num_kept_windows, encoding_size)
+        
+        if packed:
+            encodings = kept_encodings
+        elif len(kept_encodings) == num_samples*num_windows:
+            encodings = kept_encodings.reshape(num_samples, num_windows, encoding_size)
+        else:
+            # Scatter the kept encodings back, fully imputed windows are left as zeros
+            encodings = torch.zeros(num_samples*num_windows, encoding_size, dtype=kept_encodings.dtype, device=kept_encodings.device)
+            encodings[window_inds.to(encodings.device)] = kept_encodings
+            encodings = encodings.reshape(num_samples, num_windows, encoding_size)
         
         if return_encoding_mask:
             return encodings, encoding_mask
         else:
             return encodings
 
+    def _windows_per_chunk(self, window_rows, element_size, memory_budget=None):
+        '''Number of windows forward_seq passes to the encoder at once. Each window costs its own input plus roughly four
+        tensors of size (channels, window_size) per causal convolution block kept alive by the network.'''
+        memory_budget = self.memory_budget if memory_budget is None else memory_budget
+        window_bytes = element_size*self.window_size*(window_rows + 4*self.channels*(self.depth + 1))
+        return max(1, int(memory_budget // window_bytes))
+
+    def freeze_for_inference(self, example_input=None, tolerance=1e-5):
+        '''Folds the weight norm of every causal convolution into plain convolution weights and switches them to left only
+        padding, so that no output is computed and then chomped (see CausalConvolutionBlock.freeze_for_inference). The encoder
+        is put in eval mode and can't be trained afterwards. Its state dict has plain convolution weights, so it can only be
+        loaded into another frozen encoder.
+
+        The encodings of example_input (of shape (batch_size, in_channels, window_size), random if not given) before and after
+        freezing are compared, and a ValueError is raised if they differ by more than tolerance. Returns the max absolute difference.'''
+        self.eval()
+        if example_input is None:
+            in_channels = self.network[0].network[0].causal[0].in_channels
+            example_input = torch.randn(8, in_channels, self.window_size)
+        example_input = example_input.to(self.device)
+        with torch.no_grad():
+            reference_encodings = self.network(example_input)
+            for block in self.network[0].network:
+                block.freeze_for_inference()
+            max_diff = float(torch.max(torch.abs(self.network(example_input) - reference_encodings)))
+        if max_diff > tolerance:
+            raise ValueError('Frozen encoder differs from the training encoder by %.2e (tolerance %.2e)'%(max_diff, tolerance))
+        return max_diff
+
+    def receptive_field(self):
+        '''Number of time steps each output of the causal CNN depends on. Every causal convolution block applies two convolutions
+        with dilation 1, 2, 4, ..., and each of them looks (kernel_size - 1)*dilation steps further into the past.'''
+        receptive_field = 1
+        for block in self.network[0].network:
+            for layer in block.causal:
+                if isinstance(layer, torch.nn.Conv1d):
+                    receptive_field += (layer.kernel_size[0] - 1)*layer.dilation[0]
+        return receptive_field
+
+    def forward_seq_shared(self, x, sliding_gap=1, return_pruned=True, exact_head=False):
+        '''Sliding window encodings computed from a single pass of the causal CNN over the whole series.
+        
+        Takes a tensor of shape (num_samples, 2, num_features, seq_len) (or (num_samples, num_features, seq_len)) and returns a tensor
+        of shape (num_samples, num_windows, encoding_size), with the same windows as forward_seq(x, sliding_gap=sliding_gap).
+        
+        The adaptive max pool is replaced by a max over each window of the causal CNN outputs of the full series. The output at
+        time step t only depends on the last receptive_field() steps, so the first receptive_field() - 1 outputs of each window
+        also see data from before the window (where forward_seq would see zero padding), and only those can differ from the
+        exact encodings. If exact_head is True, these outputs are recomputed from the window alone (a receptive field reset),
+        which makes the encodings exact, at the cost of encoding receptive_field() - 1 steps per window instead of window_size.'''
+        assert x.shape[-1] % self.window_size == 0
+        if len(tuple(x.shape)) == 3 and x.shape[1] == 2: # If a 3D tensor with maps is passed in, add a new dimension of size 1 to make it a batch of size 1
+            x = torch.unsqueeze(x, 0)
+        window_gap = sliding_gap if sliding_gap else self.window_size
+        num_samples, seq_len = x.shape[0], x.shape[-1]
+        x = x.reshape(num_samples, -1, seq_len).to(self.device) # Now of shape (num_samples, num_channels*num_features, seq_len)
+
+        causal_cnn, linear = self.network[0], self.network[3]
+        features = causal_cnn(x) # of shape (num_samples, reduced_size, seq_len)
+        head_len = min(self.receptive_field() - 1, self.window_size)
+        if exact_head and head_len > 0:
+            # The outputs after the first head_len steps of a window only depend on data inside the window, so they are shared.
+            # The head of each window is encoded on its own, from the head_len first steps of the window.
+            features = torch.nn.functional.max_pool1d(features[:, :, head_len:], kernel_size=self.window_size-head_len, stride=window_gap) \
+                if head_len < self.window_size else None # of shape (num_samples, reduced_size, num_windows)
+            head_view = torch.movedim(x.unfold(-1, head_len, window_gap)[:, :, :(seq_len - self.window_size)//window_gap + 1], -2, 1) # of shape (num_samples, num_windows, num_channels*num_features, head_len)
+            num_windows = head_view.shape[1]
+            head_view = head_view.reshape(num_samples*num_windows, -1, head_len)
+            head_features = torch.cat([torch.amax(causal_cnn(chunk), dim=-1) for chunk in torch.split(head_view, self._windows_per_chunk(x.shape[1], x.element_size()))])
+            head_features = head_features.reshape(num_samples, num_windows, -1).permute(0, 2, 1)
+            features = head_features if features is None else torch.maximum(features, head_features)
+        else:
+            features = torch.nn.functional.max_pool1d(features, kernel_size=self.window_size, stride=window_gap) # of shape (num_samples, reduced_size, num_windows)
+
+        encodings = linear(features.permute(0, 2, 1)) # of shape (num_samples, num_windows, encoding_size)
+        if return_pruned:
+            return encodings[:, :, self.pruning_mask]
+        else:
+            return encodings
+
+    def shared_trunk_error(self, x, sliding_gap=1):
+        '''Compares forward_seq_shared (without exact_head) to the exact encodings of forward_seq on x.
+        
+        Returns a dictionary with the max and mean absolute difference, the max difference relative to the norm of the
+        exact encodings, and the fraction of encodings that are affected at all.'''
+        with torch.no_grad():
+            exact_encodings = self.forward_seq(x, sliding_gap=sliding_gap, return_pruned=False)
+            shared_encodings = self.forward_seq_shared(x, sliding_gap=sliding_gap, return_pruned=False)
+        abs_diff = torch.abs(exact_encodings - shared_encodings)
+        window_diff = torch.linalg.norm(exact_encodings - shared_encodings, dim=-1)
+        window_norm = torch.linalg.norm(exact_encodings, dim=-1)
+        return {'max_abs_diff': float(torch.max(abs_diff)), 'mean_abs_diff': float(torch.mean(abs_diff)),
+                'max_rel_diff': float(torch.max(window_diff/torch.clamp(window_norm, min=1e-12))),
+                'fraction_affected': float(torch.mean((window_diff > 1e-5*torch.clamp(window_norm, min=1)).float()))}
+
 
 
 
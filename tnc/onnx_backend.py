@@ -0,0 +1,233 @@
+"""
+ONNX export of the CausalCNNEncoder -> RnnPredictor pipeline, and an ONNX Runtime backend to run it on CPU.
+
+The encoder graph includes the forward_seq windowing (for the sliding_gap it was exported with) and the pruning of the
+encoding dimensions, so it maps data_maps of shape (batch_size, 2, num_features, seq_len) straight to encodings of shape
+(batch_size, num_windows, pruned_encoding_size). The predictor graph maps encodings to the RnnPredictor outputs at every
+window. Batch size and sequence length are dynamic axes of both graphs.
+
+OnnxEncoder and OnnxPredictor have the forward_seq / predict_trajectories interfaces of the torch models, so the bulk
+encoding and risk trajectory code (e.g. tnc.quantization.predict_risks) can run on either backend.
+
+The encoder graph gathers all the windows of its input at once. OnnxEncoder.forward_seq bounds the memory of each run the
+way CausalCNNEncoder.forward_seq bounds its chunks: it runs the graph on groups of samples, and on overlapping time
+segments of them when a single sample has too many windows. Each run then takes roughly at most memory_budget bytes.
+Callers running the graph directly (e.g. from another runtime) have to bound the number of windows per call themselves.
+"""
+
+import os
+import time
+import inspect
+import argparse
+import json
+import numpy as np
+import torch
+from tnc.streaming import load_risk_models
+
+
+class _ForwardSeqGraph(torch.nn.Module):
+    '''CausalCNNEncoder.forward_seq (without the encoding mask and skip_imputed), written with traceable operations only.'''
+    def __init__(self, encoder, sliding_gap=None):
+        super(_ForwardSeqGraph, self).__init__()
+        self.network = encoder.network
+        self.window_size = encoder.window_size
+        self.sliding_gap = sliding_gap if sliding_gap else encoder.window_size
+        self.register_buffer('pruned_dimensions', torch.where(encoder.pruning_mask.cpu())[0])
+
+    def forward(self, x):
+        # x is of shape (batch_size, 2, num_features, seq_len)
+        num_samples, seq_len = x.shape[0], x.shape[-1]
+        x = x.reshape(num_samples, -1, seq_len)
+        num_channels = x.shape[1]
+        # Gathered rather than unfolded, since Unfold can't be exported with a dynamic seq_len
+        window_starts = torch.arange(0, seq_len - self.window_size + 1, self.sliding_gap, device=x.device)
+        window_indices = window_starts.unsqueeze(1) + torch.arange(self.window_size, device=x.device).unsqueeze(0)
+        windows = x[:, :, window_indices] # of shape (batch_size, num_channels, num_windows, window_size)
+        windows = windows.permute(0, 2, 1, 3).reshape(-1, num_channels, self.window_size)
+        encodings = torch.index_select(self.network(windows), 1, self.pruned_dimensions)
+        return encodings.reshape(num_samples, -1, encodings.shape[-1])
+
+
+class _FullSeqPredictorGraph(torch.nn.Module):
+    def __init__(self, classifier):
+        super(_FullSeqPredictorGraph, self).__init__()
+        self.classifier = classifier
+
+    def forward(self, encodings):
+        return self.classifier(encodings, return_full_seq=True)
+
+
+def _onnx_export(model, example_input, path, input_name, output_name, dynamic_axes, opset_version):
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False # The TorchScript exporter, which doesn't need onnxscript
+    torch.onnx.export(model, (example_input,), path, input_names=[input_name], output_names=[output_name],
+                      dynamic_axes=dynamic_axes, opset_version=opset_version, **kwargs)
+
+
+def _set_metadata(path, metadata):
+    import onnx
+    model = onnx.load(path)
+    onnx.helper.set_model_props(model, {key: json.dumps(value) for key, value in metadata.items()})
+    onnx.save(model, path)
+
+
+def export_onnx(encoder, classifier, output_dir, sliding_gap=None, opset_version=13):
+    '''Writes encoder.onnx and predictor.onnx to output_dir. The encoder is frozen for inference (in place) before it is
+    exported, see CausalCNNEncoder.freeze_for_inference. Returns the paths of the two graphs.'''
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    encoder.freeze_for_inference()
+    classifier.eval()
+    num_features = encoder.network[0].network[0].causal[0].in_channels//2
+    sliding_gap = sliding_gap if sliding_gap else encoder.window_size
+
+    encoder_path = os.path.join(output_dir, 'encoder.onnx')
+    example_input = torch.randn(2, 2, num_features, 4*encoder.window_size, device=encoder.device)
+    with torch.no_grad():
+        _onnx_export(_ForwardSeqGraph(encoder, sliding_gap), example_input, encoder_path, 'data_maps', 'encodings',
+                     {'data_maps': {0: 'batch_size', 3: 'seq_len'}, 'encodings': {0: 'batch_size', 1: 'num_windows'}}, opset_version)
+    # The bytes each window takes in a run (see CausalCNNEncoder._windows_per_chunk), for OnnxEncoder's chunking
+    window_bytes = example_input.element_size()*encoder.window_size*(2*num_features + 4*encoder.channels*(encoder.depth + 1))
+    _set_metadata(encoder_path, {'window_size': encoder.window_size, 'sliding_gap': sliding_gap,
+                                 'pruned_encoding_size': encoder.pruned_encoding_size, 'num_features': num_features,
+                                 'window_bytes': window_bytes, 'memory_budget': encoder.memory_budget})
+
+    predictor_path = os.path.join(output_dir, 'predictor.onnx')
+    example_encodings = torch.randn(2, 4, encoder.pruned_encoding_size, device=next(classifier.parameters()).device)
+    with torch.no_grad():
+        _onnx_export(_FullSeqPredictorGraph(classifier), example_encodings, predictor_path, 'encodings', 'predictions',
+                     {'encodings': {0: 'batch_size', 1: 'num_windows'}, 'predictions': {0: 'batch_size', 1: 'num_windows'}}, opset_version)
+    _set_metadata(predictor_path, {'n_classes': classifier.n_classes})
+    return encoder_path, predictor_path
+
+
+def _inference_session(path, intra_op_num_threads=None):
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    if intra_op_num_threads:
+        options.intra_op_num_threads = intra_op_num_threads
+    session = onnxruntime.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+    metadata = {key: json.loads(value) for key, value in session.get_modelmeta().custom_metadata_map.items()}
+    return session, metadata
+
+
+class OnnxEncoder():
+    '''Runs an encoder graph written by export_onnx under ONNX Runtime (on CPU), with intra_op_num_threads threads
+    (ONNX Runtime's default if None). Each run of the graph takes roughly at most memory_budget bytes (defaults to the
+    memory_budget of the exported encoder). Graphs exported without the window_bytes metadata are run on whole batches.'''
+    def __init__(self, path, intra_op_num_threads=None, memory_budget=None):
+        self.session, metadata = _inference_session(path, intra_op_num_threads)
+        self.window_size = metadata['window_size']
+        self.sliding_gap = metadata['sliding_gap']
+        self.pruned_encoding_size = metadata['pruned_encoding_size']
+        self.window_bytes = metadata.get('window_bytes')
+        self.memory_budget = memory_budget if memory_budget is not None else metadata.get('memory_budget')
+
+    def _run(self, x):
+        return torch.from_numpy(self.session.run(None, {'data_maps': x.numpy()})[0])
+
+    def forward_seq(self, x, sliding_gap=None):
+        '''Same as CausalCNNEncoder.forward_seq(x, sliding_gap=sliding_gap) for x of shape (num_samples, 2, num_features, seq_len).
+        The windows are the ones of the sliding_gap the graph was exported with.'''
+        sliding_gap = sliding_gap if sliding_gap else self.window_size
+        if sliding_gap != self.sliding_gap:
+            raise ValueError('The ONNX encoder was exported with sliding_gap=%d, not %d'%(self.sliding_gap, sliding_gap))
+        if len(tuple(x.shape)) == 3 and x.shape[1] == 2: # A single sample with maps
+            x = x.unsqueeze(0)
+        x = x.detach().cpu().float()
+        num_samples, seq_len = x.shape[0], x.shape[-1]
+        num_windows = (seq_len - self.window_size)//self.sliding_gap + 1
+        if self.window_bytes is None or self.memory_budget is None or num_samples*num_windows*self.window_bytes <= self.memory_budget:
+            return self._run(x)
+
+        windows_per_run = max(1, int(self.memory_budget // self.window_bytes))
+        samples_per_run = max(1, windows_per_run//num_windows)
+        windows_per_segment = min(num_windows, max(1, windows_per_run//samples_per_run))
+        encodings = []
+        for samples in torch.split(x, samples_per_run):
+            # Windows [first, first + num_segment_windows) only depend on the time steps they cover, so a segment of the series is encoded on its own
+            segments = []
+            for first in range(0, num_windows, windows_per_segment):
+                num_segment_windows = min(windows_per_segment, num_windows - first)
+                start = first*self.sliding_gap
+                segments.append(self._run(samples[..., start:start + (num_segment_windows - 1)*self.sliding_gap + self.window_size].contiguous()))
+            encodings.append(torch.cat(segments, dim=1))
+        return torch.cat(encodings)
+
+
+class OnnxPredictor():
+    '''Runs a predictor graph written by export_onnx under ONNX Runtime (on CPU).'''
+    def __init__(self, path, intra_op_num_threads=None):
+        self.session, metadata = _inference_session(path, intra_op_num_threads)
+        self.n_classes = metadata['n_classes']
+
+    def __call__(self, x, return_full_seq=False):
+        preds = torch.from_numpy(self.session.run(None, {'encodings': x.detach().cpu().float().numpy()})[0])
+        return preds if return_full_seq else preds[:, -1]
+
+    def predict_trajectories(self, encodings, batch_size=512):
+        '''Same as RnnPredictor.predict_trajectories (without lengths).'''
+        risks = []
+        for start in range(0, len(encodings), batch_size):
+            preds = self(encodings[start:start+batch_size], return_full_seq=True)
+            risks.append(torch.sigmoid(preds) if self.n_classes == 1 else torch.softmax(preds, dim=-1))
+        return torch.cat(risks)
+
+
+def load_onnx_risk_models(output_dir, intra_op_num_threads=None):
+    return (OnnxEncoder(os.path.join(output_dir, 'encoder.onnx'), intra_op_num_threads),
+            OnnxPredictor(os.path.join(output_dir, 'predictor.onnx'), intra_op_num_threads))
+
+
+def risk_trajectories(encoder, classifier, data_maps, sliding_gap=None, batch_size=64):
+    '''Risk at every window of each sample of data_maps (of shape (num_samples, 2, num_features, seq_len)), with either the
+    torch models or the ONNX Runtime ones. Returns a tensor of shape (num_samples, num_windows) (or (num_samples, num_windows, n_classes)).'''
+    risks = []
+    with torch.no_grad():
+        for batch in torch.split(data_maps, batch_size):
+            risks.append(classifier.predict_trajectories(encoder.forward_seq(batch, sliding_gap=sliding_gap).cpu(), batch_size=batch_size))
+    return torch.cat(risks)
+
+
+def compare_backends(encoder, classifier, onnx_encoder, onnx_predictor, data_maps, sliding_gap=None, batch_size=64, num_repeats=3):
+    '''Parity and throughput (samples/sec) of the risk trajectories computed with the torch models and with ONNX Runtime.'''
+    torch_risks = risk_trajectories(encoder, classifier, data_maps, sliding_gap, batch_size)
+    onnx_risks = risk_trajectories(onnx_encoder, onnx_predictor, data_maps, sliding_gap, batch_size)
+    report = {'max_abs_diff': float(torch.max(torch.abs(torch_risks - onnx_risks)))}
+    for name, (backend_encoder, backend_classifier) in [('torch', (encoder, classifier)), ('onnxruntime', (onnx_encoder, onnx_predictor))]:
+        start = time.perf_counter()
+        for _ in range(num_repeats):
+            risk_trajectories(backend_encoder, backend_classifier, data_maps, sliding_gap, batch_size)
+        report[name] = len(data_maps)*num_repeats/(time.perf_counter() - start)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports the encoder and RnnPredictor to ONNX and compares ONNX Runtime to PyTorch')
+    parser.add_argument('--encoder_checkpoint', type=str, default=None, help='Randomly initialized models are used if not given.')
+    parser.add_argument('--classifier_checkpoint', type=str, default=None)
+    parser.add_argument('--output_dir', type=str, default='./ckpt/onnx')
+    parser.add_argument('--sliding_gap', type=int, default=None)
+    parser.add_argument('--intra_op_num_threads', type=int, default=None)
+    parser.add_argument('--data_maps', type=str, default=None, help='e.g. hirid_numpy/TEST_mortality_data_maps.npy. Random data if not given.')
+    parser.add_argument('--num_samples', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=64)
+    args = parser.parse_args()
+
+    encoder, classifier = load_risk_models(args.encoder_checkpoint, args.classifier_checkpoint)
+    export_onnx(encoder, classifier, args.output_dir, sliding_gap=args.sliding_gap)
+    onnx_encoder, onnx_predictor = load_onnx_risk_models(args.output_dir, args.intra_op_num_threads)
+
+    if args.data_maps is not None:
+        data_maps = torch.from_numpy(np.asarray(np.load(args.data_maps, mmap_mode='r')[0:args.num_samples])).float()
+    else:
+        num_features = encoder.network[0].network[0].causal[0].in_channels//2
+        data_maps = torch.randn(args.num_samples, 2, num_features, 96*encoder.window_size)
+        data_maps[:, 1] = (torch.rand(args.num_samples, num_features, data_maps.shape[-1]) > 0.5).float()
+    if args.intra_op_num_threads:
+        torch.set_num_threads(args.intra_op_num_threads)
+
+    report = compare_backends(encoder, classifier, onnx_encoder, onnx_predictor, data_maps, args.sliding_gap, args.batch_size)
+    print('Risk trajectories of %d samples of length %d: max abs difference between PyTorch and ONNX Runtime %.2e'%(len(data_maps), data_maps.shape[-1], report['max_abs_diff']))
+    print('    PyTorch: %.1f samples/sec, ONNX Runtime: %.1f samples/sec (%.2fx)'%(report['torch'], report['onnxruntime'], report['onnxruntime']/report['torch']))
@@ -0,0 +1,191 @@
+"""
+Linear probe evaluation of an encoder: a quick alternative to training an RnnPredictor for hundreds of epochs.
+
+The encodings of each patient (from forward_seq) are pooled into a single vector, using only the windows that aren't
+masked (the ones whose last time step has at least one observation, as in CausalCNNEncoder.forward_seq's encoding mask):
+'last' takes the last of them, 'mean' and 'max' pool over all of them. A binary or multinomial logistic regression is fit
+on the standardized pooled encodings with full batch LBFGS, in torch or with sklearn (both minimize the objective of
+sklearn's LogisticRegression with an L2 penalty of strength 1/C), and the AUROC/AUPRC are those of tnc.tasks' heads.
+
+Running this file probes the encoder of a checkpoint on the HiRID tasks.
+"""
+
+import time
+import argparse
+import numpy as np
+import torch
+from tnc.tasks import EncodingSource, BinaryHead, MulticlassHead, hirid_tasks, format_metrics
+from tnc.quantization import load_float_encoder
+
+
+def window_mask(data_maps, window_size, sliding_gap=None):
+    '''Of shape (num_samples, num_windows), True for the windows whose last time step isn't fully imputed. All True if
+    data_maps (of shape (num_samples, 2, num_features, seq_len) with maps, or without maps) don't include the maps.'''
+    window_gap = sliding_gap if sliding_gap else window_size
+    num_windows = (data_maps.shape[-1] - window_size)//window_gap + 1
+    if len(tuple(data_maps.shape)) != 4 or data_maps.shape[1] != 2:
+        return torch.ones(data_maps.shape[0], num_windows, dtype=torch.bool)
+    last_steps = data_maps[:, 1, :, window_size-1::window_gap][..., :num_windows]
+    last_steps = torch.as_tensor(np.asarray(last_steps))
+    return torch.any(last_steps != 0, dim=1)
+
+
+def pool_encodings(encodings, mask, pooling='last'):
+    '''Pools encodings of shape (num_samples, num_windows, encoding_size) over the windows where mask (of shape
+    (num_samples, num_windows)) is True. Samples without any such window get zeros.'''
+    mask = mask.to(encodings.device)
+    has_window = torch.any(mask, dim=1, keepdim=True)
+    if pooling == 'last':
+        # Index of the last unmasked window of each sample (0 if there is none)
+        positions = torch.arange(mask.shape[1], device=mask.device).unsqueeze(0).expand_as(mask)
+        last = torch.max(torch.where(mask, positions, torch.zeros_like(positions)), dim=1)[0]
+        pooled = encodings[torch.arange(len(encodings), device=encodings.device), last]
+    elif pooling == 'mean':
+        weights = mask.unsqueeze(-1).to(encodings.dtype)
+        pooled = torch.sum(encodings*weights, dim=1)/torch.clamp(torch.sum(weights, dim=1), min=1)
+    elif pooling == 'max':
+        pooled = torch.max(encodings.masked_fill(~mask.unsqueeze(-1), -np.inf), dim=1)[0]
+    else:
+        raise ValueError('Unknown pooling %s'%pooling)
+    return torch.where(has_window, pooled, torch.zeros_like(pooled))
+
+
+def encode_and_pool(encoder, data_maps, pooling='last', batch_size=64, device='cpu', indices=None):
+    '''Pooled encodings of shape (num_samples, encoding_size) of data_maps (a tensor or a, possibly memory mapped, numpy array),
+    or of its rows indices if given (one batch of them is copied at a time).'''
+    pooled = []
+    num_samples = len(data_maps) if indices is None else len(indices)
+    with torch.no_grad():
+        for start in range(0, num_samples, batch_size):
+            rows = slice(start, start+batch_size) if indices is None else np.asarray(indices[start:start+batch_size])
+            batch = torch.as_tensor(np.array(data_maps[rows])).float()
+            encodings = encoder.forward_seq(batch.to(device)).cpu()
+            pooled.append(pool_encodings(encodings, window_mask(batch, encoder.window_size), pooling))
+    return torch.cat(pooled)
+
+
+class LinearProbe():
+    '''
+    Logistic regression on standardized features, binary (n_classes=1, probabilities of shape (num_samples,)) or multinomial
+    (probabilities of shape (num_samples, n_classes)). Minimizes the mean cross entropy + ||W||^2/(2*C*num_samples), i.e.
+    the objective of sklearn's LogisticRegression(C=C), with full batch LBFGS in torch ('torch') or with sklearn ('sklearn').
+    '''
+    def __init__(self, n_classes=1, C=1.0, max_iter=200, backend='torch'):
+        if backend not in ['torch', 'sklearn']:
+            raise ValueError('Unknown backend %s'%backend)
+        self.n_classes = n_classes
+        self.C = C
+        self.max_iter = max_iter
+        self.backend = backend
+
+    def _standardize(self, features):
+        return (features.double() - self.mean)/self.std
+
+    def fit(self, features, labels):
+        self.mean = torch.mean(features.double(), dim=0)
+        self.std = torch.clamp(torch.std(features.double(), dim=0), min=1e-8)
+        x = self._standardize(features)
+        labels = torch.as_tensor(labels)
+        if self.backend == 'sklearn':
+            from sklearn.linear_model import LogisticRegression
+            model = LogisticRegression(C=self.C, max_iter=self.max_iter).fit(x.numpy(), labels.numpy())
+            self.weight = torch.from_numpy(model.coef_.T.copy())
+            self.bias = torch.from_numpy(model.intercept_.copy())
+            if self.n_classes > 1 and len(model.classes_) != self.n_classes:
+                raise ValueError('Only %d of the %d classes are in the training labels'%(len(model.classes_), self.n_classes))
+            return self
+        num_outputs = self.n_classes if self.n_classes > 1 else 1
+        self.weight = torch.zeros(x.shape[1], num_outputs, dtype=torch.float64, requires_grad=True)
+        self.bias = torch.zeros(num_outputs, dtype=torch.float64, requires_grad=True)
+        optimizer = torch.optim.LBFGS([self.weight, self.bias], lr=1, max_iter=self.max_iter, tolerance_grad=1e-6,
+                                      tolerance_change=1e-10, history_size=20, line_search_fn='strong_wolfe')
+        def closure():
+            optimizer.zero_grad()
+            logits = x@self.weight + self.bias
+            if num_outputs == 1:
+                loss = torch.nn.functional.binary_cross_entropy_with_logits(logits[:, 0], labels.double())
+            else:
+                loss = torch.nn.functional.cross_entropy(logits, labels.long())
+            loss = loss + torch.sum(self.weight**2)/(2*self.C*len(x))
+            loss.backward()
+            return loss
+        optimizer.step(closure)
+        self.weight, self.bias = self.weight.detach(), self.bias.detach()
+        return self
+
+    def predict_proba(self, features):
+        logits = self._standardize(features)@self.weight + self.bias
+        if logits.shape[1] == 1:
+            return torch.sigmoid(logits[:, 0]).float()
+        return torch.softmax(logits, dim=1).float()
+
+
+def probe_metrics(probe, features, labels):
+    '''AUROC/AUPRC (and accuracy for multiclass probes) of the probe's predictions, see tnc.tasks.BinaryHead.metrics and
+    MulticlassHead.metrics.'''
+    head = BinaryHead() if probe.n_classes == 1 else MulticlassHead(probe.n_classes)
+    return head.metrics(np.asarray(labels), probe.predict_proba(features).numpy())
+
+
+def sample_labels(y):
+    '''Per sample labels: the labels of y of shape (num_samples,), or for per time step labels of shape (num_samples,
+    seq_len), 1 if any time step is positive (as in tnc.py's HiRID mortality classifier).'''
+    y = torch.as_tensor(np.asarray(y))
+    return (torch.sum(y == 1, dim=1) > 0).float() if y.dim() == 2 else y
+
+
+def linear_probe(encoder, X_train, y_train, X_validation, y_validation, X_TEST, y_TEST, pooling='last', n_classes=1, C=1.0,
+                 max_iter=200, backend='torch', batch_size=64, device='cpu', train_indices=None, validation_indices=None):
+    '''
+    Fits a linear probe on the pooled encodings of X_train and returns its metrics on X_validation and X_TEST, as
+    (validation_metrics, TEST_metrics) dicts. X_* are of shape (num_samples, 2, num_features, seq_len), y_* are per sample
+    or per time step labels (see sample_labels). If train_indices (validation_indices) is given, only these rows of X_train
+    and y_train (X_validation and y_validation) are used, as in tnc.tnc.train_linear_classifier.
+    '''
+    encoder.eval()
+    splits = [('train', X_train, y_train, train_indices), ('validation', X_validation, y_validation, validation_indices), ('TEST', X_TEST, y_TEST, None)]
+    features = {split: encode_and_pool(encoder, X, pooling, batch_size, device, indices) for split, X, _, indices in splits}
+    labels = {split: sample_labels(y if indices is None else y[np.asarray(indices)]) for split, _, y, indices in splits}
+    probe = LinearProbe(n_classes=n_classes, C=C, max_iter=max_iter, backend=backend).fit(features['train'], labels['train'])
+    return probe_metrics(probe, features['validation'], labels['validation']), probe_metrics(probe, features['TEST'], labels['TEST'])
+
+
+def probe_tasks(source, tasks, pooling='last', C=1.0, max_iter=200, backend='torch'):
+    '''Fits a linear probe per Task (see tnc.tasks.hirid_tasks) on its train split and returns the metrics of its other splits.'''
+    results = {}
+    for task in tasks:
+        features, labels = {}, {}
+        for split, (source_name, split_labels, rows) in task.splits.items():
+            encodings = source.encodings(source_name)[rows][:, task.encoding_slice]
+            data_maps = source.data_maps(source_name)
+            mask = torch.cat([window_mask(data_maps[start:start+1024], source.encoder.window_size)
+                              for start in range(0, len(data_maps), 1024)])[rows][:, task.encoding_slice]
+            features[split], labels[split] = pool_encodings(encodings, mask, pooling), split_labels
+        n_classes = task.head.n_classes if task.head.n_classes > 2 else 1 # Binary multiclass heads are probed as binary
+        probe = LinearProbe(n_classes=n_classes, C=C, max_iter=max_iter, backend=backend).fit(features['train'], labels['train'])
+        results[task.name] = {split: probe_metrics(probe, features[split], labels[split]) for split in task.splits if split != 'train'}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Linear probe evaluation of an encoder on the HiRID tasks')
+    parser.add_argument('--encoder_checkpoint', type=str, required=True)
+    parser.add_argument('--path', type=str, default='./hirid_numpy')
+    parser.add_argument('--tasks', type=str, nargs='+', default=['mortality', 'circulatory', 'apache'], choices=['mortality', 'circulatory', 'apache'])
+    parser.add_argument('--pooling', type=str, default='last', choices=['last', 'mean', 'max'])
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'sklearn'])
+    parser.add_argument('--C', type=float, default=1.0, help='Inverse of the L2 penalty strength, as in sklearn')
+    parser.add_argument('--max_iter', type=int, default=200)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    encoder, _ = load_float_encoder(args.encoder_checkpoint)
+    encoder.freeze_for_inference()
+    encoder.device = device
+    source = EncodingSource(encoder.to(device), device=device)
+    tasks = hirid_tasks(source, args.path, args.tasks, window_size=encoder.window_size)
+    start = time.time()
+    for task_name, splits in probe_tasks(source, tasks, args.pooling, args.C, args.max_iter, args.backend).items():
+        for split, metrics in splits.items():
+            print('%s %s: %s'%(split, task_name, format_metrics(metrics)))
+    print('Encoded and probed in %.1f seconds'%(time.time() - start))
@@ -0,0 +1,198 @@
+"""
+Int8 quantization of the CausalCNNEncoder and RnnPredictor for CPU serving and bulk encoding.
+
+The causal convolutions of each CausalConvolutionBlock are statically quantized (post training, calibrated on windows of
+train_encoder_data_maps), and the Linear and LSTM layers are dynamically quantized. The residual additions, the max pool
+and the final activations stay in float, between the quantized convolution stacks.
+
+Running this file quantizes the models of an encoder checkpoint and of the mortality and circulatory failure classifier
+checkpoints, reports the change in TEST AUROC/AUPRC and the throughput of both versions, and saves the quantized
+checkpoints, which load_risk_models (and so the streaming scorer and the risk server) load directly.
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score, precision_recall_curve, auc
+from tnc.models import CausalCNNEncoder, RnnPredictor, LeftPaddedConv1d
+from tnc.checkpoints import load_checkpoint
+
+
+def quantizable_encoder(encoder, backend='fbgemm'):
+    '''Freezes encoder (see CausalCNNEncoder.freeze_for_inference) and prepares it for static quantization, in place.
+    The causal convolutions of each block (and the residual 1x1 convolution) are wrapped between a QuantStub and a
+    DeQuantStub, and their left padding is made a separate ConstantPad1d layer so that they are plain Conv1d layers.
+    Returns the encoder, whose observers must be calibrated (by encoding some windows) before calling torch.quantization.convert.'''
+    encoder.freeze_for_inference()
+    torch.backends.quantized.engine = backend
+    qconfig = torch.quantization.get_default_qconfig(backend)
+    for block in encoder.network[0].network:
+        layers = []
+        for layer in block.causal:
+            if isinstance(layer, LeftPaddedConv1d):
+                conv = torch.nn.Conv1d(layer.in_channels, layer.out_channels, layer.kernel_size[0], dilation=layer.dilation[0])
+                conv.load_state_dict(layer.state_dict())
+                layers += [torch.nn.ConstantPad1d((layer.left_padding, 0), 0.), conv]
+            elif isinstance(layer, torch.nn.LeakyReLU):
+                layers.append(torch.nn.LeakyReLU(layer.negative_slope)) # The quantized leaky ReLU isn't in place
+            else:
+                layers.append(layer)
+        block.causal = torch.quantization.QuantWrapper(torch.nn.Sequential(*layers))
+        block.causal.qconfig = qconfig
+        if block.upordownsample is not None:
+            block.upordownsample = torch.quantization.QuantWrapper(block.upordownsample)
+            block.upordownsample.qconfig = qconfig
+    torch.quantization.prepare(encoder.network, inplace=True)
+    return encoder
+
+
+def quantize_encoder(encoder, calibration_data, batch_size=64, backend='fbgemm'):
+    '''Statically quantizes the convolutions of a CausalCNNEncoder, calibrated on calibration_data (of shape
+    (num_samples, 2, num_features, seq_len), e.g. a sample of train_encoder_data_maps), and dynamically quantizes its Linear
+    layer. encoder is modified in place (and moved to the CPU) and returned.'''
+    encoder.device = 'cpu'
+    encoder.to('cpu')
+    quantizable_encoder(encoder, backend)
+    with torch.no_grad():
+        for batch in torch.split(calibration_data, batch_size):
+            encoder.forward_seq(batch)
+    torch.quantization.convert(encoder.network, inplace=True)
+    torch.quantization.quantize_dynamic(encoder.network, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return encoder
+
+
+def quantize_predictor(classifier):
+    '''Dynamically quantizes the LSTM and Linear layers of an RnnPredictor, in place. Returns classifier.'''
+    classifier.to('cpu')
+    torch.quantization.quantize_dynamic(classifier, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return classifier
+
+
+def save_quantized_encoder(encoder, encoder_hyper_params, path):
+    state = {'encoder_state_dict': encoder.state_dict(),
+             'pruning_mask': encoder.pruning_mask,
+             'encoder_hyper_params': encoder_hyper_params,
+             'quantized': True,
+             'quantized_engine': torch.backends.quantized.engine}
+    torch.save(state, path)
+
+
+def save_quantized_predictor(classifier, path):
+    torch.save({'classifier_state_dict': classifier.state_dict(), 'n_classes': classifier.n_classes, 'quantized': True}, path)
+
+
+def load_quantized_encoder(checkpoint):
+    '''Builds a quantized CausalCNNEncoder from a checkpoint (dictionary) saved by save_quantized_encoder.'''
+    encoder = CausalCNNEncoder(**dict(checkpoint['encoder_hyper_params'], device='cpu'))
+    quantizable_encoder(encoder, checkpoint.get('quantized_engine', 'fbgemm'))
+    torch.quantization.convert(encoder.network, inplace=True)
+    torch.quantization.quantize_dynamic(encoder.network, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    encoder.load_state_dict(checkpoint['encoder_state_dict'])
+    encoder.pruning_mask = checkpoint['pruning_mask']
+    encoder.pruned_encoding_size = int(torch.sum(encoder.pruning_mask))
+    return encoder.eval()
+
+
+def load_quantized_predictor(checkpoint, encoding_size, hidden_size=8):
+    '''Builds a quantized RnnPredictor from a checkpoint (dictionary) saved by save_quantized_predictor.'''
+    classifier = quantize_predictor(RnnPredictor(encoding_size=encoding_size, hidden_size=hidden_size, n_classes=checkpoint.get('n_classes', 1)))
+    classifier.load_state_dict(checkpoint['classifier_state_dict'])
+    return classifier.eval()
+
+
+def predict_risks(encoder, classifier, data_maps, batch_size=64):
+    '''Risk of the positive class at the end of each sample of data_maps (of shape (num_samples, 2, num_features, seq_len)):
+    sigmoid of the output of a single output RnnPredictor, or the softmax probability of class 1 for a multi-class one.'''
+    risks = []
+    with torch.no_grad():
+        for batch in torch.split(data_maps, batch_size):
+            predictions = classifier(encoder.forward_seq(batch).cpu())
+            if classifier.n_classes == 1:
+                risks.append(torch.sigmoid(predictions).reshape(-1))
+            else:
+                risks.append(torch.softmax(predictions, dim=-1)[:, 1])
+    return torch.cat(risks)
+
+
+def compare_quantized(encoder, classifier, quantized_encoder, quantized_classifier, data_maps, labels, batch_size=64):
+    '''Returns a dictionary with the AUROC, AUPRC and throughput (samples/sec) of the float and quantized models on
+    (data_maps, labels), labels being 1 for the positive samples.'''
+    report = {}
+    for name, (report_encoder, report_classifier) in [('float', (encoder, classifier)), ('int8', (quantized_encoder, quantized_classifier))]:
+        predict_risks(report_encoder, report_classifier, data_maps[:batch_size], batch_size) # Warm up
+        start = time.perf_counter()
+        risks = predict_risks(report_encoder, report_classifier, data_maps, batch_size).numpy()
+        elapsed = time.perf_counter() - start
+        precision, recall, _ = precision_recall_curve(labels, risks)
+        report[name] = {'auroc': roc_auc_score(labels, risks), 'auprc': auc(recall, precision), 'samples_per_sec': len(data_maps)/elapsed}
+    return report
+
+
+def print_quantization_report(task, report):
+    print('%s TEST set:'%task)
+    for name, row in report.items():
+        print('    %-6s AUROC %.4f  AUPRC %.4f  %.1f samples/sec'%(name, row['auroc'], row['auprc'], row['samples_per_sec']))
+    print('    change: AUROC %+.4f  AUPRC %+.4f  throughput %.2fx'%(report['int8']['auroc'] - report['float']['auroc'],
+          report['int8']['auprc'] - report['float']['auprc'], report['int8']['samples_per_sec']/report['float']['samples_per_sec']))
+
+
+def load_float_encoder(encoder_checkpoint):
+    checkpoint = load_checkpoint(encoder_checkpoint, map_location='cpu')
+    encoder = CausalCNNEncoder(**dict(checkpoint['encoder_hyper_params'], device='cpu'))
+    encoder.load_state_dict(checkpoint['encoder_state_dict'])
+    encoder.pruning_mask = checkpoint['pruning_mask']
+    encoder.pruned_encoding_size = int(torch.sum(encoder.pruning_mask))
+    return encoder, checkpoint['encoder_hyper_params']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Int8 quantization of the encoder and risk predictors')
+    parser.add_argument('--encoder_checkpoint', type=str, required=True)
+    parser.add_argument('--mortality_classifier_checkpoint', type=str, default=None)
+    parser.add_argument('--circulatory_classifier_checkpoint', type=str, default=None)
+    parser.add_argument('--path', type=str, default='./hirid_numpy')
+    parser.add_argument('--num_calibration_samples', type=int, default=256)
+    parser.add_argument('--hidden_size', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--output_dir', type=str, default='./ckpt/quantized')
+    parser.add_argument('--backend', type=str, default='fbgemm', help='Quantized engine, e.g. fbgemm, x86 (newer versions of torch) or qnnpack (ARM).')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    train_encoder_data_maps = np.load(os.path.join(args.path, 'train_encoder_data_maps.npy'), mmap_mode='r')
+    calibration_inds = np.sort(np.random.RandomState(0).choice(len(train_encoder_data_maps), min(args.num_calibration_samples, len(train_encoder_data_maps)), replace=False))
+    calibration_data = torch.from_numpy(np.asarray(train_encoder_data_maps[calibration_inds])).float()
+
+    # The float encoder is compared as it is served, i.e. frozen
+    encoder, encoder_hyper_params = load_float_encoder(args.encoder_checkpoint)
+    encoder.freeze_for_inference()
+    quantized_encoder = quantize_encoder(load_float_encoder(args.encoder_checkpoint)[0], calibration_data, batch_size=args.batch_size, backend=args.backend)
+    save_quantized_encoder(quantized_encoder, encoder_hyper_params, os.path.join(args.output_dir, 'quantized_encoder_checkpoint.tar'))
+
+    tasks = []
+    if args.mortality_classifier_checkpoint is not None:
+        TEST_data_maps = torch.from_numpy(np.load(os.path.join(args.path, 'TEST_mortality_data_maps.npy'))).float()
+        TEST_labels = np.array([1 in label for label in torch.from_numpy(np.load(os.path.join(args.path, 'TEST_mortality_labels.npy')))])
+        tasks.append(('mortality', args.mortality_classifier_checkpoint, TEST_data_maps, TEST_labels))
+    if args.circulatory_classifier_checkpoint is not None:
+        # Same truncation as in circulatory_failure_prediction.py: the last 3 hrs of data are cut off
+        truncate_amt = 36
+        TEST_data_maps = torch.from_numpy(np.load(os.path.join(args.path, 'TEST_circulatory_data_maps.npy')))[:, :, :, :-truncate_amt].float()
+        TEST_labels = np.array([1 in label for label in torch.from_numpy(np.load(os.path.join(args.path, 'TEST_circulatory_labels.npy')))[:, truncate_amt:]])
+        tasks.append(('circulatory_failure', args.circulatory_classifier_checkpoint, TEST_data_maps, TEST_labels))
+
+    for task, classifier_checkpoint, TEST_data_maps, TEST_labels in tasks:
+        classifier_state_dict = load_checkpoint(classifier_checkpoint, map_location='cpu')['classifier_state_dict']
+        n_classes = classifier_state_dict[[key for key in classifier_state_dict if key.startswith('linear')][-1]].shape[0]
+        classifier = RnnPredictor(encoding_size=encoder.pruned_encoding_size, hidden_size=args.hidden_size, n_classes=n_classes)
+        classifier.load_state_dict(classifier_state_dict)
+        quantized_classifier = RnnPredictor(encoding_size=encoder.pruned_encoding_size, hidden_size=args.hidden_size, n_classes=n_classes)
+        quantized_classifier.load_state_dict(classifier_state_dict)
+        quantized_classifier = quantize_predictor(quantized_classifier.eval())
+        save_quantized_predictor(quantized_classifier, os.path.join(args.output_dir, 'quantized_%s_classifier_checkpoint.tar'%task))
+
+        print_quantization_report(task, compare_quantized(encoder, classifier.eval(), quantized_encoder, quantized_classifier, TEST_data_maps, TEST_labels, batch_size=args.batch_size))
@@ -0,0 +1,67 @@
+"""
+Load generator for tnc/risk_server.py. Replays HiRID data_maps (of shape (num_samples, 2, num_features, seq_len)) as if
+each sample was a bed sending one observation per time step, and prints the server's latency and throughput counters.
+"""
+
+import asyncio
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+
+async def replay_bed(patient_id, data_map, interval, open_connection):
+    reader, writer = await open_connection()
+    # Skips the left padding, i.e. the time steps before the first observation
+    observed = np.where(data_map[1].sum(axis=0) > 0)[0]
+    start = observed[0] if len(observed) else data_map.shape[-1]
+    num_risks = 0
+    for t in range(start, data_map.shape[-1]):
+        request = {'patient_id': patient_id, 'observation': data_map[:, :, t].tolist()}
+        writer.write((json.dumps(request) + '\n').encode())
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        num_risks += response.get('risk') is not None
+        if interval:
+            await asyncio.sleep(interval)
+
+    writer.write((json.dumps({'type': 'discharge', 'patient_id': patient_id}) + '\n').encode())
+    await writer.drain()
+    await reader.readline()
+    writer.close()
+    return data_map.shape[-1] - start, num_risks
+
+
+async def main(data_maps, interval, open_connection):
+    start = time.perf_counter()
+    results = await asyncio.gather(*[replay_bed(str(i), data_maps[i], interval, open_connection) for i in range(len(data_maps))])
+    elapsed = time.perf_counter() - start
+    num_requests = sum(result[0] for result in results)
+    num_risks = sum(result[1] for result in results)
+    print('Sent %d observations from %d beds in %.2fs (%.1f observations/s), received %d risk scores'%(num_requests, len(data_maps), elapsed, num_requests/elapsed, num_risks))
+
+    reader, writer = await open_connection()
+    writer.write((json.dumps({'type': 'stats'}) + '\n').encode())
+    await writer.drain()
+    print('Server stats: ', json.loads(await reader.readline()))
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays HiRID data_maps against the local risk scoring service')
+    parser.add_argument('--path', type=str, default='./hirid_numpy')
+    parser.add_argument('--file_name', type=str, default='TEST_mortality_data_maps.npy')
+    parser.add_argument('--num_beds', type=int, default=64)
+    parser.add_argument('--interval', type=float, default=0, help='Seconds between two observations of a bed. 0 sends them as fast as possible.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix_socket', type=str, default=None)
+    args = parser.parse_args()
+
+    data_maps = np.load(os.path.join(args.path, args.file_name), mmap_mode='r')[0:args.num_beds]
+    if args.unix_socket is not None:
+        open_connection = lambda: asyncio.open_unix_connection(args.unix_socket)
+    else:
+        open_connection = lambda: asyncio.open_connection(args.host, args.port)
+    asyncio.run(main(np.asarray(data_maps, dtype=np.float32), args.interval, open_connection))
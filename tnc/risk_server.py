@@ -0,0 +1,229 @@
+"""
+Local asyncio risk scoring service. Clients send one JSON object per line (over TCP or a Unix socket) with the next
+observation of a patient, and get back one JSON line with the patient's risk score. Concurrent requests from different
+beds are coalesced into micro-batches before calling the encoder and the RnnPredictor.
+
+Requests:
+    {"patient_id": ..., "observation": [[data of each feature], [map of each feature]]}
+        -> {"patient_id": ..., "risk": risk score, or null if no window was completed by this observation}
+    {"type": "discharge", "patient_id": ...} -> {"patient_id": ..., "discharged": true}
+    {"type": "stats"} -> latency percentiles (ms), throughput (requests/s) and batch counters
+"""
+
+import asyncio
+import argparse
+import collections
+import json
+import time
+import numpy as np
+import torch
+from tnc.streaming import StreamingRiskScorer, load_risk_models
+
+
+class MicroBatcher():
+    '''Collects the observations submitted concurrently and passes them to a StreamingRiskScorer in batches.
+
+    A batch is closed when it has max_batch_size observations, or max_latency seconds after its first observation was
+    submitted. Observations of the same patient within a batch are applied in the order they were submitted. Discharges go
+    through the same queue, so that the scorer is only ever used from the executor thread scoring the batches.
+    '''
+    def __init__(self, scorer, max_batch_size=256, max_latency=0.005, num_latencies_kept=100000):
+        self.scorer = scorer
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = asyncio.Queue()
+        self.latencies = collections.deque(maxlen=num_latencies_kept) # In seconds, from submission to the risk being available
+        self.num_requests = 0
+        self.num_batches = 0
+        self.first_submitted = None # Throughput is measured from the first request to the last response
+        self.last_done = None
+
+    async def submit(self, patient_id, observation):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((patient_id, observation, future, time.perf_counter()))
+        return await future
+
+    async def discharge(self, patient_id):
+        '''Removes the patient from the scorer, after the observations submitted before the discharge.'''
+        return await self.submit(patient_id, None)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][3] + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(None, self._score, batch)
+            except Exception as e:
+                results = [e]*len(batch)
+
+            done = time.perf_counter()
+            self.first_submitted = batch[0][3] if self.first_submitted is None else self.first_submitted
+            self.last_done = done
+            for (_, _, future, submitted), result in zip(batch, results):
+                self.latencies.append(done - submitted)
+                if future.done(): # e.g. cancelled by a client that went away
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            self.num_requests += len(batch)
+            self.num_batches += 1
+
+    def _score(self, batch):
+        '''Applies the observations and discharges of batch in order. Returns the result of each of them (the risk, None if
+        no window was completed, or True for a discharge), or the exception that was raised computing it.'''
+        results = [None]*len(batch)
+        failed = set() # Patients with a failed observation in this batch. Their later observations aren't applied, they'd be out of order
+        start = 0
+        for end in range(len(batch) + 1):
+            if end < len(batch) and batch[end][1] is not None:
+                continue
+            self._score_observations(batch, range(start, end), results, failed)
+            if end < len(batch): # A discharge
+                patient_id = batch[end][0]
+                if patient_id in self.scorer.patients:
+                    self.scorer.remove_patient(patient_id)
+                failed.discard(patient_id)
+                results[end] = True
+            start = end + 1
+        return results
+
+    def _score_observations(self, batch, indices, results, failed):
+        # The scorer takes at most one observation per patient, so the observations are split into rounds
+        rounds = []
+        for i in indices:
+            patient_id = batch[i][0]
+            for scorer_round in rounds:
+                if patient_id not in scorer_round:
+                    scorer_round[patient_id] = i
+                    break
+            else:
+                rounds.append({patient_id: i})
+
+        for scorer_round in rounds:
+            for patient_id in failed.intersection(scorer_round):
+                results[scorer_round.pop(patient_id)] = RuntimeError('An earlier observation of patient %s failed'%patient_id)
+            try:
+                round_risks = self.scorer.update({patient_id: batch[i][1] for patient_id, i in scorer_round.items()})
+            except Exception:
+                # A failed update leaves the scorer's patients as they were (see StreamingRiskScorer.update), so the round is
+                # retried one patient at a time, and only the observations that fail on their own get the exception
+                round_risks = {}
+                for patient_id, i in scorer_round.items():
+                    try:
+                        round_risks.update(self.scorer.update({patient_id: batch[i][1]}))
+                    except Exception as e:
+                        results[i] = e
+                        failed.add(patient_id)
+            for patient_id, risk in round_risks.items():
+                results[scorer_round[patient_id]] = risk.tolist()
+
+    def stats(self):
+        latencies = np.array(self.latencies)*1000
+        elapsed = self.last_done - self.first_submitted if self.num_batches else 0
+        return {'num_requests': self.num_requests, 'num_batches': self.num_batches,
+                'mean_batch_size': self.num_requests/max(self.num_batches, 1),
+                'throughput': self.num_requests/elapsed if elapsed > 0 else None,
+                'p50_latency_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99_latency_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                'num_patients': len(self.scorer.patients)}
+
+
+class RiskServer():
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def handle_connection(self, reader, writer):
+        # Requests of one connection are answered in order, but handled concurrently so that they can share a batch
+        responses = asyncio.Queue()
+        writer_task = asyncio.create_task(self._write_responses(responses, writer))
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('Requests must be JSON objects')
+            except ValueError as e: # Malformed lines get an error response, the connection stays open
+                await responses.put(asyncio.create_task(self._error_response('Invalid request: %s'%e)))
+                continue
+            await responses.put(asyncio.create_task(self.handle_request(request)))
+        await responses.put(None)
+        await writer_task
+        writer.close()
+
+    async def _write_responses(self, responses, writer):
+        while True:
+            task = await responses.get()
+            if task is None:
+                break
+            writer.write((json.dumps(await task) + '\n').encode())
+            await writer.drain()
+
+    async def _error_response(self, message):
+        return {'error': message}
+
+    async def handle_request(self, request):
+        request_type = request.get('type', 'observation')
+        if request_type == 'stats':
+            return self.batcher.stats()
+        if 'patient_id' not in request:
+            return {'error': 'Missing patient_id'}
+        if request_type == 'discharge':
+            try:
+                await self.batcher.discharge(request['patient_id'])
+            except Exception as e:
+                return {'patient_id': request['patient_id'], 'error': str(e)}
+            return {'patient_id': request['patient_id'], 'discharged': True}
+
+        try:
+            observation = torch.Tensor(request['observation'])
+            risk = await self.batcher.submit(request['patient_id'], observation)
+        except Exception as e:
+            return {'patient_id': request['patient_id'], 'error': str(e)}
+        return {'patient_id': request['patient_id'], 'risk': risk}
+
+
+async def serve(batcher, host='127.0.0.1', port=8765, unix_socket=None):
+    risk_server = RiskServer(batcher)
+    batcher_task = asyncio.create_task(batcher.run())
+    if unix_socket is not None:
+        server = await asyncio.start_unix_server(risk_server.handle_connection, path=unix_socket)
+        print('Serving risk scores on %s'%unix_socket)
+    else:
+        server = await asyncio.start_server(risk_server.handle_connection, host=host, port=port)
+        print('Serving risk scores on %s:%d'%(host, port))
+    async with server:
+        await server.serve_forever()
+    batcher_task.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local risk scoring service')
+    parser.add_argument('--encoder_checkpoint', type=str, default=None, help='Randomly initialized models are used if not given.')
+    parser.add_argument('--classifier_checkpoint', type=str, default=None)
+    parser.add_argument('--sliding_gap', type=int, default=1)
+    parser.add_argument('--max_batch_size', type=int, default=256)
+    parser.add_argument('--max_latency_ms', type=float, default=5)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix_socket', type=str, default=None)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    encoder, classifier = load_risk_models(args.encoder_checkpoint, args.classifier_checkpoint, device=device)
+    scorer = StreamingRiskScorer(encoder, classifier, sliding_gap=args.sliding_gap, device=device)
+    batcher = MicroBatcher(scorer, max_batch_size=args.max_batch_size, max_latency=args.max_latency_ms/1000)
+    asyncio.run(serve(batcher, host=args.host, port=args.port, unix_socket=args.unix_socket))
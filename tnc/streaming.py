@@ -0,0 +1,167 @@
+"""
+Streaming risk scoring: encodes each patient's stay one time step at a time, without re-running the encoder and the
+RnnPredictor over the whole history on every update.
+"""
+
+import torch
+import argparse
+from tnc.models import CausalCNNEncoder, RnnPredictor
+from tnc.checkpoints import load_checkpoint
+from tnc.quantization import load_quantized_encoder, load_quantized_predictor
+
+
+class StreamingRiskScorer():
+    '''Keeps, for each patient, a ring buffer of the last window_size time steps and the (h, c) state of the classifier's LSTM.
+
+    Every sliding_gap time steps (once the first window_size steps have been seen), the window in the buffer is encoded
+    and the LSTM is advanced by one step from the cached state, so the cost of an update doesn't depend on the length
+    of the stay. The risks are the same as classifier.predict_trajectories(encoder.forward_seq(x, sliding_gap=sliding_gap))
+    computed on the whole stay (a sigmoid for single output classifiers, a softmax over the classes otherwise).
+    @param encoder CausalCNNEncoder the classifier was trained on.
+    @param classifier RnnPredictor taking the (pruned) encodings of the encoder.
+    @param sliding_gap Number of time steps between two consecutive windows. Defaults to the encoder's window_size (non overlapping windows).
+    '''
+    def __init__(self, encoder, classifier, sliding_gap=None, device='cpu'):
+        self.encoder = encoder.eval()
+        self.classifier = classifier.eval()
+        self.window_size = encoder.window_size
+        self.sliding_gap = sliding_gap if sliding_gap else encoder.window_size
+        self.device = device
+        self.patients = {} # Maps each patient id to its state
+
+    def _new_state(self):
+        return {'buffer': None, # Of shape (num_channels*num_features, window_size). Created with the first observation
+                'num_steps': 0, # Number of time steps seen so far
+                'h': torch.zeros(self.classifier.num_layers, 1, self.classifier.hidden_size, device=self.device),
+                'c': torch.zeros(self.classifier.num_layers, 1, self.classifier.hidden_size, device=self.device)}
+
+    def add_patient(self, patient_id):
+        self.patients[patient_id] = self._new_state()
+
+    def remove_patient(self, patient_id):
+        del self.patients[patient_id]
+
+    def update(self, observations):
+        '''Takes a dictionary mapping patient ids to the observation of their next time step, of shape (2, num_features)
+        (data and map) or (num_features,). Patients that haven't been seen before are added.
+
+        Returns a dictionary mapping the ids of the patients for which a window was completed to their new risk score.
+        The encoder and the LSTM are called once for all these patients. The new buffers, step counts and LSTM states are
+        only stored once they have all been computed, so if the update raises, the patients are left as they were.'''
+        staged = {} # The new state of each patient in observations
+        completed = []
+        windows = []
+        for patient_id, observation in observations.items():
+            observation = observation.reshape(-1).to(self.device)
+            if patient_id in self.patients:
+                state = dict(self.patients[patient_id])
+            else:
+                state = self._new_state()
+            if state['buffer'] is None:
+                state['buffer'] = torch.zeros(len(observation), self.window_size, device=self.device)
+            else:
+                state['buffer'] = state['buffer'].clone()
+
+            # The oldest time step in the buffer is overwritten
+            state['buffer'][:, state['num_steps'] % self.window_size] = observation
+            state['num_steps'] += 1
+            staged[patient_id] = state
+
+            if state['num_steps'] >= self.window_size and (state['num_steps'] - self.window_size) % self.sliding_gap == 0:
+                oldest = state['num_steps'] % self.window_size # Index of the oldest time step in the buffer
+                windows.append(torch.cat([state['buffer'][:, oldest:], state['buffer'][:, :oldest]], dim=1)) # Window in chronological order
+                completed.append(patient_id)
+
+        risks = {}
+        if len(completed) > 0:
+            with torch.no_grad():
+                # The windows go through the network directly, forward would take a stack of exactly 2 windows for a single sample with maps
+                encodings = self.encoder._encode_windows(torch.stack(windows)) # of shape (num_completed, encoding_size)
+                h = torch.cat([staged[patient_id]['h'] for patient_id in completed], dim=1) # of shape (num_layers, num_completed, hidden_size)
+                c = torch.cat([staged[patient_id]['c'] for patient_id in completed], dim=1)
+                output, (h, c) = self.classifier.rnn(encodings.unsqueeze(1).to(self.device), (h, c)) # output is of shape (num_completed, 1, hidden_size)
+                predictions = self.classifier.linear(output[:, 0]) # of shape (num_completed, n_classes)
+                # As in RnnPredictor.predict_trajectories, of shape (num_completed,) or (num_completed, n_classes)
+                completed_risks = torch.sigmoid(predictions.squeeze(-1)) if self.classifier.n_classes == 1 else torch.softmax(predictions, dim=-1)
+            for i, patient_id in enumerate(completed):
+                staged[patient_id]['h'] = h[:, i:i+1]
+                staged[patient_id]['c'] = c[:, i:i+1]
+                risks[patient_id] = completed_risks[i]
+
+        self.patients.update(staged)
+        return risks
+
+
+def check_streaming_risk(encoder, classifier, x, sliding_gap=None, device='cpu'):
+    '''Feeds the samples of x (of shape (num_samples, 2, num_features, seq_len)) one time step at a time to a StreamingRiskScorer
+    and compares the risks to the batch computation over the whole sequences. Returns the max absolute difference.'''
+    scorer = StreamingRiskScorer(encoder, classifier, sliding_gap=sliding_gap, device=device)
+    with torch.no_grad():
+        batch_risks = classifier.predict_trajectories(encoder.forward_seq(x, sliding_gap=scorer.sliding_gap)).reshape(x.shape[0], -1)
+
+    streaming_risks = [[] for _ in range(x.shape[0])]
+    for t in range(x.shape[-1]):
+        risks = scorer.update({i: x[i, ..., t] for i in range(x.shape[0])})
+        for i, risk in risks.items():
+            streaming_risks[i].append(risk)
+    streaming_risks = torch.stack([torch.stack(risks) for risks in streaming_risks]).reshape(x.shape[0], -1)
+    return float(torch.max(torch.abs(streaming_risks.to(batch_risks.device) - batch_risks)))
+
+
+def predictor_size(state_dict):
+    '''(hidden_size, n_classes) of the RnnPredictor a (float) state dict was saved from.'''
+    hidden_size = state_dict['rnn.weight_hh_l0'].shape[1]
+    if 'linear.weight' in state_dict: # Single output, a single linear layer
+        return hidden_size, state_dict['linear.weight'].shape[0]
+    return hidden_size, state_dict['linear.1.weight'].shape[0]
+
+
+def load_risk_models(encoder_checkpoint=None, classifier_checkpoint=None, hidden_size=8, device='cpu', freeze=True):
+    '''Loads the CausalCNNEncoder of an encoder checkpoint saved by tnc.py and the RnnPredictor of a classifier checkpoint.
+    Randomly initialized models (with the HiRID encoder hyper parameters) are returned for the ones that aren't given.
+    The hidden_size and n_classes of a float classifier come from its checkpoint (hidden_size is only used for random ones).
+    If freeze, the encoder is frozen for inference (see CausalCNNEncoder.freeze_for_inference).
+    Quantized checkpoints saved by tnc/quantization.py are loaded as quantized models (which run on the CPU).'''
+    checkpoint = load_checkpoint(encoder_checkpoint, map_location=device) if encoder_checkpoint is not None else {}
+    if checkpoint.get('quantized', False):
+        encoder = load_quantized_encoder(checkpoint)
+    elif encoder_checkpoint is not None:
+        encoder = CausalCNNEncoder(**dict(checkpoint['encoder_hyper_params'], device=device))
+        encoder.load_state_dict(checkpoint['encoder_state_dict'])
+        encoder.pruning_mask = checkpoint['pruning_mask']
+        encoder.pruned_encoding_size = int(torch.sum(encoder.pruning_mask))
+    else:
+        encoder = CausalCNNEncoder(in_channels=36, channels=4, depth=1, reduced_size=2, encoding_size=10, kernel_size=2, device=device, window_size=12)
+    if freeze and not checkpoint.get('quantized', False): # Quantized encoders are already frozen
+        encoder.freeze_for_inference()
+    
+    classifier_checkpoint = load_checkpoint(classifier_checkpoint, map_location=device) if classifier_checkpoint is not None else {}
+    if classifier_checkpoint.get('quantized', False):
+        classifier = load_quantized_predictor(classifier_checkpoint, encoder.pruned_encoding_size, hidden_size=hidden_size)
+    else:
+        n_classes = 1
+        if 'classifier_state_dict' in classifier_checkpoint:
+            hidden_size, n_classes = predictor_size(classifier_checkpoint['classifier_state_dict'])
+        classifier = RnnPredictor(encoding_size=encoder.pruned_encoding_size, hidden_size=hidden_size, n_classes=n_classes).to(device)
+        if 'classifier_state_dict' in classifier_checkpoint:
+            classifier.load_state_dict(classifier_checkpoint['classifier_state_dict'])
+    return encoder, classifier
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks that streaming risk scores match the batch computation')
+    parser.add_argument('--checkpoint_file', type=str, default=None, help='Encoder checkpoint. A randomly initialized encoder is used if not given.')
+    parser.add_argument('--sliding_gap', type=int, default=1)
+    parser.add_argument('--seq_len', type=int, default=144)
+    args = parser.parse_args()
+
+    device = 'cpu'
+    encoder, classifier = load_risk_models(args.checkpoint_file, device=device)
+
+    num_features = encoder.network[0].network[0].causal[0].in_channels//2
+    x = torch.randn(4, 2, num_features, args.seq_len)
+    x[:, 1] = (torch.rand(4, num_features, args.seq_len) > 0.5).float()
+    # With 2 patients, the windows are completed (and encoded) exactly 2 at a time
+    for num_patients in [4, 2]:
+        print('Max absolute difference between streaming and batch risk scores (%d patients): '%num_patients,
+              check_streaming_risk(encoder, classifier, x[:num_patients], sliding_gap=args.sliding_gap, device=device))
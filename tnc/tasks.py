@@ -0,0 +1,316 @@
+"""
+Downstream task engine: trains and evaluates several task heads (RnnPredictors) on the encodings of a frozen encoder, with
+a single encoding sweep over the data.
+
+An EncodingSource encodes each array of data maps once and caches the encodings. A Task is a head (BinaryHead, a single
+output trained with BCE and a pos_weight, like the mortality classifier of tnc.py, or MulticlassHead, trained with a class
+weighted cross entropy, like the circulatory failure and APACHE classifiers) and the rows of the encoding source (and
+labels) of each of its splits. Tasks whose splits read the same data maps share each batch of encodings: TaskEngine
+gathers the encodings of a batch once, and every head takes its own rows of it, so their losses are summed and back
+propagated together (each head only has its own parameters, so this is the same as training them one by one).
+
+The frozen encoder classifiers of tnc.py (HiRID mortality), circulatory_failure_prediction.py and
+apache_group_prediction.py are trained by a TaskEngine (through task_epoch_run, which returns an epoch in the format of
+their epoch loops). Running this file evaluates the mortality, circulatory failure and APACHE group tasks of an encoder
+checkpoint.
+"""
+
+import os
+import argparse
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score, precision_recall_curve, auc
+from tnc.models import RnnPredictor
+from tnc.quantization import load_float_encoder
+
+
+class EncodingSource():
+    '''Encodes arrays of data maps (torch tensors or numpy arrays, possibly memory mapped, of shape (num_samples, 2,
+    num_features, seq_len)) with encoder.forward_seq, batch_size samples at a time, the first time their encodings are needed.'''
+    def __init__(self, encoder, batch_size=64, device='cpu'):
+        self.encoder = encoder.eval()
+        self.batch_size = batch_size
+        self.device = device
+        self.encoding_size = encoder.pruned_encoding_size
+        self._data_maps = {}
+        self._encodings = {}
+
+    def add(self, name, data_maps):
+        self._data_maps[name] = data_maps
+        self._encodings.pop(name, None)
+
+    def __len__(self):
+        return len(self._data_maps)
+
+    def num_samples(self, name):
+        return len(self._data_maps[name])
+
+    def data_maps(self, name):
+        return self._data_maps[name]
+
+    def encodings(self, name):
+        '''Encodings of the data maps added as name, of shape (num_samples, seq_len/window_size, encoding_size), on the CPU.'''
+        if name not in self._encodings:
+            data_maps = self._data_maps[name]
+            encodings = []
+            with torch.no_grad():
+                for start in range(0, len(data_maps), self.batch_size):
+                    batch = data_maps[start:start+self.batch_size]
+                    if isinstance(batch, np.ndarray):
+                        batch = torch.from_numpy(np.array(batch)) # Copied out of a (read only) memory map
+                    encodings.append(self.encoder.forward_seq(batch.float().to(self.device)).cpu())
+            self._encodings[name] = torch.cat(encodings)
+        return self._encodings[name]
+
+
+def _auprc(labels, risks):
+    precision, recall, _ = precision_recall_curve(labels, risks)
+    return auc(recall, precision)
+
+
+class BinaryHead():
+    '''Single output head trained with BCE (with pos_weight on the positive samples). Labels are 0 or 1.'''
+    def __init__(self, pos_weight=None):
+        self.n_classes = 1
+        self.pos_weight = pos_weight
+
+    def loss(self, predictions, labels):
+        pos_weight = torch.Tensor([self.pos_weight]).to(predictions.device) if self.pos_weight is not None else None
+        return torch.nn.functional.binary_cross_entropy_with_logits(predictions, labels.float(), pos_weight=pos_weight)
+
+    def probabilities(self, predictions):
+        return torch.sigmoid(predictions)
+
+    def metrics(self, labels, probabilities):
+        return {'auroc': roc_auc_score(labels, probabilities), 'auprc': _auprc(labels, probabilities)}
+
+
+class MulticlassHead():
+    '''n_classes output head trained with a cross entropy weighted by class_weights (e.g. max class count/class count).
+    Labels are class numbers. With 2 classes, the AUROC and AUPRC are those of class 1, otherwise the AUROC is one vs rest.'''
+    def __init__(self, n_classes, class_weights=None):
+        self.n_classes = n_classes
+        self.class_weights = class_weights
+
+    def loss(self, predictions, labels):
+        class_weights = self.class_weights.to(predictions.device) if self.class_weights is not None else None
+        return torch.nn.functional.cross_entropy(predictions, labels.long(), weight=class_weights)
+
+    def probabilities(self, predictions):
+        return torch.softmax(predictions, dim=-1)
+
+    def metrics(self, labels, probabilities):
+        metrics = {'accuracy': float(np.mean(np.argmax(probabilities, axis=1) == labels))}
+        if self.n_classes == 2:
+            metrics.update({'auroc': roc_auc_score(labels, probabilities[:, 1]), 'auprc': _auprc(labels, probabilities[:, 1])})
+        else:
+            metrics['auroc'] = roc_auc_score(labels, probabilities, multi_class='ovr', labels=np.arange(self.n_classes))
+        return metrics
+
+
+class Task():
+    '''A head trained on the encodings of an EncodingSource. splits maps a split name (e.g. 'train', 'validation', 'TEST')
+    to (source name, labels, rows), where labels[i] is the label of row rows[i] of the source (all the rows, in order, if
+    rows is None). Labels are per sample. encoding_slice selects the windows the head sees (e.g. slice(None, -3) to drop the
+    last 3 windows of every sample). lr and weight_decay override the ones of the TaskEngine for this head.'''
+    def __init__(self, name, head, splits, encoding_slice=None, lr=None, weight_decay=None):
+        self.name = name
+        self.head = head
+        self.splits = {}
+        for split, (source_name, labels, rows) in splits.items():
+            labels = labels if torch.is_tensor(labels) else torch.as_tensor(np.asarray(labels))
+            rows = torch.arange(len(labels)) if rows is None else torch.as_tensor(rows, dtype=torch.long)
+            self.splits[split] = (source_name, labels, rows)
+        self.encoding_slice = encoding_slice if encoding_slice is not None else slice(None)
+        self.lr = lr
+        self.weight_decay = weight_decay
+
+
+def train_validation_rows(num_samples, validation_fraction=0.2, seed=0):
+    '''Random split of range(num_samples) into train and validation rows, e.g. for Task splits.'''
+    rows = np.random.RandomState(seed).permutation(num_samples)
+    n_valid = int(validation_fraction*num_samples)
+    return np.sort(rows[n_valid:]), np.sort(rows[:n_valid])
+
+
+class TaskEngine():
+    '''Trains an RnnPredictor per task on the encodings of source.'''
+    def __init__(self, source, tasks, hidden_size=8, lr=1e-3, weight_decay=0, batch_size=32, device='cpu'):
+        self.source = source
+        self.tasks = tasks
+        self.batch_size = batch_size
+        self.device = device
+        self.classifiers = {task.name: RnnPredictor(encoding_size=source.encoding_size, hidden_size=hidden_size, n_classes=task.head.n_classes).to(device)
+                            for task in tasks}
+        self.optimizer = torch.optim.Adam([{'params': self.classifiers[task.name].parameters(),
+                                            'lr': task.lr if task.lr is not None else lr,
+                                            'weight_decay': task.weight_decay if task.weight_decay is not None else weight_decay} for task in tasks])
+
+    def _split_groups(self, split):
+        '''Groups the tasks that have split by the source they read. For every task of a group, the returned lookup maps
+        each row of the source to the index of its label (-1 for the rows the task doesn't use).'''
+        groups = {}
+        for task in self.tasks:
+            if split not in task.splits:
+                continue
+            source_name, labels, rows = task.splits[split]
+            lookup = torch.full((self.source.num_samples(source_name),), -1, dtype=torch.long)
+            lookup[rows] = torch.arange(len(rows))
+            groups.setdefault(source_name, []).append((task, labels, lookup))
+        return groups
+
+    def run_epoch(self, split, train=False):
+        '''One pass over the encodings of split for all the tasks. Returns, for each task, its mean loss, and its predicted
+        probabilities and labels (in the order of its rows if not train).'''
+        for classifier in self.classifiers.values():
+            classifier.train(train)
+        results = {}
+        for source_name, group in self._split_groups(split).items():
+            encodings = self.source.encodings(source_name)
+            used_rows = torch.where(torch.stack([lookup for _, _, lookup in group]).max(dim=0)[0] >= 0)[0]
+            if train:
+                used_rows = used_rows[torch.randperm(len(used_rows))]
+            losses = {task.name: [] for task, _, _ in group}
+            probabilities = {task.name: [] for task, _, _ in group}
+            labels_seen = {task.name: [] for task, _, _ in group}
+            for batch_rows in torch.split(used_rows, self.batch_size):
+                encoding_batch = encodings[batch_rows].to(self.device) # Gathered once for all the tasks of the group
+                batch_loss = 0
+                with torch.set_grad_enabled(train):
+                    for task, labels, lookup in group:
+                        label_inds = lookup[batch_rows]
+                        keep = label_inds >= 0
+                        if not torch.any(keep):
+                            continue
+                        predictions = self.classifiers[task.name](encoding_batch[keep.to(self.device)][:, task.encoding_slice])
+                        label_batch = labels[label_inds[keep]].to(self.device)
+                        loss = task.head.loss(predictions, label_batch)
+                        batch_loss = batch_loss + loss
+                        losses[task.name].append((loss.item(), int(torch.sum(keep))))
+                        probabilities[task.name].append(task.head.probabilities(predictions.detach()).cpu())
+                        labels_seen[task.name].append(label_batch.cpu())
+                if train:
+                    self.optimizer.zero_grad()
+                    batch_loss.backward()
+                    self.optimizer.step()
+            for task, _, _ in group:
+                num_samples = sum(n for _, n in losses[task.name])
+                results[task.name] = {'loss': sum(loss*n for loss, n in losses[task.name])/max(num_samples, 1),
+                                      'probabilities': torch.cat(probabilities[task.name]).numpy(), 'labels': torch.cat(labels_seen[task.name]).numpy()}
+        return results
+
+    def evaluate(self, split):
+        '''Loss and metrics (see BinaryHead.metrics and MulticlassHead.metrics) of every task that has split.'''
+        results = self.run_epoch(split, train=False)
+        heads = {task.name: task.head for task in self.tasks}
+        return {name: dict(heads[name].metrics(result['labels'], result['probabilities']), loss=result['loss']) for name, result in results.items()}
+
+    def fit(self, n_epochs, validation_split='validation', print_every=10):
+        '''Trains every head for n_epochs on its 'train' split, printing the validation metrics every print_every epochs.
+        Returns the train losses of each task, per epoch.'''
+        history = {task.name: [] for task in self.tasks}
+        for epoch in range(1, n_epochs + 1):
+            for name, result in self.run_epoch('train', train=True).items():
+                history[name].append(result['loss'])
+            if print_every and epoch%print_every == 0:
+                for name, metrics in self.evaluate(validation_split).items():
+                    print('Epoch %d %s =====> Training Loss: %.5f \t Validation %s'%(epoch, name, history[name][-1], format_metrics(metrics)))
+        return history
+
+    def save(self, ckpt_path, prefix=''):
+        '''Saves each classifier as tnc.py does, to ckpt_path/<prefix><task name>_classifier_checkpoint.tar.'''
+        if not os.path.exists(ckpt_path):
+            os.makedirs(ckpt_path)
+        for name, classifier in self.classifiers.items():
+            torch.save({'classifier_state_dict': classifier.state_dict()}, os.path.join(ckpt_path, '%s%s_classifier_checkpoint.tar'%(prefix, name)))
+
+
+def task_epoch_run(engine, task_name, split, train=False, accumulator=None):
+    '''TaskEngine.run_epoch for the task task_name, returned like the linear_classifier_epoch_run functions of the training
+    scripts: (list of predicted probabilities, list of losses, list of labels). If accumulator (a BinaryMetricAccumulator)
+    is given, the probabilities and labels are added to it instead, and the returned lists of predictions and labels are empty.'''
+    result = engine.run_epoch(split, train=train)[task_name]
+    probabilities, labels = torch.from_numpy(result['probabilities']), torch.from_numpy(result['labels'])
+    if accumulator is not None:
+        accumulator.update(probabilities, labels)
+        return [], [result['loss']], []
+    return [probabilities], [result['loss']], [labels]
+
+
+def format_metrics(metrics):
+    return ', '.join('%s: %.4f'%(key, value) for key, value in sorted(metrics.items()))
+
+
+def hirid_tasks(source, path, task_names=('mortality', 'circulatory', 'apache'), window_size=12, validation_fraction=0.2):
+    '''Adds the data maps of the HiRID benchmark tasks to source and returns the Tasks, with the labels, loss weights and
+    optimizer settings of tnc.py (mortality), circulatory_failure_prediction.py and apache_group_prediction.py.'''
+    tasks = []
+    for name in task_names:
+        if name == 'mortality':
+            labels = np.array([1 in label for label in np.load(os.path.join(path, 'train_mortality_labels.npy'))]).astype(np.float32)
+            TEST_labels = np.array([1 in label for label in np.load(os.path.join(path, 'TEST_mortality_labels.npy'))]).astype(np.float32)
+            source.add('train_mortality', np.load(os.path.join(path, 'train_mortality_data_maps.npy'), mmap_mode='r'))
+            source.add('TEST_mortality', np.load(os.path.join(path, 'TEST_mortality_data_maps.npy'), mmap_mode='r'))
+            train_rows, validation_rows = train_validation_rows(len(labels), validation_fraction)
+            tasks.append(Task('mortality', BinaryHead(pos_weight=10), {'train': ('train_mortality', labels[train_rows], train_rows),
+                                                                        'validation': ('train_mortality', labels[validation_rows], validation_rows),
+                                                                        'TEST': ('TEST_mortality', TEST_labels, None)}, lr=1e-3, weight_decay=5e-3))
+        elif name == 'circulatory':
+            # The last 3 hrs of data are cut off, as in circulatory_failure_prediction.py. Windows don't overlap, so the head
+            # only sees the encodings of the windows that end before the cut, i.e. all but the last ceil(truncate_amt/window_size).
+            truncate_amt = 36
+            labels = np.array([1 in label for label in np.load(os.path.join(path, 'train_circulatory_labels.npy'))[:, truncate_amt:]]).astype(np.int64)
+            TEST_labels = np.array([1 in label for label in np.load(os.path.join(path, 'TEST_circulatory_labels.npy'))[:, truncate_amt:]]).astype(np.int64)
+            train_data_maps = np.load(os.path.join(path, 'train_circulatory_data_maps.npy'), mmap_mode='r')
+            source.add('train_circulatory', train_data_maps)
+            source.add('TEST_circulatory', np.load(os.path.join(path, 'TEST_circulatory_data_maps.npy'), mmap_mode='r'))
+            num_windows = train_data_maps.shape[-1]//window_size
+            num_kept_windows = num_windows - int(np.ceil(truncate_amt/window_size))
+            if num_kept_windows <= 0:
+                raise ValueError('No window of %d time steps ends before the last %d time steps of the circulatory data'%(window_size, truncate_amt))
+            class_weights = torch.Tensor([np.sum(labels == 0), np.sum(labels == 1)])
+            train_rows, validation_rows = train_validation_rows(len(labels), validation_fraction)
+            tasks.append(Task('circulatory', MulticlassHead(2, torch.max(class_weights)/class_weights),
+                              {'train': ('train_circulatory', labels[train_rows], train_rows),
+                               'validation': ('train_circulatory', labels[validation_rows], validation_rows),
+                               'TEST': ('TEST_circulatory', TEST_labels, None)},
+                              encoding_slice=slice(None, num_kept_windows), lr=1e-3, weight_decay=1e-4))
+        elif name == 'apache':
+            from tnc.apache_group_prediction import load_apache_data
+            train_data_maps, train_groups, TEST_data_maps, TEST_groups, apache_names, class_weights = load_apache_data(path)
+            source.add('train_apache', train_data_maps)
+            source.add('TEST_apache', TEST_data_maps)
+            train_rows, validation_rows = train_validation_rows(len(train_groups), validation_fraction)
+            tasks.append(Task('apache', MulticlassHead(len(class_weights), class_weights),
+                              {'train': ('train_apache', train_groups[train_rows], train_rows),
+                               'validation': ('train_apache', train_groups[validation_rows], validation_rows),
+                               'TEST': ('TEST_apache', TEST_groups, None)}, lr=2e-3, weight_decay=5e-4))
+        else:
+            raise ValueError('Unknown task %s'%name)
+    return tasks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trains and evaluates the downstream task heads of an encoder, from one encoding sweep')
+    parser.add_argument('--encoder_checkpoint', type=str, required=True)
+    parser.add_argument('--path', type=str, default='./hirid_numpy')
+    parser.add_argument('--tasks', type=str, nargs='+', default=['mortality', 'circulatory', 'apache'], choices=['mortality', 'circulatory', 'apache'])
+    parser.add_argument('--n_epochs', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--hidden_size', type=int, default=8)
+    parser.add_argument('--ckpt_path', type=str, default=None, help='If given, the trained classifiers are saved there.')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    encoder, _ = load_float_encoder(args.encoder_checkpoint)
+    encoder.freeze_for_inference()
+    encoder.device = device
+    source = EncodingSource(encoder.to(device), device=device)
+    tasks = hirid_tasks(source, args.path, args.tasks, window_size=encoder.window_size)
+    engine = TaskEngine(source, tasks, hidden_size=args.hidden_size, batch_size=args.batch_size, device=device)
+    engine.fit(args.n_epochs)
+    for split in ['validation', 'TEST']:
+        for name, metrics in engine.evaluate(split).items():
+            print('%s %s: %s'%(split, name, format_metrics(metrics)))
+    if args.ckpt_path is not None:
+        engine.save(args.ckpt_path)
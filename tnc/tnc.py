@@ -20,12 +20,18 @@ os.environ['MKL_THREADING_LAYER'] = 'GNU' # Set this value to allow grid_search.
 from sklearn.metrics import silhouette_score, davies_bouldin_score, roc_curve
 from sklearn.cluster import AgglomerativeClustering
 from datetime import datetime
-from tnc.models import CNN_Transformer_Encoder, EncoderMultiSignalMIMIC, GRUDEncoder, RnnEncoder, WFEncoder, TST, EncoderMultiSignal, LinearClassifier, RnnPredictor, EncoderMultiSignalMIMIC, CausalCNNEncoder
+from tnc.models import CNN_Transformer_Encoder, EncoderMultiSignalMIMIC, GRUDEncoder, add_grud_delta_channel, lengths_from_encoding_mask, RnnEncoder, WFEncoder, TST, EncoderMultiSignal, LinearClassifier, RnnPredictor, EncoderMultiSignalMIMIC, CausalCNNEncoder
 from tnc.utils import plot_heatmap, dim_reduction_mixed_clusters, dim_reduction_positive_clusters, plot_pca_trajectory, detect_incr_loss, dim_reduction
 from tnc.evaluations import WFClassificationExperiment, ClassificationPerformanceExperiment
 from statsmodels.tsa import stattools
 from sklearn.decomposition import PCA
 from sklearn.metrics import roc_auc_score, precision_recall_curve, auc, classification_report
+from tnc.metrics import BinaryMetricAccumulator
+from tnc.training import TrainingController, subsample_indices, subsample_loader
+from tnc.probe import linear_probe
+from tnc.tasks import EncodingSource, BinaryHead, Task, TaskEngine, task_epoch_run, format_metrics
+from tnc.trajectories import compute_risk_trajectories
+from tnc.folds import FoldManager, indexed_dataset
 from sklearn.cluster import KMeans
 
 
@@ -72,12 +78,13 @@ class Discriminator(torch.nn.Module):
 
 ######################################################################################################
 class TNCDataset(data.Dataset):
-    def __init__(self, x, mc_sample_size, window_size, eta=3, state=None, adf=False, acf=False, acf_plus=False, ACF_nghd_Threshold=0.4, ACF_out_nghd_Threshold=0.5):
+    def __init__(self, x, mc_sample_size, window_size, eta=3, state=None, adf=False, acf=False, acf_plus=False, ACF_nghd_Threshold=0.4, ACF_out_nghd_Threshold=0.5, indices=None):
         super(TNCDataset, self).__init__()
         self.time_series = x # Time series of shape (num_samples, 1, num_features, signal_length) if we have no maps, (num_samples, 2, num_features, signal_length) if we do
+        self.indices = None if indices is None else torch.as_tensor(indices, dtype=torch.long) # If given, the dataset only has these samples of x (e.g. a cross validation fold), which isn't copied
         self.T = x.shape[-1] # length of the time series
         self.window_size = window_size
-        self.have_map = True if self.time_series.shape[1] == 2 else False
+        self.have_map = True if self.time_series.shape[1] >= 2 else False # Extra channels (e.g. the precomputed GRUD Delta) come after the map
         # self.sliding_gap = int(window_size*25.2) # Commented out because its not used..
         # self.window_per_sample = (self.T-2*self.window_size)//self.sliding_gap # Commented out because its not used..
         self.mc_sample_size = mc_sample_size # num of montecarlo samples for estimating the expectations in the loss
@@ -94,7 +101,7 @@ class TNCDataset(data.Dataset):
         
         if not self.adf:
             self.acf_avgs = [] # Will store a list of acf values for a given sample. Will be modified on each call to _find_neighbors 
-            for i in range(len(x)):
+            for i in (range(len(x)) if self.indices is None else self.indices.tolist()):
                 acfs = []
                 sample = x[i]
                 for f in range(sample.shape[-2]):
@@ -108,18 +115,20 @@ class TNCDataset(data.Dataset):
     def __len__(self):
         # self.augmentation is used when there are very few samples of data, but they are long. In that case, we may wish to break up the big samples into medium samples
         # e.g. if we have 20 really long samples, we may split them each into 2 samples, meaning we now have 40 samples
-        return len(self.time_series) #*self.augmentation
+        return len(self.time_series) if self.indices is None else len(self.indices) #*self.augmentation
 
     def __getitem__(self, index):
         '''When a TNCDataset object element is accessed with data[index] notation (but more importantly when you loop through it), it will return some window W_t of the index'th sample timeseries,
         a tensor X_close of self.mc_sample_size windows in the neighborhood and X_distant a tensor of self.mc_sample_size
         windows outside of the neighborhood, as well as y_t which is the approximated patient state
         over the window W_t'''
+        index = index%len(self) # index for a sample of the dataset, and sample_index for the same sample of self.time_series
+        sample_index = index if self.indices is None else int(self.indices[index])
         end_T = self.T
         start_T = 0 # end_T and start_T represent the start of actual data and the end of actual data. i.e. the time range where each edge of the range does not have missingness (there can obviously be missing values in the middle though)
         if self.have_map: # if we have the map
             # then we can check for places where the data goes to all 0's (i.e. a time point after which all data is missing for any one feature)
-            x_map = self.time_series[index][1] # of shape (num_features, signal_length). 0's in the map indicate missingness in the data
+            x_map = self.time_series[sample_index][1] # of shape (num_features, signal_length). 0's in the map indicate missingness in the data
 
             x_map = 1-x_map # Switch to 0's indicating observed, 1's indicating missingness
             result = x_map[0]
@@ -148,28 +157,26 @@ class TNCDataset(data.Dataset):
             end_T = end_T - end_offset + 1
             start_T += start_offset
 
-        index = index%len(self.time_series) # index for a sample of the full dataset self.time_series
-        
         t = np.random.randint(start_T + 2*self.window_size, end_T-2*self.window_size) # randomly select t, the center of the window
 
         # self.time_series[ind] returns a 2D matrix for the ind'th sample. Shape is (num_features, signal_length)
-        W_t = self.time_series[index][:, :, t-self.window_size//2:t+self.window_size//2] # Generate the window, this is W_t from the paper
+        W_t = self.time_series[sample_index][:, :, t-self.window_size//2:t+self.window_size//2] # Generate the window, this is W_t from the paper
         # plt.savefig('./plots/%s_seasonal.png'%index) 
 
         
-        X_close = self._find_neighbors(self.time_series[index], t, start_T, end_T, index)
+        X_close = self._find_neighbors(self.time_series[sample_index], t, start_T, end_T, index)
        
-        X_distant = self._find_non_neighbors(self.time_series[index], t, start_T, end_T, index)
+        X_distant = self._find_non_neighbors(self.time_series[sample_index], t, start_T, end_T, index)
         
 
         if self.state is None: # If we have no patient state values
             y_t = -1
         else:
             if len(self.state.shape) == 1:
-                y_t = self.state[index]
+                y_t = self.state[sample_index]
             elif len(self.state.shape) == 2:
                 # self.state is of shape (num_samples, signal_length)
-                y_t = torch.round(torch.mean(self.state[index][t-self.window_size//2:t+self.window_size//2]))
+                y_t = torch.round(torch.mean(self.state[sample_index][t-self.window_size//2:t+self.window_size//2]))
 
 
         
@@ -350,9 +357,47 @@ class TNCDataset(data.Dataset):
                 x_n = x[:, :, end_T - rand_t - self.window_size:end_T - rand_t].unsqueeze(0)
         return x_n
 
+
+def encoding_lengths(data_maps, window_size):
+    '''Takes data_maps of shape (num_samples, 2, num_features, seq_len) and returns a tensor of shape (num_samples,) with the number of
+    non overlapping window_size encodings of each sample that come after its left padding. Uses the same criterion as the encoding mask of
+    CausalCNNEncoder.forward_seq (a window is padding if its last time step is fully imputed).'''
+    num_encodings = data_maps.shape[-1]//window_size
+    if data_maps.shape[1] < 2: # No maps, all encodings are kept
+        return torch.full((data_maps.shape[0],), num_encodings, dtype=torch.long)
+    fully_imputed = torch.all(data_maps[:, 1, :, :]==0, dim=1)[:, window_size-1::window_size] # of shape (num_samples, num_encodings)
+    encoding_mask = -fully_imputed.long() # -1 for encodings derived from fully imputed data
+    return lengths_from_encoding_mask(encoding_mask)
+
+
+class LengthBucketSampler(data.Sampler):
+    '''Batch sampler that groups samples of similar lengths, so that the padding that can be dropped in a batch
+    (the part that is padding for every sample in it) is as large as possible. Pass it as batch_sampler to a DataLoader.
+    Samples with equal lengths are shuffled, and so is the order of the batches.'''
+    def __init__(self, lengths, batch_size, shuffle=True):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        inds = torch.randperm(len(self.lengths)) if self.shuffle else torch.arange(len(self.lengths))
+        inds = inds[torch.sort(self.lengths[inds], stable=True)[1]] # torch.argsort has no stable argument in torch 1.10
+        batches = list(torch.split(inds, self.batch_size))
+        if self.shuffle:
+            random.shuffle(batches)
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return math.ceil(len(self.lengths)/self.batch_size)
+
 ######################################################################################################
 
-def linear_classifier_epoch_run(dataset, train, classifier, optimizer, data_type, window_size, encoder, encoding_size):
+def linear_classifier_epoch_run(dataset, train, classifier, optimizer, data_type, window_size, encoder, encoding_size, packed_sequences=False, accumulator=None):
+    '''
+    If accumulator (a BinaryMetricAccumulator) is given, the predictions and labels of each batch are added to it on device
+    and the returned lists of predictions and labels are empty.
+    '''
     if train:
         classifier.train()
     else:
@@ -367,36 +412,43 @@ def linear_classifier_epoch_run(dataset, train, classifier, optimizer, data_type
             label_batch = label_batch[:, -720:]
         
         
-        # data is of shape (num_samples, num_encodings_per_sample, encoding_size)
-        encoding_batch, encoding_mask = encoder.forward_seq(data_batch, return_encoding_mask=True)
-        encoding_batch = encoding_batch.to(device)
-
         if data_type == None:
+            # Encodings derived from fully imputed data are skipped inside the encoder, so encoding_batch is already
+            # of shape (num_encodings_kept, encoding_size) and the mask is of shape (num_samples, num_encodings_per_sample)
+            encoding_batch, encoding_mask = encoder.forward_seq(data_batch, return_encoding_mask=True, skip_imputed=True, packed=True)
+            encoding_batch = encoding_batch.to(device)
+
             # Takes every window_size'th label for each sample (so it matches the frequency of encodings)
             # Then reshapes to be of shape (num_samples*num_encodings_per_sample)
             label_batch = label_batch[:, window_size-1::window_size].to(device)
             
             label_batch = label_batch.reshape(-1,)
+            encoding_mask = encoding_mask.reshape(-1,)
             
-            # Now the encodings are of shape (num_samples*num_encodings_per_sample, encoding_size)
-            # and the masks are of shape (num_samples*num_encodings_per_sample)
-            encoding_batch, encoding_mask = encoding_batch.reshape(-1, encoding_size), encoding_mask.reshape(-1,)
-            
-            # Now we'll remove encodings that were derived from fully imputed data
-            encoding_batch = encoding_batch[torch.where(encoding_mask != -1)]
-            
-            # Remove the corresponding labels
+            # Remove the labels of the skipped encodings
             label_batch = label_batch[torch.where(encoding_mask != -1)]
             
             # Now encoding_batch is of shape (num_encodings_kept, encoding_size)
             # and label_batch is of shape (num_encodings_kept,)
 
         elif data_type == 'HiRID' or data_type == 'ICU':
+            if packed_sequences:
+                # Leading windows that are padding for every sample in the batch aren't encoded, and the RnnPredictor only
+                # runs over the encodings after each sample's own padding.
+                lengths = encoding_lengths(data_batch, window_size)
+                num_encodings = data_batch.shape[-1]//window_size
+                data_batch = data_batch[:, :, :, (num_encodings - max(int(torch.max(lengths)), 1))*window_size:]
+            
+            # data is of shape (num_samples, num_encodings_per_sample, encoding_size)
+            encoding_batch = encoder.forward_seq(data_batch).to(device)
             label_batch = torch.Tensor([1 in label for label in label_batch]).to(device)
             
             # So now encoding_batch is of shape (num_samples, num_windows_per_sample, encoding_size)
             # and train_labels is of shape (num_samples,)
-        predictions = torch.squeeze(classifier(encoding_batch)) # of shape (bs,)
+        if packed_sequences and data_type != None:
+            predictions = torch.squeeze(classifier(encoding_batch, lengths=lengths))
+        else:
+            predictions = torch.squeeze(classifier(encoding_batch)) # of shape (bs,)
         
         pos_weight = torch.Tensor([10]).to(device)
         if train:
@@ -420,6 +472,10 @@ def linear_classifier_epoch_run(dataset, train, classifier, optimizer, data_type
 
         # Apply sigmoid to predictions since we didn't apply it for the loss function since the loss function does sigmoid on its own.
         predictions = torch.nn.Sigmoid()(predictions)
+        epoch_losses.append(epoch_loss)
+        if accumulator is not None:
+            accumulator.update(predictions, label_batch)
+            continue
 
         # Move Tensors to CPU and remove gradients so they can be converted to NumPy arrays in the sklearn functions
         #window_labels = window_labels.cpu().detach()
@@ -429,18 +485,40 @@ def linear_classifier_epoch_run(dataset, train, classifier, optimizer, data_type
         #pos_window_labels = pos_window_labels.cpu()
         label_batch = label_batch.cpu()
 
-        epoch_losses.append(epoch_loss)
         epoch_predictions.append(predictions)
         epoch_labels.append(label_batch)
     
     return epoch_predictions, epoch_losses, epoch_labels
 
-def train_linear_classifier(X_train, y_train, X_validation, y_validation, X_TEST, y_TEST, encoding_size, num_pre_positive_encodings, encoder, window_size, batch_size=32, return_models=False, return_scores=False, pos_sample_name='arrest', data_type='ICU', classification_cv=0, encoder_cv=0, ckpt_path="./ckpt",  plt_path="./DONTCOMMITplots", classifier_name=""):
+def exact_classifier_scores(epoch_predictions, epoch_labels):
+    '''sklearn AUROC, AUPRC and PR curve of the lists of batch predictions and labels returned by linear_classifier_epoch_run.'''
+    predictions = torch.cat(epoch_predictions)
+    labels = torch.cat(epoch_labels)
+    # Compute precision recall curve
+    precision, recall, _ = precision_recall_curve(labels, predictions)
+    return {'auroc': roc_auc_score(labels, predictions), 'auprc': auc(recall, precision), # precision is the y axis, recall is the x axis
+            'precision': precision, 'recall': recall, 'predictions': predictions, 'labels': labels}
+
+def exact_classification_report(scores, target_names):
+    predictions_thresholded = (scores['predictions'] >= 0.5).float()
+    return classification_report(scores['labels'], predictions_thresholded, target_names=target_names)
+
+def train_linear_classifier(X_train, y_train, X_validation, y_validation, X_TEST, y_TEST, encoding_size, num_pre_positive_encodings, encoder, window_size, batch_size=32, return_models=False, return_scores=False, pos_sample_name='arrest', data_type='ICU', classification_cv=0, encoder_cv=0, ckpt_path="./ckpt",  plt_path="./DONTCOMMITplots", classifier_name="", packed_sequences=False, exact_metrics=False,
+                            n_epochs=500, eval_every=1, patience=5, early_stopping_metric='loss', validation_subsample=None, train_indices=None, validation_indices=None):
     '''
     Trains a classifier to predict positive events in samples.
     X_train is of shape (num_train_samples, 2, num_features, seq_len)
     y_train is of shape (num_train_samples, seq_len)
-
+    If packed_sequences is True (HiRID/ICU), batches group samples of similar lengths and the left padding is skipped by the encoder and the RnnPredictor.
+    If exact_metrics is True, the sklearn metrics are computed every epoch rather than only for the final classifier.
+    The validation set (or a fixed validation_subsample of it, see tnc.training.subsample_indices) is evaluated every eval_every
+    epochs, and training stops once the validation early_stopping_metric ('loss', 'auroc' or 'auprc') hasn't improved for
+    patience evaluations (never if patience is None). The classifier is then restored to its best evaluation, and only that
+    classifier is evaluated on TEST.
+    If train_indices (validation_indices) is given, only these rows of X_train and y_train (X_validation and y_validation)
+    are used, e.g. the folds of a tnc.folds.FoldManager over the full train set, without copying them.
+    For HiRID without packed_sequences, the samples are encoded once by the frozen encoder (see tnc.tasks.EncodingSource),
+    and the classifier is trained by a TaskEngine on the cached encodings instead of encoding every batch at every epoch.
     '''
     print("Training Linear Classifier", flush=True)
     if data_type==None:
@@ -451,14 +529,33 @@ def train_linear_classifier(X_train, y_train, X_validation, y_validation, X_TEST
         
    
     
-    print('X_train shape: ', X_train.shape)
+    if train_indices is None:
+        train_indices = np.arange(len(X_train))
+    if validation_indices is None:
+        validation_indices = np.arange(len(X_validation))
+    print('X_train shape: ', (len(train_indices),) + tuple(X_train.shape[1:]))
     print('batch_size: ', batch_size)
-    train_dataset = torch.utils.data.TensorDataset(X_train, y_train)
-    train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    validation_dataset = torch.utils.data.TensorDataset(X_validation, y_validation)
-    validation_data_loader = torch.utils.data.DataLoader(validation_dataset, batch_size=batch_size, shuffle=True)
-    TEST_dataset = torch.utils.data.TensorDataset(X_TEST, y_TEST)
-    TEST_data_loader = torch.utils.data.DataLoader(TEST_dataset, batch_size=batch_size, shuffle=True)
+    # The per epoch evaluations may run on a fixed subset of the validation set, the final one uses all of it
+    validation_eval_indices = subsample_indices(len(validation_indices), validation_subsample, seed=classification_cv)
+    validation_eval_indices = validation_indices if validation_eval_indices is None else validation_indices[validation_eval_indices]
+    train_dataset = indexed_dataset((X_train, y_train), train_indices)
+    validation_eval_dataset = indexed_dataset((X_validation, y_validation), validation_eval_indices)
+    validation_dataset = indexed_dataset((X_validation, y_validation), validation_indices)
+    TEST_dataset = indexed_dataset((X_TEST, y_TEST))
+    packed_sequences = packed_sequences and data_type != None
+    if packed_sequences:
+        # The lengths are computed once per base tensor and indexed like the datasets
+        train_lengths = encoding_lengths(X_train, window_size)
+        validation_lengths = train_lengths if X_validation is X_train else encoding_lengths(X_validation, window_size)
+        train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_sampler=LengthBucketSampler(train_lengths[train_indices], batch_size))
+        validation_eval_data_loader = torch.utils.data.DataLoader(validation_eval_dataset, batch_sampler=LengthBucketSampler(validation_lengths[validation_eval_indices], batch_size))
+        validation_data_loader = torch.utils.data.DataLoader(validation_dataset, batch_sampler=LengthBucketSampler(validation_lengths[validation_indices], batch_size))
+        TEST_data_loader = torch.utils.data.DataLoader(TEST_dataset, batch_sampler=LengthBucketSampler(encoding_lengths(X_TEST, window_size), batch_size))
+    else:
+        train_data_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
+        validation_eval_data_loader = torch.utils.data.DataLoader(validation_eval_dataset, batch_size=batch_size, shuffle=True)
+        validation_data_loader = torch.utils.data.DataLoader(validation_dataset, batch_size=batch_size, shuffle=True)
+        TEST_data_loader = torch.utils.data.DataLoader(TEST_dataset, batch_size=batch_size, shuffle=True)
     
     params = list(classifier.parameters())
     lr = .001
@@ -466,92 +563,80 @@ def train_linear_classifier(X_train, y_train, X_validation, y_validation, X_TEST
     print('Learning Rate for classifier training: ', lr)
     print('Weight Decay for classifier training: ', weight_decay)
     optimizer = torch.optim.Adam(params, lr=lr, weight_decay=weight_decay)
+    engine = None
+    if data_type == 'HiRID' and not packed_sequences:
+        encoder.eval()
+        source = EncodingSource(encoder, batch_size=batch_size, device=device)
+        sample_labels = lambda y: torch.Tensor([1 in label for label in y]) # 1 if the sample has a positive label
+        source.add('train', X_train)
+        source.add('TEST', X_TEST)
+        train_labels = sample_labels(y_train)
+        if X_validation is X_train:
+            validation_source, validation_labels = 'train', train_labels
+        else:
+            source.add('validation', X_validation)
+            validation_source, validation_labels = 'validation', sample_labels(y_validation)
+        task = Task('mortality', BinaryHead(pos_weight=10), {'train': ('train', train_labels[train_indices], train_indices),
+                                                              'validation_eval': (validation_source, validation_labels[validation_eval_indices], validation_eval_indices),
+                                                              'validation': (validation_source, validation_labels[validation_indices], validation_indices),
+                                                              'TEST': ('TEST', sample_labels(y_TEST), None)})
+        engine = TaskEngine(source, [task], hidden_size=8, lr=lr, weight_decay=weight_decay, batch_size=batch_size, device=device)
+        classifier, optimizer = engine.classifiers['mortality'], engine.optimizer
+
+    def epoch_run(split, data_loader, train=False, accumulator=None):
+        # split is the name of the engine's split of data_loader
+        if engine is not None:
+            return task_epoch_run(engine, 'mortality', split, train=train, accumulator=accumulator)
+        # linear_classifier_epoch_run(dataset, train, classifier, optimizer, data_type, window_size, encoder, encoding_size):
+        return linear_classifier_epoch_run(dataset=data_loader, train=train, classifier=classifier,
+                                           optimizer=optimizer, data_type=data_type, window_size=window_size, encoder=encoder, encoding_size=encoding_size,
+                                           packed_sequences=packed_sequences, accumulator=accumulator)
     train_losses = []
     valid_losses = []
+    valid_epochs = []
     
-    for epoch in range(1, 501):
+    controller = TrainingController(n_epochs, eval_every=eval_every, patience=patience, mode='min' if early_stopping_metric == 'loss' else 'max')
+    # Unless exact_metrics is set, the per epoch AUROC/AUPRC and classification reports come from histograms accumulated on
+    # device, and the exact sklearn metrics (and the PR/ROC curves) are computed once, for the best classifier.
+    accumulators = {split: BinaryMetricAccumulator(device=device) for split in ['train', 'validation']}
+    for epoch in range(1, n_epochs+1):
         encoder.eval()
-        # linear_classifier_epoch_run(dataset, train, classifier, optimizer, data_type, window_size, encoder, encoding_size):
-        epoch_train_predictions, epoch_train_losses, epoch_train_labels = linear_classifier_epoch_run(dataset=train_data_loader, train=True,
-                                                    classifier=classifier,
-                                                    optimizer=optimizer, data_type=data_type, window_size=window_size, encoder=encoder, encoding_size=encoding_size)
-
-        
-        classifier.eval()
-        epoch_validation_predictions, epoch_validation_losses, epoch_validation_labels = linear_classifier_epoch_run(dataset=validation_data_loader, train=False,
-                                                    classifier=classifier,
-                                                    optimizer=optimizer, data_type=data_type, window_size=window_size, encoder=encoder, encoding_size=encoding_size)
-
-        
-        
-
-        epoch_TEST_predictions, epoch_TEST_losses, epoch_TEST_labels = linear_classifier_epoch_run(dataset=TEST_data_loader, train=False,
-                                                    classifier=classifier,
-                                                    optimizer=optimizer, data_type=data_type, window_size=window_size, encoder=encoder, encoding_size=encoding_size)
-
-        
-        # TRAIN 
-        # Compute average over all batches in the epoch
-        epoch_train_loss = np.mean(epoch_train_losses)
-        epoch_train_predictions = torch.cat(epoch_train_predictions)
-        epoch_train_labels = torch.cat(epoch_train_labels)
-
-        epoch_train_auroc = roc_auc_score(epoch_train_labels, epoch_train_predictions)
-        # Compute precision recall curve
-        train_precision, train_recall, _ = precision_recall_curve(epoch_train_labels, epoch_train_predictions)
-        # Compute AUPRC
-        epoch_train_auprc = auc(train_recall, train_precision) # precision is the y axis, recall is the x axis, computes AUC of this curve
-
-        train_losses.append(epoch_train_loss)
-
-        # VALIDATION
-        epoch_validation_loss = np.mean(epoch_validation_losses)
-        epoch_validation_predictions = torch.cat(epoch_validation_predictions)
-        epoch_validation_labels = torch.cat(epoch_validation_labels)
-
-        epoch_validation_auroc = roc_auc_score(epoch_validation_labels, epoch_validation_predictions)
-        # Compute precision recall curve
-        valid_precision, valid_recall, _ = precision_recall_curve(epoch_validation_labels, epoch_validation_predictions)
-        # Compute AUPRC
-        epoch_validation_auprc = auc(valid_recall, valid_precision) # precision is the y axis, recall is the x axis, computes AUC of this curve
-        valid_losses.append(epoch_validation_loss)
-
-        # TEST
-        epoch_TEST_loss = np.mean(epoch_TEST_losses)
-        epoch_TEST_predictions = torch.cat(epoch_TEST_predictions)
-        epoch_TEST_labels = torch.cat(epoch_TEST_labels)
-
-        epoch_TEST_auroc = roc_auc_score(epoch_TEST_labels, epoch_TEST_predictions)
-        # Compute precision recall curve
-        TEST_precision, TEST_recall, _ = precision_recall_curve(epoch_TEST_labels, epoch_TEST_predictions)
-        # Compute AUPRC
-        epoch_TEST_auprc = auc(TEST_recall, TEST_precision) # precision is the y axis, recall is the x axis, computes AUC of this curve
-        
-
-        if epoch%10==0 or detect_incr_loss(valid_losses, 5):
-            print('Epoch %d Classifier Loss =====> Training Loss: %.5f \t Training AUROC: %.5f \t Training AUPRC: %.5f\t Validation Loss: %.5f \t Validation AUROC: %.5f \t Validation AUPRC %.5f\t TEST Loss: %.5f \t TEST AUROC: %.5f \t TEST AUPRC %.5f'
-                                % (epoch, epoch_train_loss, epoch_train_auroc, epoch_train_auprc, epoch_validation_loss, epoch_validation_auroc, epoch_validation_auprc, epoch_TEST_loss, epoch_TEST_auroc, epoch_TEST_auprc))
-            epoch_train_predictions_thresholded = torch.clone(epoch_train_predictions)
-            epoch_train_predictions_thresholded[epoch_train_predictions_thresholded >= 0.5] = 1
-            epoch_train_predictions_thresholded[epoch_train_predictions_thresholded < 0.5] = 0
-
-            epoch_validation_predictions_thresholded = torch.clone(epoch_validation_predictions)
-            epoch_validation_predictions_thresholded[epoch_validation_predictions_thresholded >= 0.5] = 1
-            epoch_validation_predictions_thresholded[epoch_validation_predictions_thresholded < 0.5] = 0
-
-            epoch_TEST_predictions_thresholded = torch.clone(epoch_TEST_predictions)
-            epoch_TEST_predictions_thresholded[epoch_TEST_predictions_thresholded >= 0.5] = 1
-            epoch_TEST_predictions_thresholded[epoch_TEST_predictions_thresholded < 0.5] = 0
-            
-            print("Train classification report: ")
-            print('epoch_train_labels shape: ', epoch_train_labels.shape, 'epoch_train_predictions_thresholded shape: ', epoch_train_predictions_thresholded.shape)
-            print(classification_report(epoch_train_labels.to('cpu'), epoch_train_predictions_thresholded, target_names=['normal', pos_sample_name]))
-            print("Validation classification report: ")
-            print(classification_report(epoch_validation_labels.to('cpu'), epoch_validation_predictions_thresholded, target_names=['normal', pos_sample_name]))
-            print()
-            print("TEST classification report: ")
-            print(classification_report(epoch_TEST_labels.to('cpu'), epoch_TEST_predictions_thresholded, target_names=['normal', pos_sample_name]))
-            print()
+        splits = [('train', 'train', train_data_loader)]
+        if controller.should_evaluate(epoch):
+            splits.append(('validation', 'validation_eval', validation_eval_data_loader))
+        epoch_losses, epoch_scores = {}, {}
+        for split, engine_split, data_loader in splits:
+            accumulator = None if exact_metrics else accumulators[split]
+            if accumulator is not None:
+                accumulator.reset()
+            if split != 'train':
+                classifier.eval()
+            epoch_predictions, split_losses, epoch_labels = epoch_run(engine_split, data_loader, train=(split == 'train'), accumulator=accumulator)
+            # Compute average over all batches in the epoch
+            epoch_losses[split] = np.mean(split_losses)
+            if exact_metrics:
+                epoch_scores[split] = exact_classifier_scores(epoch_predictions, epoch_labels)
+            else:
+                epoch_scores[split] = {'auroc': accumulator.auroc(), 'auprc': accumulator.auprc()}
+
+        train_losses.append(epoch_losses['train'])
+        if 'validation' not in epoch_losses:
+            continue
+        valid_losses.append(epoch_losses['validation'])
+        valid_epochs.append(epoch)
+        monitored_value = epoch_losses['validation'] if early_stopping_metric == 'loss' else epoch_scores['validation'][early_stopping_metric]
+        controller.update(epoch, monitored_value, {'classifier': classifier})
+
+        if len(valid_losses)%max(10//controller.eval_every, 1) == 0 or controller.should_stop:
+            print('Epoch %d Classifier Loss =====> Training Loss: %.5f \t Training AUROC: %.5f \t Training AUPRC: %.5f\t Validation Loss: %.5f \t Validation AUROC: %.5f \t Validation AUPRC %.5f'
+                                % (epoch, epoch_losses['train'], epoch_scores['train']['auroc'], epoch_scores['train']['auprc'], epoch_losses['validation'], epoch_scores['validation']['auroc'], epoch_scores['validation']['auprc']))
+            for split, _, _ in splits:
+                print("%s classification report: "%('Train' if split == 'train' else 'Validation'))
+                if exact_metrics:
+                    print(exact_classification_report(epoch_scores[split], ['normal', pos_sample_name]))
+                else:
+                    print(accumulators[split].classification_report(['normal', pos_sample_name]))
+                print()
 
 
             # Checkpointing the classifier model
@@ -562,8 +647,41 @@ def train_linear_classifier(X_train, y_train, X_validation, y_validation, X_TEST
                 }
 
             torch.save(state, os.path.join(ckpt_path, '%s/%s_encoder_checkpoint_%d_%sClassifier_checkpoint_%d.tar'%(data_type, UNIQUE_ID, encoder_cv, classifier_name, classification_cv)))
-            if detect_incr_loss(valid_losses, 5):
-                break
+        if controller.should_stop:
+            print('Stopping early at epoch %d: validation %s did not improve for %d evaluations'%(epoch, early_stopping_metric, controller.patience))
+            break
+
+    # The best classifier is the one that is checkpointed, returned and evaluated on the full validation set and TEST
+    controller.restore_best({'classifier': classifier})
+    print('Best validation %s %.5f at epoch %s'%(early_stopping_metric, controller.best_value, controller.best_epoch))
+    state = {
+            'epoch': controller.best_epoch,
+            'classifier_state_dict': classifier.state_dict(),
+        }
+    torch.save(state, os.path.join(ckpt_path, '%s/%s_encoder_checkpoint_%d_%sClassifier_checkpoint_%d.tar'%(data_type, UNIQUE_ID, encoder_cv, classifier_name, classification_cv)))
+
+    classifier.eval()
+    epoch_scores = {}
+    with torch.no_grad():
+        for split, data_loader in [('train', train_data_loader), ('validation', validation_data_loader), ('TEST', TEST_data_loader)]:
+            epoch_predictions, _, epoch_labels = epoch_run(split, data_loader)
+            epoch_scores[split] = exact_classifier_scores(epoch_predictions, epoch_labels)
+    print('Final Classifier =====> Training AUROC: %.5f \t Training AUPRC: %.5f\t Validation AUROC: %.5f \t Validation AUPRC %.5f\t TEST AUROC: %.5f \t TEST AUPRC %.5f'
+          % (epoch_scores['train']['auroc'], epoch_scores['train']['auprc'], epoch_scores['validation']['auroc'], epoch_scores['validation']['auprc'], epoch_scores['TEST']['auroc'], epoch_scores['TEST']['auprc']))
+    for split in ['train', 'validation', 'TEST']:
+        print("%s classification report: "%('Train' if split == 'train' else 'Validation' if split == 'validation' else split))
+        print(exact_classification_report(epoch_scores[split], ['normal', pos_sample_name]))
+        print()
+
+    train_precision, train_recall = epoch_scores['train']['precision'], epoch_scores['train']['recall']
+    epoch_train_predictions, epoch_train_labels = epoch_scores['train']['predictions'], epoch_scores['train']['labels']
+    valid_precision, valid_recall = epoch_scores['validation']['precision'], epoch_scores['validation']['recall']
+    epoch_validation_predictions, epoch_validation_labels = epoch_scores['validation']['predictions'], epoch_scores['validation']['labels']
+    TEST_precision, TEST_recall = epoch_scores['TEST']['precision'], epoch_scores['TEST']['recall']
+    epoch_TEST_predictions, epoch_TEST_labels = epoch_scores['TEST']['predictions'], epoch_scores['TEST']['labels']
+    epoch_validation_auroc, epoch_validation_auprc = epoch_scores['validation']['auroc'], epoch_scores['validation']['auprc']
+    epoch_TEST_auroc, epoch_TEST_auprc = epoch_scores['TEST']['auroc'], epoch_scores['TEST']['auprc']
+    
     
     # Plot ROC and PR Curves
     plt.figure()
@@ -616,7 +734,7 @@ def train_linear_classifier(X_train, y_train, X_validation, y_validation, X_TEST
     # Plot Loss curves
     plt.figure()
     plt.plot(np.arange(1, len(train_losses) + 1), train_losses, label="Train")
-    plt.plot(np.arange(1, len(valid_losses) + 1), valid_losses, label="Validation")
+    plt.plot(valid_epochs, valid_losses, label="Validation")
     plt.title("Loss")
     plt.legend()
     plt.savefig(os.path.join(plt_path, "%s/%s"%(data_type, UNIQUE_ID), "%s_Classifier_loss_%d_%d.pdf"%(UNIQUE_NAME, encoder_cv, classification_cv)))
@@ -780,12 +898,21 @@ def epoch_run(loader, disc_model, encoder, device, pruning_mask, w=0, optimizer=
 
 
 def learn_encoder(data_maps, encoder_type, encoder_hyper_params, pretrain_hyper_params, window_size, w, batch_size, lr=0.001, decay=0.005, mc_sample_size=20,
-                  n_epochs=100, data_type='simulation', device='cpu', n_cross_val_encoder=1, cont=False, ETA=None, ADF=True, ACF=False, ACF_PLUS=False, ACF_nghd_Threshold=0.4, ACF_out_nghd_Threshold=0.4):
-    
+                  n_epochs=100, data_type='simulation', device='cpu', n_cross_val_encoder=1, cont=False, ETA=None, ADF=True, ACF=False, ACF_PLUS=False, ACF_nghd_Threshold=0.4, ACF_out_nghd_Threshold=0.4,
+                  eval_every=1, patience=None, validation_subsample=None):
+    '''
+    The validation set (or a fixed validation_subsample of it) is evaluated every eval_every epochs. If patience is set,
+    training stops once the validation loss hasn't improved for patience evaluations, and the checkpoint is overwritten with
+    the encoder, discriminator and pruning mask of the best evaluation.
+    '''
     # x is of shape (num_samples, num_features, signal_length) OR (num_samples, 2, num_features, signal_length) if we have maps for
     # our data which indicate where we have missing values. for each sample (which is of shape (2, num_features, signal_length)), sample[0] would be the data, and sample[1] is the map
     
     accuracies, losses = [], []
+    # The folds are index arrays into data_maps rather than shuffled copies of it. As before, each cv shuffles the order of
+    # the previous one.
+    folds = FoldManager(data_maps, validation_first=False)
+    order = np.arange(len(data_maps))
     for cv in range(n_cross_val_encoder):
         random.seed(21*cv)
         print("LEARN ENCODER CV: ", cv)
@@ -813,12 +940,8 @@ def learn_encoder(data_maps, encoder_type, encoder_hyper_params, pretrain_hyper_
                 epoch_start = checkpoint['epoch'] + 1 # starting point for epochs is whatever was saved last + 1 (i.e. if we finished epoch 10 before saving, want to start on 11)
                 performance = checkpoint['performance']
         
-        inds = np.arange(len(data_maps))
-        random.shuffle(inds)
-        data_maps = data_maps[inds]
-
-        train_data = data_maps[0:int(0.8*len(data_maps))]
-        validation_data = data_maps[int(0.8*len(data_maps)):]
+        order = order[folds.shuffle()]
+        train_indices, validation_indices = folds.split(order)
 
         
         print("ETA, ADF, ACF, ACF_PLUS: ", ETA, ADF, ACF, ACF_PLUS)
@@ -832,17 +955,21 @@ def learn_encoder(data_maps, encoder_type, encoder_hyper_params, pretrain_hyper_
         elif ACF_PLUS:
             print("USING ACF_PLUS")
             
-        trainset = TNCDataset(x=train_data, mc_sample_size=mc_sample_size,
-                                window_size=window_size, eta=ETA, adf=ADF, acf=ACF, acf_plus=ACF_PLUS, ACF_nghd_Threshold=ACF_nghd_Threshold, ACF_out_nghd_Threshold=ACF_out_nghd_Threshold)
+        trainset = TNCDataset(x=data_maps, mc_sample_size=mc_sample_size,
+                                window_size=window_size, eta=ETA, adf=ADF, acf=ACF, acf_plus=ACF_PLUS, ACF_nghd_Threshold=ACF_nghd_Threshold, ACF_out_nghd_Threshold=ACF_out_nghd_Threshold, indices=train_indices)
         
         print('Done with TNCDataset for train data. Moving on to validation data...')
-        validset = TNCDataset(x=validation_data, mc_sample_size=mc_sample_size,
-                                window_size=window_size, eta=ETA, adf=ADF, acf=ACF, acf_plus=ACF_PLUS, ACF_nghd_Threshold=ACF_nghd_Threshold, ACF_out_nghd_Threshold=ACF_out_nghd_Threshold)
+        validset = TNCDataset(x=data_maps, mc_sample_size=mc_sample_size,
+                                window_size=window_size, eta=ETA, adf=ADF, acf=ACF, acf_plus=ACF_PLUS, ACF_nghd_Threshold=ACF_nghd_Threshold, ACF_out_nghd_Threshold=ACF_out_nghd_Threshold, indices=validation_indices)
 
         print("Done making TNCDataset object for validation data")
 
         train_loader = data.DataLoader(trainset, batch_size=batch_size, shuffle=True)
-        valid_loader = data.DataLoader(validset, batch_size=batch_size, shuffle=True)
+        if validation_subsample is None:
+            valid_loader = data.DataLoader(validset, batch_size=batch_size, shuffle=True)
+        else:
+            valid_loader = subsample_loader(validset, batch_size, validation_subsample, seed=cv)
+        controller = TrainingController(n_epochs, eval_every=eval_every, patience=patience, mode='min')
 
         
         
@@ -857,7 +984,11 @@ def learn_encoder(data_maps, encoder_type, encoder_hyper_params, pretrain_hyper_
                 
                 epoch_loss, epoch_acc, pruning_mask = epoch_run(train_loader, disc_model, encoder, optimizer=optimizer,
                                                 w=w, train=True, device=device, acf_plus=ACF_PLUS, compute_pruning_mask=compute_mask, pruning_mask=pruning_mask)
-                validation_loss, validation_acc, _ = epoch_run(valid_loader, disc_model, encoder, train=False, w=w, device=device, acf_plus=ACF_PLUS, compute_pruning_mask=False, pruning_mask=pruning_mask)
+                if controller.should_evaluate(epoch):
+                    validation_loss, validation_acc, _ = epoch_run(valid_loader, disc_model, encoder, train=False, w=w, device=device, acf_plus=ACF_PLUS, compute_pruning_mask=False, pruning_mask=pruning_mask)
+                    controller.update(epoch, validation_loss, {'encoder': encoder, 'discriminator': disc_model}, extra_state=pruning_mask)
+                else:
+                    validation_loss, validation_acc = np.nan, np.nan
                 
                 performance.append((epoch_loss, validation_loss, epoch_acc, validation_acc))
                 if epoch%10 == 0:
@@ -909,7 +1040,37 @@ def learn_encoder(data_maps, encoder_type, encoder_hyper_params, pretrain_hyper_
                 if best_loss > validation_loss:
                     best_acc = validation_acc
                     best_loss = validation_loss
-                    
+
+                if controller.should_stop:
+                    print('(cv:%s)Stopping early at epoch %d: validation loss did not improve for %d evaluations'%(cv, epoch, patience))
+                    break
+
+            if patience is not None and controller.best_epoch is not None:
+                # Checkpoint the best evaluation rather than the last epoch
+                pruning_mask = controller.restore_best({'encoder': encoder, 'discriminator': disc_model})
+                encoder.pruning_mask = pruning_mask
+                encoder.pruned_encoding_size = int(torch.sum(pruning_mask))
+                print('(cv:%s)Restoring the encoder of epoch %d (validation loss %.5f)'%(cv, controller.best_epoch, controller.best_value))
+                state = {
+                    'epoch': epoch,
+                    'encoder_state_dict': encoder.state_dict(),
+                    'discriminator_state_dict': disc_model.state_dict(),
+                    'best_accuracy': best_acc,
+                    'best_epoch': controller.best_epoch,
+                    'performance': performance,
+                    'encoder_hyper_params': encoder_hyper_params,
+                    'learn_encoder_hyper_params': LEARN_ENCODER_HYPER_PARAMS,
+                    'classification_hyper_params': CLASSIFICATION_HYPER_PARAMS,
+                    'pretrain_hyper_params': PRETRAIN_HYPER_PARAMS,
+                    'unique_id': UNIQUE_ID,
+                    'unique_name': UNIQUE_NAME,
+                    'data_type': DATA_TYPE,
+                    'encoder_type': ENCODER_TYPE,
+                    'pruning_mask': pruning_mask
+                }
+
+                torch.save(state, './ckpt/%s/%s_checkpoint_%d.tar'%(data_type, UNIQUE_NAME, cv))
+
             accuracies.append(best_acc)
             losses.append(best_loss)
             # Save performance plots
@@ -921,15 +1082,18 @@ def learn_encoder(data_maps, encoder_type, encoder_hyper_params, pretrain_hyper_
             train_acc = [t[2] for t in performance]
             validation_acc = [t[3] for t in performance]
             
+            # Validation is nan on the epochs it wasn't evaluated on, and training may have stopped before n_epochs
+            epochs = np.arange(len(performance))
+            evaluated = ~np.isnan(validation_loss)
             plt.figure()
-            plt.plot(np.arange(n_epochs+1), train_loss, label="Train")
-            plt.plot(np.arange(n_epochs+1), validation_loss, label="Validation")
+            plt.plot(epochs, train_loss, label="Train")
+            plt.plot(epochs[evaluated], np.array(validation_loss)[evaluated], label="Validation")
             plt.title("Loss")
             plt.legend()
             plt.savefig(os.path.join("./DONTCOMMITplots/%s/%s"%(data_type, UNIQUE_ID), "%s_loss_%d.pdf"%(UNIQUE_NAME, cv)))
             plt.figure()
-            plt.plot(np.arange(n_epochs+1), train_acc, label="Train")
-            plt.plot(np.arange(n_epochs+1), validation_acc, label="Validation")
+            plt.plot(epochs, train_acc, label="Train")
+            plt.plot(epochs[evaluated], np.array(validation_acc)[evaluated], label="Validation")
             plt.title("Accuracy")
             plt.legend()
             plt.savefig("./DONTCOMMITplots/%s/%s/%s_discriminator_accuracy_%d.pdf"%(data_type, UNIQUE_ID, UNIQUE_NAME, cv))
@@ -1014,6 +1178,7 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
             # Used for training encoder
             TEST_encoder_data_maps = torch.from_numpy(np.load(os.path.join(path, 'test_mixed_data_maps.npy')))
             train_encoder_data_maps = torch.from_numpy(np.load(os.path.join(path, 'train_mixed_data_maps.npy')))
+            encoder_data_files = {'train': os.path.join(path, 'train_mixed_data_maps.npy'), 'TEST': os.path.join(path, 'test_mixed_data_maps.npy')}
             
             if learn_encoder_hyper_params['ADF']:
                 print('USING ADF')
@@ -1078,6 +1243,7 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
             # Used for training encoder
             train_encoder_data_maps = torch.from_numpy(np.load(os.path.join(path, 'train_encoder_data_maps.npy'))).float()
             TEST_encoder_data_maps = torch.from_numpy(np.load(os.path.join(path, 'TEST_encoder_data_maps.npy'))).float()
+            encoder_data_files = {'train': os.path.join(path, 'train_encoder_data_maps.npy'), 'TEST': os.path.join(path, 'TEST_encoder_data_maps.npy')}
             
             if learn_encoder_hyper_params['ADF']:
                 print('USING ADF')
@@ -1119,6 +1285,12 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
                 print(unique[i], ': ', counts[i])
             
 
+    if train_encoder and encoder_type == 'GRUD' and train_encoder_data_maps.shape[1] == 2:
+        # Delta only depends on the maps, so it's computed once for the whole dataset and cached next to the data_maps (and
+        # recomputed when the data_maps files change)
+        train_encoder_data_maps = add_grud_delta_channel(train_encoder_data_maps, cache_file=None if DEBUG else os.path.join(path, 'train_encoder_grud_delta.npy'), source_file=encoder_data_files['train'])
+        TEST_encoder_data_maps = add_grud_delta_channel(TEST_encoder_data_maps, cache_file=None if DEBUG else os.path.join(path, 'TEST_encoder_grud_delta.npy'), source_file=encoder_data_files['TEST'])
+
     if train_encoder:
         print('Entering learn_encoder')
         print("Current Time ", datetime.now())
@@ -1136,6 +1308,11 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
     classifier_TEST_aurocs = []
     classifier_TEST_auprcs = []
 
+    # Every classification fold is a pair of index arrays into train_mixed_data_maps and train_mixed_labels, which aren't copied
+    folds = FoldManager(train_mixed_data_maps, train_mixed_labels)
+    if not learn_encoder_hyper_params['ADF']:
+        missing_per_sample = torch.sum(train_mixed_data_maps[:, 1, :, :] == 0, dim=(1, 2)) # Number of missing values of each sample
+    positive_samples = torch.tensor([1 in train_mixed_labels[ind] for ind in range(len(train_mixed_labels))])
     for encoder_cv in range(learn_encoder_hyper_params['n_cross_val_encoder']):
         for classification_cv in range(classification_hyper_params['n_cross_val_classification']):
             print('SETTING SEED TO 111*CV + 2*(classification_cv+1)')
@@ -1157,25 +1334,17 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
                 print('Original shape of train data: ')
                 print(train_mixed_data_maps.shape)
                 # shuffle for this cv:
-                inds = np.arange(len(train_mixed_data_maps))
-                random.shuffle(inds)
+                inds = folds.shuffle()
                 print("First 15 inds: ", inds[:15])
-                train_mixed_data_maps_cv = train_mixed_data_maps[inds]
-                train_mixed_labels_cv = train_mixed_labels[inds]
-
-                n_valid = int(0.2*len(train_mixed_data_maps_cv))
-                validation_mixed_data_maps_cv = train_mixed_data_maps_cv[0:n_valid]
-                validation_mixed_labels_cv = train_mixed_labels_cv[0:n_valid]
+                train_indices, validation_indices = folds.split(inds)
                 
-                print("Size of valid data: ", validation_mixed_data_maps_cv.shape)
-                print("Size of valid labels: ", validation_mixed_labels_cv.shape)
-                print("num positive valid samples: ", sum([1 in validation_mixed_labels_cv[ind] for ind in range(len(validation_mixed_labels_cv))]))
+                print("Size of valid data: ", (len(validation_indices),) + tuple(train_mixed_data_maps.shape[1:]))
+                print("Size of valid labels: ", (len(validation_indices),) + tuple(train_mixed_labels.shape[1:]))
+                print("num positive valid samples: ", int(torch.sum(positive_samples[validation_indices])))
 
-                train_mixed_data_maps_cv = train_mixed_data_maps_cv[n_valid:]
-                train_mixed_labels_cv = train_mixed_labels_cv[n_valid:]
-                print("Size of train data: ", train_mixed_data_maps_cv.shape)
-                print("Size of train labels: ", train_mixed_labels_cv.shape)
-                print("num positive train samples: ", sum([1 in train_mixed_labels_cv[ind] for ind in range(len(train_mixed_labels_cv))]))
+                print("Size of train data: ", (len(train_indices),) + tuple(train_mixed_data_maps.shape[1:]))
+                print("Size of train labels: ", (len(train_indices),) + tuple(train_mixed_labels.shape[1:]))
+                print("num positive train samples: ", int(torch.sum(positive_samples[train_indices])))
 
                 print('Size of TEST data: ', TEST_mixed_data_maps.shape)
                 print('Size of TEST labels: ', TEST_mixed_labels.shape)
@@ -1184,29 +1353,29 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
                 if not learn_encoder_hyper_params['ADF']:
                     print('Levels of missingness, for Train, Validation, and TEST')
                 
-                    print(len(torch.where(train_mixed_data_maps_cv[:, 1, :, :] == 0)[0])/ \
-                    (train_mixed_data_maps_cv.shape[0]*train_mixed_data_maps_cv.shape[2]*train_mixed_data_maps_cv.shape[3]))
+                    print(int(torch.sum(missing_per_sample[train_indices]))/ \
+                    (len(train_indices)*train_mixed_data_maps.shape[2]*train_mixed_data_maps.shape[3]))
 
-                    print(len(torch.where(validation_mixed_data_maps_cv[:, 1, :, :] == 0)[0])/ \
-                    (validation_mixed_data_maps_cv.shape[0]*validation_mixed_data_maps_cv.shape[2]*validation_mixed_data_maps_cv.shape[3]))
+                    print(int(torch.sum(missing_per_sample[validation_indices]))/ \
+                    (len(validation_indices)*train_mixed_data_maps.shape[2]*train_mixed_data_maps.shape[3]))
 
                     print(len(torch.where(TEST_mixed_data_maps[:, 1, :, :] == 0)[0])/ \
                     (TEST_mixed_data_maps.shape[0]*TEST_mixed_data_maps.shape[2]*TEST_mixed_data_maps.shape[3]))
                 
                 print('Mean of signal 1 for train:')
-                print(torch.mean(train_mixed_data_maps_cv[:, 0, 0, :]))
+                print(torch.mean(train_mixed_data_maps[train_indices, 0, 0, :]))
                 print('Mean of signal 2 for train:')
-                print(torch.mean(train_mixed_data_maps_cv[:, 0, 1, :]))
+                print(torch.mean(train_mixed_data_maps[train_indices, 0, 1, :]))
                 print('Mean of signal 3 for train:')
-                print(torch.mean(train_mixed_data_maps_cv[:, 0, 2, :]))
+                print(torch.mean(train_mixed_data_maps[train_indices, 0, 2, :]))
 
 
                 print('Mean of signal 1 for validation:')
-                print(torch.mean(validation_mixed_data_maps_cv[:, 0, 0, :]))
+                print(torch.mean(train_mixed_data_maps[validation_indices, 0, 0, :]))
                 print('Mean of signal 2 for validation:')
-                print(torch.mean(validation_mixed_data_maps_cv[:, 0, 1, :]))
+                print(torch.mean(train_mixed_data_maps[validation_indices, 0, 1, :]))
                 print('Mean of signal 3 for validation:')
-                print(torch.mean(validation_mixed_data_maps_cv[:, 0, 2, :]))
+                print(torch.mean(train_mixed_data_maps[validation_indices, 0, 2, :]))
 
 
                 print('Mean of signal 1 for TEST:')
@@ -1218,7 +1387,20 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
 
                 
             
-                if os.path.exists('./ckpt/%s/%s_encoder_checkpoint_%d_%sClassifier_checkpoint_%d.tar'%(data_type, UNIQUE_ID, encoder_cv, 'circulatory' if circulatory_failure else '', classification_cv)):
+                if classification_hyper_params.get('probe', 'rnn') == 'linear' and (data_type == 'HiRID' or data_type == 'ICU'):
+                    # Quick check of the encoder (e.g. for hyperparameter sweeps): a logistic regression on the pooled encodings of each patient
+                    print("FITTING LINEAR PROBE")
+                    validation_metrics, TEST_metrics = linear_probe(encoder, train_mixed_data_maps, train_mixed_labels,
+                    train_mixed_data_maps, train_mixed_labels, TEST_mixed_data_maps, TEST_mixed_labels,
+                    pooling=classification_hyper_params.get('probe_pooling', 'last'), device=device, train_indices=train_indices, validation_indices=validation_indices)
+                    print('Linear probe validation: %s \t TEST: %s'%(format_metrics(validation_metrics), format_metrics(TEST_metrics)))
+                    classifier = None
+                    classifier_validation_aurocs.append(validation_metrics['auroc'])
+                    classifier_validation_auprcs.append(validation_metrics['auprc'])
+                    classifier_TEST_aurocs.append(TEST_metrics['auroc'])
+                    classifier_TEST_auprcs.append(TEST_metrics['auprc'])
+
+                elif os.path.exists('./ckpt/%s/%s_encoder_checkpoint_%d_%sClassifier_checkpoint_%d.tar'%(data_type, UNIQUE_ID, encoder_cv, 'circulatory' if circulatory_failure else '', classification_cv)):
                     checkpoint = torch.load('./ckpt/%s/%s_encoder_checkpoint_%d_Classifier_checkpoint_%d.tar'%(data_type, UNIQUE_ID, encoder_cv, classification_cv))
                     if data_type == 'HiRID' or data_type == 'ICU':
                         classifier = RnnPredictor(encoding_size=encoder.pruned_encoding_size, hidden_size=8).to(device)
@@ -1232,8 +1414,8 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
                 
                 else:
                     
-                    train_pos_sample_inds = [ind for ind in range(len(train_mixed_labels_cv)) if 1 in train_mixed_labels_cv[ind]]
-                    train_neg_sample_inds = [ind for ind in range(len(train_mixed_labels_cv)) if 1 not in train_mixed_labels_cv[ind]]
+                    train_pos_sample_inds = [ind for ind in train_indices if positive_samples[ind]]
+                    train_neg_sample_inds = [ind for ind in train_indices if not positive_samples[ind]]
                     
                     inds_for_classification = train_pos_sample_inds.copy()
 
@@ -1247,15 +1429,17 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
                                             (train_mixed_data_maps.shape[-1]/window_size)) # then divide by seq_len/window_size, i.e. the number of encodings we get from each negative sample.
                         inds_for_classification.extend(train_neg_sample_inds[:min(num_negatives_to_add, len(train_neg_sample_inds))])
 
-                    train_mixed_data_maps_cv = train_mixed_data_maps_cv[inds_for_classification]
-                    train_mixed_labels_cv = train_mixed_labels_cv[inds_for_classification]
+                    train_indices = np.array(inds_for_classification)
                     '''
                     print("TRAINING LINEAR CLASSIFIER")
-                    classifier, valid_auroc, valid_auprc, TEST_auroc, TEST_auprc = train_linear_classifier(X_train=train_mixed_data_maps_cv, y_train=train_mixed_labels_cv, 
-                    X_validation=validation_mixed_data_maps_cv, y_validation=validation_mixed_labels_cv, 
+                    classifier, valid_auroc, valid_auprc, TEST_auroc, TEST_auprc = train_linear_classifier(X_train=train_mixed_data_maps, y_train=train_mixed_labels, 
+                    X_validation=train_mixed_data_maps, y_validation=train_mixed_labels, 
                     X_TEST=TEST_mixed_data_maps, y_TEST=TEST_mixed_labels,
                     encoding_size=encoder.pruned_encoding_size, batch_size=20, num_pre_positive_encodings=num_pre_positive_encodings, encoder=encoder, window_size=encoder_hyper_params['window_size'], return_models=True, return_scores=True, pos_sample_name=pos_sample_name, 
-                    data_type=data_type, classification_cv=classification_cv, encoder_cv=encoder_cv)
+                    data_type=data_type, classification_cv=classification_cv, encoder_cv=encoder_cv, packed_sequences=classification_hyper_params.get('packed_sequences', False),
+                    eval_every=classification_hyper_params.get('eval_every', 1), patience=classification_hyper_params.get('patience', 5),
+                    early_stopping_metric=classification_hyper_params.get('early_stopping_metric', 'loss'), validation_subsample=classification_hyper_params.get('validation_subsample', None),
+                    train_indices=train_indices, validation_indices=validation_indices)
 
                     classifier_validation_aurocs.append(valid_auroc)
                     classifier_validation_auprcs.append(valid_auprc)
@@ -1279,7 +1463,9 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
                     
     print("Starting encoding clustering on train/validation set..")
 
-    if plot_embeddings:
+    if plot_embeddings and classifier is None:
+        print("The embedding and risk plots need a trained RnnPredictor, they're skipped with the linear probe")
+    elif plot_embeddings:
         encoder.eval()
         classifier.eval()
         train_pos_sample_inds = [ind for ind in range(len(train_mixed_labels)) if 1 in train_mixed_labels[ind]]
@@ -1326,9 +1512,10 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
         print('shape of train mixed labels: ', train_mixed_labels.shape)
         # clustering_encodings is of shape (num_samples, seq_len//window_size, encoding_size)
         # encoding_mask is of shape (num_samples, seq_len//window_size)
-        pos_clustering_encodings, pos_encoding_mask = encoder.forward_seq(clustering_data_maps[pos_inds][:, :, :, -pre_positive_window:], return_encoding_mask=True)
+        # Windows derived from fully imputed data are never encoded, their rows are left as zeros
+        pos_clustering_encodings, pos_encoding_mask = encoder.forward_seq(clustering_data_maps[pos_inds][:, :, :, -pre_positive_window:], return_encoding_mask=True, skip_imputed=True)
         
-        neg_clustering_encodings, neg_encoding_mask = encoder.forward_seq(clustering_data_maps[neg_inds], return_encoding_mask=True)
+        neg_clustering_encodings, neg_encoding_mask = encoder.forward_seq(clustering_data_maps[neg_inds], return_encoding_mask=True, skip_imputed=True)
 
         # clustering_encodings = torch.vstack([pos_clustering_encodings, neg_clustering_encodings])
         # encoding_mask = torch.vstack([pos_encoding_mask, neg_encoding_mask])
@@ -1426,15 +1613,10 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
             for group in apache_groups_to_plot:
                 inds = torch.where(TEST_Apache_Groups==group)[0][0:10] # Get first 10 indices
                 
-                for ind in inds:
-                    sample = TEST_mixed_data_maps[ind].unsqueeze(0)
-                    encodings, encoding_mask = encoder.forward_seq(sample, return_encoding_mask=True)
-                    encodings = encodings.squeeze() # of shape (num_encodings, encoding_size)
-                    encoding_mask = encoding_mask.squeeze() # of shape (num_encodings,)
-                    for i in range(len(encodings)):
-                        if encoding_mask[i] != -1:
-                            apache_group_encodings.append(encodings[i])
-                            labels.append(TEST_Apache_Groups[ind])
+                # Only the encodings that were not derived from fully imputed data, of shape (num_kept_encodings, encoding_size)
+                encodings = encoder.forward_seq(TEST_mixed_data_maps[inds], skip_imputed=True, packed=True)
+                apache_group_encodings.append(encodings)
+                labels.extend([group]*len(encodings))
             
             labels = torch.Tensor(labels).cpu().numpy()
             apache_group_encodings = torch.vstack(apache_group_encodings).cpu().detach().numpy()
@@ -1492,12 +1674,16 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
         print('indexes_chosen_to_plot :', indexes_chosen_to_plot)
         negative_masks = []
         
+        # Risk trajectories (over the sliding windows) and encodings (of the non overlapping windows, for the heatmaps) of all
+        # the plotted samples, computed in batches
+        plotted_risks, plotted_encodings_for_rnn = compute_risk_trajectories(train_mixed_data_maps[indexes_chosen_to_plot], encoder, classifier, stride=sliding_gap)
+        _, plotted_encodings = compute_risk_trajectories(train_mixed_data_maps[indexes_chosen_to_plot], encoder)
         for plot_index, ind in enumerate(indexes_chosen_to_plot):
+            # encodings_for_rnn is of shape (num_sliding_windows, encoding_size)
+            encodings_for_rnn = plotted_encodings_for_rnn[plot_index]
+            encodings = plotted_encodings[plot_index]
+            risk_scores_over_time = plotted_risks[plot_index]
             if plot_index < num_positive_plotted:
-                # encodings_for_rnn is of shape (1, num_sliding_windows, encoding_size)
-                encodings_for_rnn = encoder.forward_seq(train_mixed_data_maps[ind], sliding_gap=sliding_gap)
-                encodings = encoder.forward_seq(train_mixed_data_maps[ind]).squeeze()
-                
                 num_pos_encodings = pos_clustering_encodings.shape[1] # The number of encodings generated for a positive sample during clustering (its large because of sliding_gap)
                 cluster_labels = clustering_model.labels_[plot_index*num_pos_encodings: (plot_index+1)*num_pos_encodings]
                 
@@ -1507,8 +1693,7 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
                     cluster_labels = np.concatenate([-1*np.ones(diff), cluster_labels])
             
             else:
-                encodings_for_rnn = encoder.forward_seq(train_mixed_data_maps[ind], sliding_gap=sliding_gap)
-                encodings = neg_clustering_encodings[plot_index-num_positive_plotted]
+                # neg_clustering_encodings has zeros for the skipped windows, so the heatmap uses the full set of encodings
                 mask = neg_encoding_mask[plot_index - num_positive_plotted]
                 num_vals_to_skip = 0
                 for negative_mask in negative_masks:
@@ -1528,19 +1713,7 @@ def main(train_encoder, data_type, encoder_type, encoder_hyper_params, learn_enc
                 
                 
 
-            # encoding_batch is of size (1, seq_len, encoding_size) 
-            if data_type == 'HiRID':
-                output = classifier(encodings_for_rnn, return_full_seq=True) # output contains hidden state for each time step. Shape is (1, seq_len)
-            else:
-                encodings_for_rnn = encodings_for_rnn.squeeze()
-                output = classifier(encodings_for_rnn)
-            output = output.squeeze() # now of shape (seq_len, hidden_size). Can be thought of as seq_len hidden states, each of size hidden_size
-            
-            risk_scores_over_time = torch.nn.Sigmoid()(output.to('cpu')).detach() # Apply sigmoid because the classifier doesn't apply this because we use BCEWITHLOGITSLOSS in train_linear_classifier
-
-
-            encodings = encodings.to('cpu')
-            encodings = encodings.detach().numpy().astype(np.float) # Removes gradients and converts to numpy
+            encodings = encodings.numpy().astype(np.float)
             
             
             '''
@@ -0,0 +1,92 @@
+"""
+Evaluation cadence, early stopping and best-state restore shared by the encoder and classifier training loops.
+
+The training loops run the validation set only on the epochs TrainingController.should_evaluate returns True for,
+report the validation metric to TrainingController.update, and stop once should_stop is True. The weights of the best
+evaluation are kept in memory (on CPU), so restore_best gives back the best models without reloading a checkpoint.
+"""
+
+import copy
+import numpy as np
+import torch
+
+
+class TrainingController():
+    '''
+    Evaluates every eval_every epochs (and at the last one, n_epochs), and stops when the monitored metric hasn't improved
+    by more than min_delta for patience evaluations in a row (never stops early if patience is None). mode is 'min' for
+    metrics like losses and 'max' for metrics like AUROC.
+    '''
+    def __init__(self, n_epochs, eval_every=1, patience=None, mode='min', min_delta=0.):
+        if mode not in ['min', 'max']:
+            raise ValueError("mode must be 'min' or 'max', not %s"%mode)
+        self.n_epochs = n_epochs
+        self.eval_every = max(int(eval_every), 1)
+        self.patience = patience
+        self.mode = mode
+        self.min_delta = min_delta
+        self.best_value = np.inf if mode == 'min' else -np.inf
+        self.best_epoch = None
+        self.best_state = None
+        self.best_extra_state = None
+        self.num_bad_evaluations = 0
+
+    def should_evaluate(self, epoch):
+        return epoch%self.eval_every == 0 or epoch == self.n_epochs
+
+    def is_improvement(self, value):
+        if self.mode == 'min':
+            return value < self.best_value - self.min_delta
+        return value > self.best_value + self.min_delta
+
+    def update(self, epoch, value, models, extra_state=None):
+        '''
+        Records the metric value of an evaluation. models is a dict of name to torch Module whose weights are kept if the
+        value is the best so far, along with extra_state (e.g. the encoder's pruning mask). Returns True iff it is the best.
+        '''
+        if not self.is_improvement(value):
+            self.num_bad_evaluations += 1
+            return False
+        self.best_value = value
+        self.best_epoch = epoch
+        self.num_bad_evaluations = 0
+        self.best_state = {name: {key: tensor.detach().cpu().clone() for key, tensor in model.state_dict().items()}
+                           for name, model in models.items()}
+        self.best_extra_state = copy.deepcopy(extra_state)
+        return True
+
+    @property
+    def should_stop(self):
+        return self.patience is not None and self.num_bad_evaluations >= self.patience
+
+    def restore_best(self, models):
+        '''Loads the best weights back into models (in place) and returns the extra_state saved with them (None if no
+        evaluation was recorded, in which case models are left as they are).'''
+        if self.best_state is None:
+            return None
+        for name, model in models.items():
+            model.load_state_dict(self.best_state[name])
+        return self.best_extra_state
+
+
+def subsample_indices(num_samples, subsample=None, seed=0):
+    '''
+    Sorted indices of a fixed random subset of num_samples samples, so that each evaluation is run on the same samples.
+    subsample is either a fraction of the samples (float in (0, 1]) or a number of samples (int). Returns None (all the
+    samples) if subsample is None or covers every sample.
+    '''
+    if subsample is None:
+        return None
+    num_kept = int(round(subsample*num_samples)) if isinstance(subsample, float) else int(subsample)
+    num_kept = min(max(num_kept, 1), num_samples)
+    if num_kept == num_samples:
+        return None
+    return np.sort(np.random.RandomState(seed).choice(num_samples, num_kept, replace=False))
+
+
+def subsample_loader(dataset, batch_size, subsample=None, seed=0):
+    '''DataLoader over the subset of dataset given by subsample_indices (the whole dataset if subsample is None).'''
+    indices = subsample_indices(len(dataset), subsample, seed)
+    if indices is not None:
+        dataset = torch.utils.data.Subset(dataset, indices.tolist())
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
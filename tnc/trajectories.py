@@ -0,0 +1,91 @@
+"""
+Batched risk trajectories of an encoder and classifier, for the plotting and analysis code.
+
+compute_risk_trajectories encodes batch_size patients at a time with forward_seq (with a sliding_gap of stride) and runs
+the classifier over each patient's sequence of encodings, instead of encoding and classifying one patient at a time.
+"""
+
+import os
+import hashlib
+import numpy as np
+import torch
+
+
+def model_hash(model):
+    '''sha1 of the parameters and buffers of model (and of the pruning_mask of an encoder), or '' if model is None.'''
+    if model is None:
+        return ''
+    sha = hashlib.sha1()
+    state = list(model.state_dict().items())
+    if getattr(model, 'pruning_mask', None) is not None:
+        state.append(('pruning_mask', model.pruning_mask))
+    for name, value in state:
+        sha.update(name.encode())
+        if isinstance(value, torch.Tensor):
+            value = value.int_repr() if value.is_quantized else value
+            sha.update(value.detach().cpu().contiguous().numpy().tobytes())
+        else: # e.g. the packed parameters of quantized layers
+            sha.update(repr(value).encode())
+    return sha.hexdigest()
+
+
+def compute_risk_trajectories(data_maps, encoder, classifier=None, stride=None, batch_size=64, positive_class=1, cache_file=None, device=None):
+    '''
+    Takes data_maps of shape (num_samples, 2, num_features, seq_len) (a tensor or a, possibly memory mapped, numpy array).
+    Returns (risks, encodings), CPU tensors of shape (num_samples, num_windows) and (num_samples, num_windows, encoding_size),
+    where the windows start every stride time steps (every window_size if stride is None, i.e. non overlapping windows).
+
+    The risk at each window is the sigmoid of a single output RnnPredictor, or the softmax probability of positive_class for
+    a multi-class one (positive_class=None keeps all the classes, of shape (num_samples, num_windows, n_classes)). Classifiers
+    without predict_trajectories (e.g. LinearClassifier) are applied to each encoding. risks is None if classifier is None.
+    If cache_file is given, the outputs are loaded from it if it exists, and saved to it (with np.savez) otherwise. The
+    cache also holds the hashes of the encoder and classifier (see model_hash), the stride and positive_class, and a
+    ValueError is raised if they don't match the arguments (delete the file to recompute the trajectories).
+    '''
+    if cache_file is not None and not cache_file.endswith('.npz'):
+        cache_file = cache_file + '.npz' # np.savez adds the extension
+    # What the cached outputs were computed with
+    parameters = {'encoder_hash': model_hash(encoder), 'classifier_hash': model_hash(classifier),
+                  'stride': stride if stride is not None else encoder.window_size,
+                  'positive_class': positive_class if positive_class is not None else -1}
+    if cache_file is not None and os.path.exists(cache_file):
+        cached = np.load(cache_file)
+        if len(cached['encodings']) != len(data_maps):
+            raise ValueError('%s holds the trajectories of %d samples, not %d'%(cache_file, len(cached['encodings']), len(data_maps)))
+        for name, value in parameters.items():
+            if name not in cached.files or cached[name].item() != value:
+                raise ValueError('%s was computed with a different %s (%s, not %s)'%(cache_file, name, cached[name].item() if name in cached.files else None, value))
+        risks = torch.from_numpy(cached['risks']) if 'risks' in cached.files else None
+        return risks, torch.from_numpy(cached['encodings'])
+
+    device = device if device is not None else getattr(encoder, 'device', 'cpu')
+    if classifier is not None:
+        classifier.eval()
+    risks, encodings = [], []
+    with torch.no_grad():
+        for start in range(0, len(data_maps), batch_size):
+            batch = data_maps[start:start+batch_size]
+            if isinstance(batch, np.ndarray):
+                batch = torch.from_numpy(np.array(batch)) # Copied out of a (read only) memory map
+            batch_encodings = encoder.forward_seq(batch.float().to(device), sliding_gap=stride)
+            encodings.append(batch_encodings.cpu())
+            if classifier is None:
+                continue
+            if hasattr(classifier, 'predict_trajectories'):
+                batch_risks = classifier.predict_trajectories(batch_encodings, batch_size=batch_size)
+            else:
+                # One prediction per encoding, of shape (batch_size*num_windows, n_classes)
+                predictions = classifier(batch_encodings.reshape(-1, batch_encodings.shape[-1])).reshape(batch_encodings.shape[0], batch_encodings.shape[1], -1)
+                batch_risks = torch.sigmoid(predictions.squeeze(-1)) if predictions.shape[-1] == 1 else torch.softmax(predictions, dim=-1)
+            if batch_risks.dim() == 3 and positive_class is not None:
+                batch_risks = batch_risks[:, :, positive_class]
+            risks.append(batch_risks.cpu())
+    encodings = torch.cat(encodings)
+    risks = torch.cat(risks) if classifier is not None else None
+
+    if cache_file is not None:
+        outputs = dict(parameters, encodings=encodings.numpy())
+        if risks is not None:
+            outputs['risks'] = risks.numpy()
+        np.savez(cache_file, **outputs)
+    return risks, encodings
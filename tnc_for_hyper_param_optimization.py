@@ -92,8 +92,16 @@ if __name__ == '__main__':
 
     # Classifier hyper params
     parser.add_argument('--n_cross_val_classification', type=int)
+    parser.add_argument('--packed_sequences', action='store_true', help='Batch patients by length and skip their left padding in the RnnPredictor')
+    parser.add_argument('--probe', type=str, default=None, choices=['linear', 'rnn'], help='linear: logistic regression on pooled encodings (fast, see tnc/probe.py), rnn: train the RnnPredictor. Defaults to rnn with --plot_embeddings, linear otherwise')
+    parser.add_argument('--probe_pooling', type=str, default='last', choices=['last', 'mean', 'max'])
 
     args = parser.parse_args()
+    # The embedding and risk plots are made with the trained RnnPredictor
+    if args.probe is None:
+        args.probe = 'rnn' if args.plot_embeddings else 'linear'
+    elif args.probe == 'linear' and args.plot_embeddings:
+        parser.error('--plot_embeddings needs the RnnPredictor, use --probe rnn')
 
     if args.encoder_type == 'Transformer':
         encoder_hyper_params = {'verbose': False,
@@ -169,7 +177,10 @@ if __name__ == '__main__':
                                     'ACF_nghd_Threshold': args.ACF_nghd_Threshold,
                                     'ACF_out_nghd_Threshold': args.ACF_out_nghd_Threshold}
     
-    classification_hyper_params = {'n_cross_val_classification': args.n_cross_val_classification}
+    classification_hyper_params = {'n_cross_val_classification': args.n_cross_val_classification,
+                                   'packed_sequences': args.packed_sequences,
+                                   'probe': args.probe,
+                                   'probe_pooling': args.probe_pooling}
     
     
     UNIQUE_ID = args.ID